@@ -0,0 +1,63 @@
+# Per-call latency of Pi-hole API calls with a fresh connection per call (the
+# previous behaviour of apiCall) versus the pooled keep-alive session.
+#
+#   python -m benchmarks.bench_session --calls 500 --latency-ms 0
+import argparse, statistics, sys, time, types
+
+import requests
+
+
+def importShim():
+  sys.modules.setdefault('docker', types.SimpleNamespace(DockerClient=lambda base_url, **kwargs: object()))
+  import shim
+  return shim
+
+
+def summarise(label, samples, connections):
+  samples = sorted(samples)
+  p95 = samples[int(len(samples) * 0.95) - 1]
+  print("%-10s calls=%-5d connections=%-5d mean=%.3fms p50=%.3fms p95=%.3fms total=%.3fs" %(
+    label, len(samples), connections,
+    statistics.mean(samples) * 1000, statistics.median(samples) * 1000, p95 * 1000, sum(samples),
+  ))
+
+
+def run(calls, latency):
+  from benchmarks.fake_pihole import FakePihole
+
+  shim = importShim()
+  with FakePihole(latency=latency) as fake:
+    shim.moduleTarget.piholeAPI = fake.url
+    shim.moduleTarget.token = fake.password
+    shim.moduleTarget.session = None
+    shim.sessionPersist = False
+    shim.moduleTarget.sid = shim.auth()
+    headers = {"sid": shim.moduleTarget.sid, "User-Agent": "docker-pihole-dns-shim"}
+
+    fake.resetCounters()
+    samples = []
+    for index in range(calls):
+      started = time.perf_counter()
+      requests.put("%s/config/dns/hosts/10.1.%s.%s fresh%s.lan" %(fake.url, index // 250, index % 250, index), headers=headers)
+      samples.append(time.perf_counter() - started)
+    summarise("fresh", samples, fake.connections)
+
+    fake.resetCounters()
+    samples = []
+    for index in range(calls):
+      started = time.perf_counter()
+      shim.apiCall("createDns", payload="10.2.%s.%s pooled%s.lan" %(index // 250, index % 250, index))
+      samples.append(time.perf_counter() - started)
+    summarise("pooled", samples, fake.connections)
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Compare per-call latency of fresh connections against the pooled session.")
+  parser.add_argument("--calls", type=int, default=500)
+  parser.add_argument("--latency-ms", type=float, default=0.0, help="Server-side latency injected per request.")
+  args = parser.parse_args(argv)
+  run(args.calls, args.latency_ms / 1000)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,104 @@
+# Cost of persisting state per sync cycle for large owned sets: the previous
+# full indent=2 rewrite versus change-only snapshots and the journal.
+#
+#   python -m benchmarks.bench_state --records 10000 100000
+import argparse, json, os, sys, tempfile, time, types
+
+
+def importShim():
+  sys.modules.setdefault('docker', types.SimpleNamespace(DockerClient=lambda base_url, **kwargs: object()))
+  import shim
+  return shim
+
+
+def legacyFlush(shim):
+  owned_list = list(shim.moduleTarget.store.owned)
+  last_seen_list = [[k[0], k[1], shim.moduleTarget.store.lastSeen(k, int(time.time()))] for k in owned_list]
+  jsonObject = json.dumps({"owned": owned_list, "last_seen": last_seen_list, "version": 2}, indent=2)
+  with open(shim.moduleTarget.statePath, "w") as outfile:
+    outfile.write(jsonObject)
+
+
+def measure(label, shim, fn, records):
+  started = time.perf_counter()
+  fn()
+  elapsed = time.perf_counter() - started
+  written = os.path.getsize(shim.moduleTarget.statePath) if os.path.exists(shim.moduleTarget.statePath) else 0
+  journal = shim.journalPath()
+  journalBytes = os.path.getsize(journal) if os.path.exists(journal) else 0
+  print("%-8d %-28s %8.1fms  state=%-10d journal=%d" %(records, label, elapsed * 1000, written, journalBytes))
+
+
+def steadyState(shim, records, minutes):
+  # Sync cycles every 10 seconds over several minutes with every record labeled,
+  # each one bumping all last_seen well past STATE_LAST_SEEN_RESOLUTION
+  realTime = time.time
+  clock = [int(realTime())]
+  time.time = lambda: clock[0]
+  writes = 0
+  try:
+    started = time.perf_counter()
+    for clock[0] in range(clock[0] + 10, clock[0] + minutes * 60 + 10, 10):
+      for tup in shim.moduleTarget.store.owned:
+        shim.moduleTarget.store.seen(tup, clock[0])
+      if shim.flushList():
+        writes += 1
+    elapsed = time.perf_counter() - started
+  finally:
+    time.time = realTime
+  written = os.path.getsize(shim.moduleTarget.statePath)
+  journal = shim.journalPath()
+  journalBytes = os.path.getsize(journal) if os.path.exists(journal) else 0
+  print("%-8d %-28s %8.1fms  state=%-10d journal=%d writes=%d" %(records, "steady %dmin, 10s cycles" % minutes, elapsed * 1000, written, journalBytes, writes))
+
+
+def scenario(shim, records, churn, minutes):
+  shim.moduleTarget.store = shim.RecordStore()
+  for i in range(records):
+    shim.moduleTarget.store.own(("host%s.lan" % i, "10.%s.%s.%s" %(i >> 16 & 255, i >> 8 & 255, i & 255)), 1000)
+  shim.moduleTarget.persistedOwned = None
+  shim.moduleTarget.persistedLabeledAt = None
+  shim.moduleTarget.persistedGeneration = 0
+  shim.moduleTarget.journalEntries = 0
+  for path in (shim.moduleTarget.statePath, shim.journalPath()):
+    if os.path.exists(path):
+      os.remove(path)
+
+  measure("legacy full rewrite", shim, lambda: legacyFlush(shim), records)
+  measure("snapshot (first write)", shim, shim.flushList, records)
+  # Every labeled record gets its last_seen bumped each cycle, within the resolution
+  for tup in shim.moduleTarget.store.owned:
+    shim.moduleTarget.store.seen(tup, 1010)
+  measure("unchanged (last_seen bump)", shim, shim.flushList, records)
+
+  changed = sorted(shim.moduleTarget.store.owned)[:churn]
+  for index, tup in enumerate(changed):
+    shim.moduleTarget.store.disown(tup)
+    shim.moduleTarget.store.own(("new%s.lan" % index, tup[1]), 1010)
+  shim.stateJournal = False
+  saved = (set(shim.moduleTarget.persistedOwned), dict(shim.moduleTarget.persistedLastSeen), shim.moduleTarget.persistedLabeledAt)
+  measure("%d changes, snapshot" % churn, shim, shim.flushList, records)
+
+  shim.moduleTarget.persistedOwned, shim.moduleTarget.persistedLastSeen, shim.moduleTarget.persistedLabeledAt = saved
+  shim.stateJournal = True
+  shim.stateCompactEntries = max(churn * 4, 1000)
+  measure("%d changes, journal" % churn, shim, shim.flushList, records)
+  steadyState(shim, records, minutes)
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Benchmark state persistence for large owned record sets.")
+  parser.add_argument("--records", type=int, nargs="+", default=[10000, 100000])
+  parser.add_argument("--churn", type=int, default=50, help="Records added/removed between the last two writes.")
+  parser.add_argument("--minutes", type=int, default=10, help="Duration of the steady state with every record labeled.")
+  args = parser.parse_args(argv)
+
+  shim = importShim()
+  with tempfile.TemporaryDirectory() as tmp:
+    shim.moduleTarget.statePath = os.path.join(tmp, "pihole.state")
+    for records in args.records:
+      scenario(shim, records, args.churn, args.minutes)
+
+
+if __name__ == "__main__":
+  main()
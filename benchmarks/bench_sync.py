@@ -0,0 +1,158 @@
+# Synthetic-load benchmark of sync_once() against an in-process fake Pi-hole and
+# fake Docker, reporting wall time, API calls, peak Python heap and state size for:
+#
+#   cold    first sync with N labeled containers, empty Pi-hole and state
+#   steady  the next sync with nothing changed
+#   churn   a fraction of the containers replaced by new ones
+#   reap    every container gone, all owned records removed
+#
+#   python -m benchmarks.bench_sync --records 1000 10000 --latency-ms 1
+#   python -m benchmarks.bench_sync --records 1000 --save baseline.json
+#   python -m benchmarks.bench_sync --records 1000 --baseline baseline.json
+#
+# With --baseline the run fails when wall time or API calls of a scenario
+# exceed the baseline by more than --tolerance.
+import argparse, importlib, json, logging, os, sys, tempfile, time, tracemalloc, types
+
+from benchmarks.fake_docker import FakeDocker, records
+from benchmarks.fake_pihole import FakePihole
+
+SCENARIOS = ("cold", "steady", "churn", "reap")
+
+
+def importShim(settings):
+  sys.modules.pop('shim', None)
+  sys.modules['docker'] = types.SimpleNamespace(DockerClient=lambda base_url, **kwargs: object())
+  shim = importlib.import_module('shim')
+  for name, value in settings.items():
+    setattr(shim, name, value)
+  return shim
+
+
+def measure(shim, fake, name, count, action):
+  fake.resetCounters()
+  # Peak of this scenario alone, the process-wide max RSS never goes down
+  tracemalloc.reset_peak()
+  current, _ = tracemalloc.get_traced_memory()
+  started = time.perf_counter()
+  action()
+  elapsed = time.perf_counter() - started
+  _, peak = tracemalloc.get_traced_memory()
+  stateBytes = sum(
+    os.path.getsize(path) for path in (shim.moduleTarget.statePath, shim.journalPath()) if os.path.exists(path)
+  )
+  return {
+    "scenario": name,
+    "records": count,
+    "seconds": round(elapsed, 4),
+    "apiCalls": sum(fake.calls.values()),
+    "calls": dict(sorted(fake.calls.items())),
+    "peakKb": (peak - current) // 1024,
+    "stateBytes": stateBytes,
+    "owned": len(shim.moduleTarget.store),
+  }
+
+
+def runSize(count, args, tmp, name="pihole"):
+  settings = {
+    "applyConcurrency": args.concurrency,
+    "batchApply": args.batch,
+    "stateJournal": args.journal,
+    "recordCacheSeconds": args.record_cache_seconds,
+    "reapSeconds": 0,
+    # Measure reaping everything in one sync rather than the mass-reap spreading
+    "reapRatePerSecond": 0,
+  }
+  shim = importShim(settings)
+  shim.moduleTarget.statePath = os.path.join(tmp, "%s-%s.state" %(name, count))
+  docker = FakeDocker.generate(count)
+  shim.client = docker
+  results = []
+  with FakePihole(latency=args.latency_ms / 1000, writeLatency=args.write_latency_ms / 1000) as fake:
+    shim.moduleTarget.piholeAPI = fake.url
+    shim.moduleTarget.token = fake.password
+    shim.moduleTarget.sid = shim.auth()
+
+    results.append(measure(shim, fake, "cold", count, shim.sync_once))
+    results.append(measure(shim, fake, "steady", count, shim.sync_once))
+
+    churned = max(1, int(count * args.churn))
+    for index in range(churned):
+      docker.stop("app%s" % index)
+      docker.start("new%s" % index, records(index, prefix="new"))
+    results.append(measure(shim, fake, "churn", count, shim.sync_once))
+
+    for containerId in list(docker.labels):
+      docker.stop(containerId)
+    results.append(measure(shim, fake, "reap", count, shim.sync_once))
+  return results
+
+
+def compare(results, baselinePath, tolerance):
+  with open(baselinePath) as openfile:
+    baseline = dict(((entry["scenario"], entry["records"]), entry) for entry in json.load(openfile))
+  regressions = []
+  for entry in results:
+    reference = baseline.get((entry["scenario"], entry["records"]))
+    if reference is None:
+      continue
+    for key in ("seconds", "apiCalls"):
+      # Ignore sub-10ms noise on the wall time of tiny scenarios
+      limit = max(reference[key] * tolerance, 0.01 if key == "seconds" else 0)
+      if entry[key] > limit:
+        regressions.append("%s/%s %s: %s > %s (baseline %s)" %(entry["scenario"], entry["records"], key, entry[key], round(limit, 4), reference[key]))
+  return regressions
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Benchmark sync_once() against a fake Pi-hole and fake Docker.")
+  parser.add_argument("--records", type=int, nargs="+", default=[1000])
+  parser.add_argument("--latency-ms", type=float, default=0.0, help="Latency injected into every Pi-hole call.")
+  parser.add_argument("--write-latency-ms", type=float, default=0.0, help="Extra latency of Pi-hole config writes.")
+  parser.add_argument("--churn", type=float, default=0.1, help="Fraction of containers replaced in the churn scenario.")
+  parser.add_argument("--concurrency", type=int, default=1, help="APPLY_CONCURRENCY")
+  parser.add_argument("--batch", action="store_true", help="BATCH_APPLY")
+  parser.add_argument("--journal", action="store_true", help="STATE_JOURNAL")
+  parser.add_argument("--record-cache-seconds", type=int, default=0, help="RECORD_CACHE_SECONDS")
+  parser.add_argument("--save", help="Write the results as JSON to this file.")
+  parser.add_argument("--baseline", help="Fail when results regress against this saved JSON.")
+  parser.add_argument("--tolerance", type=float, default=1.25)
+  args = parser.parse_args(argv)
+
+  logging.disable(logging.INFO)
+  results = []
+  with tempfile.TemporaryDirectory() as tmp:
+    for count in args.records:
+      timed = runSize(count, args, tmp)
+      # Tracing slows everything down, so the peaks come from a second run of
+      # the same scenarios and the timed run stays untraced
+      tracemalloc.start()
+      try:
+        traced = runSize(count, args, tmp, name="traced")
+      finally:
+        tracemalloc.stop()
+      for entry, tracedEntry in zip(timed, traced):
+        entry["peakKb"] = tracedEntry["peakKb"]
+      results.extend(timed)
+
+  print("%-8s %-8s %10s %9s %12s %12s %8s" %("scenario", "records", "seconds", "apiCalls", "peakKb", "stateBytes", "owned"))
+  for entry in results:
+    print("%-8s %-8d %10.3f %9d %12d %12d %8d" %(
+      entry["scenario"], entry["records"], entry["seconds"], entry["apiCalls"],
+      entry["peakKb"], entry["stateBytes"], entry["owned"],
+    ))
+
+  if args.save:
+    with open(args.save, "w") as outfile:
+      json.dump(results, outfile, indent=2)
+
+  if args.baseline:
+    regressions = compare(results, args.baseline, args.tolerance)
+    for regression in regressions:
+      print("REGRESSION %s" % regression)
+    return 1 if regressions else 0
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
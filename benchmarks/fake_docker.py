@@ -0,0 +1,59 @@
+# Stand-in for the parts of the Docker SDK used by the shim, with N labeled containers.
+import json, queue, types
+
+
+class FakeDocker:
+  def __init__(self, containers=None):
+    # container id -> labels
+    self.labels = dict(containers or {})
+    self.eventQueue = queue.Queue()
+    self.listCalls = 0
+    self.api = types.SimpleNamespace(containers=self.listSummaries)
+    self.containers = types.SimpleNamespace(list=self.listContainers)
+
+  @classmethod
+  def generate(cls, count, cnameEvery=5, prefix="app"):
+    fake = cls()
+    for index in range(count):
+      fake.start("%s%s" %(prefix, index), records(index, cnameEvery, prefix))
+    return fake
+
+  def start(self, containerId, recordList, emit=False):
+    self.labels[containerId] = {"pihole.custom-record": json.dumps(recordList)}
+    if emit:
+      self.emit("start", containerId)
+
+  def stop(self, containerId, emit=False):
+    labels = self.labels.pop(containerId)
+    if emit:
+      self.emit("die", containerId, labels)
+
+  def emit(self, action, containerId, labels=None):
+    attributes = dict(labels if labels is not None else self.labels.get(containerId, {}), name=containerId)
+    self.eventQueue.put({"Type": "container", "Action": action, "Actor": {"ID": containerId, "Attributes": attributes}})
+
+  def listSummaries(self, filters=None):
+    self.listCalls += 1
+    label = (filters or {}).get("label")
+    return [
+      {"Id": containerId, "Labels": labels}
+      for containerId, labels in self.labels.items()
+      if label is None or label in labels
+    ]
+
+  def listContainers(self, filters=None):
+    return [types.SimpleNamespace(id=summary["Id"], labels=summary["Labels"]) for summary in self.listSummaries(filters)]
+
+  def events(self, decode=True, filters=None):
+    while True:
+      event = self.eventQueue.get()
+      if event is None:
+        return
+      yield event
+
+
+def records(index, cnameEvery=5, prefix="app"):
+  domain = "%s%s.lan" %(prefix, index)
+  if cnameEvery and index % cnameEvery == cnameEvery - 1:
+    return [[domain, "%s%s.lan" %(prefix, index - 1)]]
+  return [[domain, "10.%s.%s.%s" %(index >> 16 & 255, index >> 8 & 255, index & 255)]]
@@ -0,0 +1,197 @@
+# In-process stand-in for the parts of the Pi-hole v6 REST API used by the shim.
+import json, socket, threading, time, uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
+
+
+class FakePihole:
+  def __init__(self, password="secret", latency=0.0, validity=1800, writeLatency=0.0):
+    self.password = password
+    self.latency = latency
+    # Extra delay of config writes, which make Pi-hole rewrite its config and reload FTL
+    self.writeLatency = writeLatency
+    self.validity = validity
+    self.hosts = []
+    self.cnames = []
+    self.sessions = {}
+    self.calls = Counter()
+    self.connections = 0
+    self.lock = threading.Lock()
+    self.server = None
+    self.thread = None
+
+  @property
+  def url(self):
+    host, port = self.server.server_address[:2]
+    return "http://%s:%s/api" %(host, port)
+
+  def start(self):
+    fake = self
+
+    class Handler(PiholeHandler):
+      pihole = fake
+
+    self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    self.server.daemon_threads = True
+    self.thread = threading.Thread(target=self.server.serve_forever, name="fake-pihole", daemon=True)
+    self.thread.start()
+    return self.url
+
+  def stop(self):
+    if self.server is not None:
+      self.server.shutdown()
+      self.server.server_close()
+      self.server = None
+
+  def __enter__(self):
+    self.start()
+    return self
+
+  def __exit__(self, *exc):
+    self.stop()
+
+  def resetCounters(self):
+    with self.lock:
+      self.calls.clear()
+      self.connections = 0
+
+
+def routeFamily(route):
+  # Collapse item paths such as /config/dns/hosts/<item> for call accounting
+  for prefix in ("/config/dns/hosts", "/config/dns/cnameRecords", "/auth/session/"):
+    if route.startswith(prefix):
+      return prefix.rstrip("/")
+  return route
+
+
+class PiholeHandler(BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+  pihole = None
+
+  def setup(self):
+    super().setup()
+    # Headers and body are separate writes, don't let Nagle delay the body
+    self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    with self.pihole.lock:
+      self.pihole.connections += 1
+
+  def log_message(self, format, *args):
+    pass
+
+  def reply(self, status, body=None):
+    data = b"" if body is None else json.dumps(body).encode()
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    if data:
+      self.wfile.write(data)
+
+  def readJson(self):
+    length = int(self.headers.get("Content-Length") or 0)
+    if length == 0:
+      return None
+    return json.loads(self.rfile.read(length))
+
+  def authorised(self):
+    sid = self.headers.get("sid")
+    with self.pihole.lock:
+      expires = self.pihole.sessions.get(sid)
+      if expires is not None and expires > time.time():
+        # Like Pi-hole, every authenticated request restarts the validity window
+        self.pihole.sessions[sid] = time.time() + self.pihole.validity
+        return True
+    self.reply(401, {"error": {"key": "unauthorized", "message": "Unauthorized"}})
+    return False
+
+  def handle_one(self, method):
+    fake = self.pihole
+    # Drain the body before anything else so keep-alive connections stay in sync
+    body = self.readJson()
+    path = urlsplit(self.path).path
+    if fake.latency:
+      time.sleep(fake.latency)
+    if fake.writeLatency and method in ("PUT", "DELETE", "PATCH") and path.startswith("/api/config"):
+      time.sleep(fake.writeLatency)
+    route = path[len("/api"):] if path.startswith("/api") else path
+    with fake.lock:
+      fake.calls["%s %s" %(method, routeFamily(route))] += 1
+
+    if route == "/auth" and method == "POST":
+      if (body or {}).get("password") != fake.password:
+        return self.reply(401, {"session": {"valid": False, "sid": None, "validity": -1}})
+      sid = uuid.uuid4().hex
+      with fake.lock:
+        fake.sessions[sid] = time.time() + fake.validity
+      return self.reply(200, {"session": {"valid": True, "sid": sid, "validity": fake.validity}})
+    if not self.authorised():
+      return
+    if route == "/auth" and method == "GET":
+      return self.reply(200, {"session": {"valid": True, "sid": self.headers.get("sid"), "validity": fake.validity}})
+    if route == "/auth/sessions" and method == "GET":
+      current = self.headers.get("sid")
+      with fake.lock:
+        sessions = [
+          {"id": index, "current_session": key == current, "user_agent": "docker-pihole-dns-shim"}
+          for index, key in enumerate(fake.sessions)
+        ]
+      return self.reply(200, {"sessions": sessions})
+    if route.startswith("/auth/session/") and method == "DELETE":
+      index = int(route.rsplit("/", 1)[1])
+      with fake.lock:
+        keys = list(fake.sessions)
+        if 0 <= index < len(keys):
+          del fake.sessions[keys[index]]
+      return self.reply(204)
+
+    if route == "/config" and method == "PATCH":
+      dns = ((body or {}).get("config") or {}).get("dns") or {}
+      with fake.lock:
+        if "hosts" in dns:
+          fake.hosts[:] = dns["hosts"]
+        if "cnameRecords" in dns:
+          fake.cnames[:] = dns["cnameRecords"]
+        config = {"dns": {"hosts": list(fake.hosts), "cnameRecords": list(fake.cnames)}}
+      return self.reply(200, {"config": config})
+
+    for prefix, records, key in (
+      ("/config/dns/hosts", fake.hosts, "hosts"),
+      ("/config/dns/cnameRecords", fake.cnames, "cnameRecords"),
+    ):
+      if route == prefix and method == "GET":
+        with fake.lock:
+          return self.reply(200, {"config": {"dns": {key: list(records)}}})
+      if route.startswith(prefix + "/"):
+        item = unquote(route[len(prefix) + 1:])
+        with fake.lock:
+          present = item in records
+          if method == "PUT" and not present:
+            records.append(item)
+          elif method == "DELETE" and present:
+            records.remove(item)
+        if method == "PUT":
+          if present:
+            return self.reply(400, {"error": {"key": "bad_request", "message": "Item already present"}})
+          return self.reply(201)
+        if method == "DELETE":
+          if not present:
+            return self.reply(404, {"error": {"key": "not_found", "message": "Item not found"}})
+          return self.reply(204)
+
+    self.reply(404, {"error": {"key": "not_found", "message": "Not found"}})
+
+  def do_GET(self):
+    self.handle_one("GET")
+
+  def do_POST(self):
+    self.handle_one("POST")
+
+  def do_PUT(self):
+    self.handle_one("PUT")
+
+  def do_DELETE(self):
+    self.handle_one("DELETE")
+
+  def do_PATCH(self):
+    self.handle_one("PATCH")
@@ -1,14 +1,89 @@
-import docker, time, requests, json, socket, os, sys, logging, argparse
+import time, json, os, sys, logging, argparse, queue, threading, contextvars, re, heapq, random, ipaddress, functools, socket, fcntl
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
-dockerUrl = os.getenv('DOCKER_URL', "unix://var/run/docker.sock")
+def envFlag(name, default="false"):
+  return os.getenv(name, default).strip().lower() in ("1", "true", "yes", "on")
 
-client = docker.DockerClient(base_url=dockerUrl)
+dockerUrl = os.getenv('DOCKER_URL', "unix://var/run/docker.sock")
+dockerTimeoutSeconds = int(os.getenv('DOCKER_TIMEOUT_SECONDS', "60"))
 
 token = os.getenv('PIHOLE_TOKEN', "")
 piholeAPI = os.getenv('PIHOLE_API', "http://pi.hole:8080/api")
 statePath = os.getenv('STATE_FILE', "/state/pihole.state")
 intervalSeconds = int(os.getenv('INTERVAL_SECONDS', "10"))
+# 0 means INTERVAL_SECONDS, so polling stays fixed unless MAX_INTERVAL_SECONDS is raised
+minIntervalSeconds = float(os.getenv('MIN_INTERVAL_SECONDS', "0"))
+maxIntervalSeconds = float(os.getenv('MAX_INTERVAL_SECONDS', "0"))
+intervalGrowth = float(os.getenv('INTERVAL_GROWTH', "2"))
+backoffBaseSeconds = float(os.getenv('BACKOFF_BASE_SECONDS', "0"))
+backoffMaxSeconds = float(os.getenv('BACKOFF_MAX_SECONDS', "300"))
 reapSeconds = int(os.getenv('REAP_SECONDS', str(10*60)))
+reapBurst = int(os.getenv('REAP_BURST', "100"))
+reapRatePerSecond = float(os.getenv('REAP_RATE_PER_SECOND', "10"))
+writeRatePerSecond = float(os.getenv('WRITE_RATE_PER_SECOND', "0"))
+writeBurst = int(os.getenv('WRITE_BURST', "10"))
+mutationWindowSeconds = float(os.getenv('MUTATION_WINDOW_SECONDS', "0"))
+watchEvents = envFlag('WATCH_EVENTS')
+reconcileSeconds = int(os.getenv('RECONCILE_SECONDS', str(5*60)))
+httpPoolSize = int(os.getenv('HTTP_POOL_SIZE', "10"))
+httpTimeoutSeconds = float(os.getenv('HTTP_TIMEOUT_SECONDS', "10"))
+httpRetries = int(os.getenv('HTTP_RETRIES', "3"))
+httpBackoffSeconds = float(os.getenv('HTTP_BACKOFF_SECONDS', "0.5"))
+applyConcurrency = int(os.getenv('APPLY_CONCURRENCY', "1"))
+batchApply = envFlag('BATCH_APPLY')
+maxStaleSeconds = int(os.getenv('MAX_STALE_SECONDS', "0"))
+stateJournal = envFlag('STATE_JOURNAL')
+stateCompactEntries = int(os.getenv('STATE_COMPACT_ENTRIES', "1000"))
+lastSeenResolution = int(os.getenv('STATE_LAST_SEEN_RESOLUTION', "60"))
+recordCacheSeconds = int(os.getenv('RECORD_CACHE_SECONDS', "0"))
+targetTimeoutSeconds = float(os.getenv('TARGET_TIMEOUT_SECONDS', "60"))
+metricsPort = int(os.getenv('METRICS_PORT', "0"))
+healthIntervals = int(os.getenv('HEALTH_INTERVALS', "3"))
+sessionPersist = envFlag('SESSION_PERSIST', "true")
+sessionRefreshSeconds = int(os.getenv('SESSION_REFRESH_SECONDS', "60"))
+leaseFile = os.getenv('LEADER_LEASE_FILE', "")
+leaseSeconds = float(os.getenv('LEADER_LEASE_SECONDS', "15"))
+leaseRenewSeconds = float(os.getenv('LEADER_RENEW_SECONDS', "5"))
+leaderId = os.getenv('LEADER_ID', "") or "%s-%s" %(socket.gethostname(), os.getpid())
+
+labelKey = os.getenv('LABEL_KEY', "pihole.custom-record")
+labelPrefix = os.getenv('LABEL_PREFIX', "pihole")
+labelSources = frozenset(source.strip() for source in os.getenv('LABEL_SOURCES', "json").split(",") if source.strip())
+traefikTarget = os.getenv('TRAEFIK_TARGET', "")
+conflictPolicy = os.getenv('CONFLICT_POLICY', "priority").lower()
+adoptUnmanaged = envFlag('ADOPT_UNMANAGED')
+
+def endpointName(url):
+  # Short file/log friendly name of a Pi-hole or Docker endpoint url
+  scheme, _, rest = url.partition("://")
+  if not rest:
+    rest = scheme
+  elif scheme != "unix":
+    rest = rest.split("/", 1)[0]
+  return re.sub(r"[^A-Za-z0-9.-]+", "_", rest.strip("/"))
+
+class DockerSource:
+  # One Docker endpoint and the labeled containers of its last successful scan
+  def __init__(self, name, url):
+    self.name = name
+    self.url = url
+    self.client = None
+    self.containers = None
+    self.labelCache = {}
+
+def buildSources(urls):
+  # Several comma separated DOCKER_URLs are scanned and merged into one record set
+  urls = [url.strip() for url in urls.split(",") if url.strip()]
+  if len(urls) <= 1:
+    return []
+  return [DockerSource(endpointName(url), url) for url in urls]
+
+dockerSources = buildSources(dockerUrl)
+# Created on first use, see defaultClient()
+client = None
+eventActions = ("start", "die", "update")
 
 loggingLevel = logging.getLevelName(os.getenv('LOGGING_LEVEL', "INFO"))
 logging.basicConfig(
@@ -20,16 +95,636 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-global globalList
-globalList = set()
-global globalLastSeen
-globalLastSeen = {}
+class Metrics:
+  # Minimal Prometheus registry and text exposition, so metrics need no client library
+  buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.meta = {}
+    self.values = {}
+    self.histograms = {}
+
+  def describe(self, name, kind, text):
+    self.meta[name] = (kind, text)
+
+  def key(self, name, labels):
+    # Label values are kept as strings, so series keys always sort (e.g. code=200 next to code="error")
+    return (name, tuple(sorted((label, str(value)) for label, value in labels.items())))
+
+  def inc(self, name, amount=1, **labels):
+    key = self.key(name, labels)
+    with self.lock:
+      self.values[key] = self.values.get(key, 0) + amount
+
+  def set(self, name, value, **labels):
+    key = self.key(name, labels)
+    with self.lock:
+      self.values[key] = value
+
+  def observe(self, name, value, **labels):
+    key = self.key(name, labels)
+    with self.lock:
+      counts, total = self.histograms.get(key, ([0] * len(self.buckets), 0.0))
+      counts = [count + (1 if value <= bound else 0) for count, bound in zip(counts, self.buckets)]
+      self.histograms[key] = (counts, total + value)
+      self.values[(name + "_count", key[1])] = self.values.get((name + "_count", key[1]), 0) + 1
+
+  @contextmanager
+  def time(self, name, **labels):
+    started = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.observe(name, time.perf_counter() - started, **labels)
+
+  def render(self):
+    def formatLabels(labels):
+      if not labels:
+        return ""
+      return "{%s}" %(",".join('%s="%s"' %(key, str(value).replace("\\", "\\\\").replace('"', '\\"')) for key, value in labels))
+
+    lines = []
+    with self.lock:
+      for name, (kind, text) in sorted(self.meta.items()):
+        lines.append("# HELP %s %s" %(name, text))
+        lines.append("# TYPE %s %s" %(name, kind))
+        if kind == "histogram":
+          for (metric, labels), (counts, total) in sorted(self.histograms.items()):
+            if metric != name:
+              continue
+            for bound, count in zip(self.buckets, counts):
+              lines.append("%s_bucket%s %s" %(name, formatLabels(labels + (("le", bound),)), count))
+            observed = self.values[(name + "_count", labels)]
+            lines.append("%s_bucket%s %s" %(name, formatLabels(labels + (("le", "+Inf"),)), observed))
+            lines.append("%s_sum%s %s" %(name, formatLabels(labels), total))
+            lines.append("%s_count%s %s" %(name, formatLabels(labels), observed))
+        else:
+          for (metric, labels), value in sorted(self.values.items()):
+            if metric == name:
+              lines.append("%s%s %s" %(name, formatLabels(labels), value))
+    return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.describe("pihole_shim_sync_duration_seconds", "histogram", "Duration of a full sync.")
+metrics.describe("pihole_shim_phase_duration_seconds", "histogram", "Duration of the phases of a sync.")
+metrics.describe("pihole_shim_api_request_duration_seconds", "histogram", "Duration of Pi-hole API calls by endpoint.")
+metrics.describe("pihole_shim_api_responses_total", "counter", "Pi-hole API responses by endpoint and status code.")
+metrics.describe("pihole_shim_records_added_total", "counter", "Records added to Pi-hole.")
+metrics.describe("pihole_shim_records_removed_total", "counter", "Records removed from Pi-hole.")
+metrics.describe("pihole_shim_records_synced_total", "counter", "Owned records re-added after drifting from Pi-hole.")
+metrics.describe("pihole_shim_record_failures_total", "counter", "Record changes Pi-hole did not accept.")
+metrics.describe("pihole_shim_deferred_reaps_total", "counter", "Removals deferred by the reap window, counted per sync.")
+metrics.describe("pihole_shim_logins_total", "counter", "Pi-hole logins by reason.")
+metrics.describe("pihole_shim_record_cache_lookups_total", "counter", "Pi-hole record lookups served from the cache (hit) or the API (miss).")
+metrics.describe("pihole_shim_reaps_rate_limited_total", "counter", "Due removals pushed back to spread a mass reap.")
+metrics.describe("pihole_shim_writes_throttled_total", "counter", "Pi-hole writes delayed by the WRITE_RATE_PER_SECOND limit.")
+metrics.describe("pihole_shim_write_throttle_seconds_total", "counter", "Seconds Pi-hole writes waited for the WRITE_RATE_PER_SECOND limit.")
+metrics.describe("pihole_shim_mutations_coalesced_total", "counter", "Queued record changes cancelled by an opposing change within the mutation window.")
+metrics.describe("pihole_shim_mutation_queue_depth", "gauge", "Record changes waiting in the mutation queue.")
+metrics.describe("pihole_shim_mutation_latency_seconds", "histogram", "Time from queueing a record change to writing it to Pi-hole.")
+metrics.describe("pihole_shim_lease_renewals_total", "counter", "Leader lease renewals by result (leader, standby, error).")
+metrics.describe("pihole_shim_lease_renew_duration_seconds", "histogram", "Duration of a leader lease renewal.")
+metrics.describe("pihole_shim_failover_seconds", "histogram", "Time from the previous leader's last lease renewal to a takeover.")
+metrics.describe("pihole_shim_leader", "gauge", "1 while this replica holds the leader lease.")
+metrics.describe("pihole_shim_label_errors_total", "counter", "Malformed container labels ignored.")
+metrics.describe("pihole_shim_domain_conflicts_total", "counter", "Domains found labeled with conflicting targets, by resolution policy.")
+metrics.describe("pihole_shim_domain_conflicts", "gauge", "Domains currently labeled with conflicting targets.")
+metrics.describe("pihole_shim_records_adopted_total", "counter", "Pi-hole records the shim did not create that it took ownership of.")
+metrics.describe("pihole_shim_unmanaged_records", "gauge", "Labeled records Pi-hole already has from elsewhere, left unmanaged.")
+metrics.describe("pihole_shim_owned_records", "gauge", "Records currently owned by the shim.")
+metrics.describe("pihole_shim_last_success_timestamp_seconds", "gauge", "Time of the last sync that completed without failures.")
+
+# Last sign of progress of the sync loop, and when the next one is due at the
+# latest (the end of the wait the loop registered)
+heartbeatAt = None
+heartbeatDue = None
+
+def beat(within=0):
+  # Progress from other threads during a wait (e.g. an API call of an event or
+  # session cleanup) keeps the deadline of that wait
+  global heartbeatAt, heartbeatDue
+  heartbeatAt = time.time()
+  heartbeatDue = max(heartbeatDue or 0, heartbeatAt + within)
+
+def healthStatus(now):
+  # Alive while the loop made progress (a sync phase or an API call) within
+  # HEALTH_INTERVALS polling intervals of when it was due
+  if heartbeatAt is None:
+    return True, {"status": "starting"}
+  late = now - heartbeatDue
+  healthy = late <= healthIntervals * (minIntervalSeconds or intervalSeconds)
+  return healthy, {"status": "ok" if healthy else "stalled", "secondsSinceProgress": round(now - heartbeatAt, 1)}
+
+def readyStatus():
+  # Ready while every Pi-hole is authenticated, reachable and its last
+  # reconcile succeeded. A standby does not reconcile, it only has to be connected.
+  leader = isLeader()
+  checks = {}
+  for pihole in targets or [moduleTarget]:
+    problems = []
+    if pihole.sid is None:
+      problems.append("not authenticated")
+    if pihole.apiError is not None:
+      problems.append("unreachable: %s" %(pihole.apiError))
+    if pihole.backoff.failures:
+      problems.append("%s failed syncs" %(pihole.backoff.failures))
+    if leader and pihole.lastReconcile is None:
+      problems.append("no reconcile yet")
+    elif leader and not pihole.lastReconcile["clean"]:
+      problems.append("last reconcile had failures")
+    checks[pihole.name] = problems or "ok"
+  ready = all(check == "ok" for check in checks.values())
+  return ready, {"status": "ready" if ready else "not ready", "role": "leader" if leader else "standby", "targets": checks}
+
+def httpRoute(path):
+  # Status, content type and body served for a path by the metrics server
+  path = path.split("?", 1)[0]
+  if path == "/metrics":
+    return 200, "text/plain; version=0.0.4", metrics.render().encode()
+  if path in ("/healthz", "/readyz"):
+    ok, body = healthStatus(time.time()) if path == "/healthz" else readyStatus()
+    return 200 if ok else 503, "application/json", json.dumps(body).encode()
+  return 404, "text/plain", b"Not found\n"
+
+class MetricsHandler(BaseHTTPRequestHandler):
+  def do_GET(self):
+    status, contentType, body = httpRoute(self.path)
+    self.send_response(status)
+    self.send_header("Content-Type", contentType)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    logger.debug("metrics: " + format %(args))
+
+def startMetricsServer(port):
+  server = ThreadingHTTPServer(("", port), MetricsHandler)
+  server.daemon_threads = True
+  threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+  logger.info("Serving metrics and health checks on :%s" %(server.server_address[1]))
+  return server
+
+class Record:
+  # One record known to a RecordStore: owned, or only seen labeled so far
+  __slots__ = ("domain", "target", "kind", "owned", "lastSeen", "reapAt", "priority", "reapSeconds")
+
+  def __init__(self, domain, target):
+    self.domain = domain
+    self.target = target
+    self.kind = recordKind(target) or "CNAME"
+    self.owned = False
+    self.lastSeen = None
+    self.reapAt = None
+    # From the labels of the container it was last seen on, reapSeconds
+    # overrides REAP_SECONDS when set
+    self.priority = 0
+    self.reapSeconds = None
+
+class RecordStore:
+  # Owned records and last-seen times of one Pi-hole, indexed by domain, target
+  # and kind. Records that stopped being labeled are scheduled on a min-heap of
+  # reap deadlines, so finding the expired ones does not scan every record.
+  def __init__(self):
+    self.records = {}
+    self.owned = set()
+    self.scheduled = set()
+    self.domains = {}
+    self.targets = {}
+    self.kinds = {}
+    self.reapHeap = []
+
+  def __len__(self):
+    return len(self.owned)
+
+  def __contains__(self, key):
+    return key in self.owned
+
+  def __iter__(self):
+    return iter(self.owned)
+
+  def entry(self, key):
+    record = self.records.get(key)
+    if record is None:
+      record = self.records[key] = Record(key[0], key[1])
+    return record
+
+  def own(self, key, lastSeen=None):
+    record = self.entry(key)
+    if lastSeen is not None:
+      record.lastSeen = lastSeen
+    if not record.owned:
+      record.owned = True
+      self.owned.add(key)
+      self.domains.setdefault(record.domain, set()).add(key)
+      self.targets.setdefault(record.target, set()).add(key)
+      self.kinds.setdefault(record.kind, set()).add(key)
+
+  def disown(self, key):
+    # Forget the record entirely, last seen time and pending reap included
+    record = self.records.pop(key, None)
+    if record is None:
+      return
+    self.scheduled.discard(key)
+    if record.owned:
+      self.owned.discard(key)
+      for index, value in ((self.domains, record.domain), (self.targets, record.target), (self.kinds, record.kind)):
+        keys = index[value]
+        keys.discard(key)
+        if not keys:
+          del index[value]
+
+  def seen(self, key, when, options=None):
+    # options is the (priority, reapSeconds) pair of the labels it was seen on
+    record = self.entry(key)
+    record.lastSeen = when
+    if options is not None:
+      record.priority, record.reapSeconds = options
+
+  def prune(self, labeled):
+    # Forget records neither owned nor labeled any more, such as unmanaged,
+    # refused or failed adds whose label went away. Returns how many.
+    stale = [key for key, record in self.records.items() if not record.owned and key not in labeled]
+    for key in stale:
+      del self.records[key]
+    return len(stale)
+
+  def reapDelay(self, key):
+    record = self.records.get(key)
+    if record is None or record.reapSeconds is None:
+      return reapSeconds
+    return record.reapSeconds
+
+  def lastSeen(self, key, default=None):
+    record = self.records.get(key)
+    if record is None or record.lastSeen is None:
+      return default
+    return record.lastSeen
+
+  def byDomain(self, domain):
+    return set(self.domains.get(domain, ()))
+
+  def byTarget(self, target):
+    return set(self.targets.get(target, ()))
+
+  def byKind(self, kind):
+    return set(self.kinds.get(kind, ()))
+
+  def schedule(self, key, deadline):
+    # (Re)schedule an owned record for removal at deadline
+    record = self.records.get(key)
+    if record is None or not record.owned:
+      return
+    record.reapAt = deadline
+    self.scheduled.add(key)
+    heapq.heappush(self.reapHeap, (deadline, key))
+
+  def unschedule(self, key):
+    # Heap entries of unscheduled records are skipped when they surface
+    record = self.records.get(key)
+    if record is not None:
+      record.reapAt = None
+    self.scheduled.discard(key)
+
+  def reapAt(self, key):
+    record = self.records.get(key)
+    return None if record is None else record.reapAt
+
+  def current(self, deadline, key):
+    return key in self.scheduled and self.records[key].reapAt == deadline
+
+  def due(self, now):
+    # Scheduled records whose deadline passed, popped off the heap. They stay
+    # scheduled until disowned or rescheduled.
+    expired = []
+    while self.reapHeap and self.reapHeap[0][0] <= now:
+      deadline, key = heapq.heappop(self.reapHeap)
+      if self.current(deadline, key):
+        expired.append(key)
+    return expired
+
+  def nextDeadline(self):
+    while self.reapHeap and not self.current(*self.reapHeap[0]):
+      heapq.heappop(self.reapHeap)
+    return self.reapHeap[0][0] if self.reapHeap else None
+
+class DomainIndex:
+  # The containers labeling each domain and how conflicts between them are
+  # resolved. A domain is in conflict when containers label it with different
+  # targets of the same family (A, AAAA or CNAME), or one with a CNAME and
+  # another with addresses. A and AAAA records of different containers can
+  # coexist. CONFLICT_POLICY keeps the records of the container with the
+  # highest priority (then the oldest), of the oldest container, or refuses
+  # to add or remove any record of the domain. Only the domains of containers
+  # whose records or rank changed are resolved again.
+  def __init__(self):
+    self.containers = {}
+    # Container key -> (priority, created)
+    self.info = {}
+    # Domain -> {container key: records of that domain}
+    self.labels = {}
+    # Domain -> (labeling containers, winning container or None)
+    self.conflicts = {}
+    # Records not to publish, and records to keep as they are while refused
+    self.rejected = set()
+    self.held = set()
+    self.rejectedBy = {}
+
+  def rank(self, key):
+    priority, created = self.info.get(key, (0, 0))
+    if conflictPolicy == "oldest":
+      return (created, key)
+    return (-priority, created, key)
+
+  def put(self, key, records, info):
+    # Index a container's records, returns the domains whose labels changed
+    old = self.containers.get(key, frozenset())
+    rankChanged = self.info.get(key) != info
+    if records is old and not rankChanged:
+      return set()
+    if records:
+      self.containers[key] = records
+      self.info[key] = info
+    else:
+      self.containers.pop(key, None)
+      self.info.pop(key, None)
+    before, after = {}, {}
+    for byDomain, recordSet in ((before, old), (after, records)):
+      for tup in recordSet:
+        byDomain.setdefault(tup[0], set()).add(tup)
+    changed = set()
+    for domain in before.keys() | after.keys():
+      if not rankChanged and before.get(domain) == after.get(domain):
+        continue
+      changed.add(domain)
+      labeled = self.labels.setdefault(domain, {})
+      if domain in after:
+        labeled[key] = frozenset(after[domain])
+      else:
+        labeled.pop(key, None)
+        if not labeled:
+          del self.labels[domain]
+    return changed
+
+  def update(self, key, records, info=(0, 0)):
+    # Index one container (no records to forget it) and resolve its domains
+    changed = self.put(key, records, info)
+    for domain in changed:
+      self.resolve(domain)
+    return changed
+
+  def sync(self, containers, info):
+    # Bring the index in line with a full scan of the labeled containers
+    changed = set()
+    for key in [key for key in self.containers if key not in containers]:
+      changed |= self.put(key, frozenset(), None)
+    for key, records in containers.items():
+      changed |= self.put(key, records, info.get(key, (0, 0)))
+    for domain in changed:
+      self.resolve(domain)
+    return changed
+
+  def resolve(self, domain):
+    # Held records of a domain are always among its rejected ones
+    self.held -= self.rejectedBy.get(domain, frozenset())
+    self.rejected -= self.rejectedBy.pop(domain, frozenset())
+    previous = self.conflicts.pop(domain, None)
+    labeled = self.labels.get(domain, {})
+    everything = frozenset().union(*labeled.values()) if labeled else frozenset()
+    ranked = sorted(labeled, key=self.rank)
+    # Each family goes to the highest ranked container labeling it, and the
+    # top container decides between a CNAME and addresses
+    cname = bool(ranked) and any(recordKind(target) == "CNAME" for _, target in labeled[ranked[0]])
+    winners = {}
+    for key in ranked:
+      families = {}
+      for tup in labeled[key]:
+        families.setdefault(recordKind(tup[1]) or "CNAME", set()).add(tup)
+      for family, records in families.items():
+        if key == ranked[0] or (family == "CNAME") == cname:
+          winners.setdefault(family, records)
+    rejected = everything - frozenset().union(*winners.values()) if winners else frozenset()
+    if not rejected:
+      if previous is not None:
+        logger.info("Conflict on %s resolved" %(domain))
+        metrics.set("pihole_shim_domain_conflicts", len(self.conflicts))
+      return
+    if conflictPolicy == "refuse":
+      winner = None
+      rejected = everything
+      self.held |= everything
+    else:
+      winner = ranked[0]
+    self.rejected |= rejected
+    self.rejectedBy[domain] = rejected
+    self.conflicts[domain] = (tuple(sorted(labeled)), winner)
+    if self.conflicts[domain] != previous:
+      metrics.inc("pihole_shim_domain_conflicts_total", policy=conflictPolicy)
+      claims = "; ".join("%s: %s" %(key, ", ".join(sorted(target for _, target in labeled[key]))) for key in sorted(labeled))
+      if winner is None:
+        logger.warning("Containers label %s with conflicting targets (%s), not changing its records" %(domain, claims))
+      else:
+        logger.warning("Containers label %s with conflicting targets (%s), keeping those of %s" %(domain, claims, winner))
+    metrics.set("pihole_shim_domain_conflicts", len(self.conflicts))
+
+  def publish(self, labeled, owned):
+    # The labeled records to sync: without the losers of conflicts, and with
+    # the owned records of refused domains kept as they are
+    if not self.rejected:
+      return labeled
+    return (labeled - self.rejected) | (self.held & owned)
+
+# Records declared by each running container, keyed by container id
+# (prefixed with the Docker source name when several DOCKER_URLs are set)
+containerRecords = {}
+# (priority, reapSeconds) of every labeled record, see collectOptions()
+labelOptions = {}
+domainIndex = DomainIndex()
+# Names of the Docker sources declaring each record, when several are set
+recordSources = {}
+# Parsed labels per container id, as (labelHash, parsed, created), see cachedLabels()
+labelCache = {}
+# Guards the record store while record changes are applied concurrently
+stateLock = threading.RLock()
+
+class Backoff:
+  # Exponential backoff with jitter over consecutive failures, starting at
+  # BACKOFF_BASE_SECONDS (the polling interval by default), capped at
+  # BACKOFF_MAX_SECONDS
+  def __init__(self):
+    self.failures = 0
+    self.until = 0
+
+  def failed(self, now):
+    self.failures += 1
+    base = backoffBaseSeconds or minIntervalSeconds or intervalSeconds
+    delay = min(backoffMaxSeconds, base * 2 ** (self.failures - 1))
+    delay = delay / 2 + random.uniform(0, delay / 2)
+    self.until = now + delay
+    return delay
+
+  def succeeded(self):
+    self.failures = 0
+    self.until = 0
+
+class TokenBucket:
+  # WRITE_RATE_PER_SECOND Pi-hole writes per second after a burst of
+  # WRITE_BURST. Tokens may go negative, each write then waits its turn.
+  def __init__(self):
+    self.tokens = None
+    self.updated = 0
+    self.lock = threading.Lock()
+
+  def reserve(self, now):
+    # Take a token, returns the seconds to wait before using it
+    if writeRatePerSecond <= 0:
+      return 0
+    with self.lock:
+      if self.tokens is None:
+        self.tokens = writeBurst
+      else:
+        self.tokens = min(writeBurst, self.tokens + (now - self.updated) * writeRatePerSecond)
+      self.updated = now
+      self.tokens -= 1
+      return 0 if self.tokens >= 0 else -self.tokens / writeRatePerSecond
+
+class MutationQueue:
+  # Record adds and removes from Docker events waiting to be written. An add
+  # and a remove of the same record within MUTATION_WINDOW_SECONDS cancel out,
+  # and everything queued is written together once the oldest change is
+  # MUTATION_WINDOW_SECONDS old.
+  def __init__(self):
+    # record -> ("add" or "remove", time queued)
+    self.pending = {}
+    self.lock = threading.Lock()
+
+  def __len__(self):
+    return len(self.pending)
+
+  def push(self, op, key, now):
+    # A change queued again keeps its original time
+    with self.lock:
+      self.pending.setdefault(key, (op, now))
+
+  def cancel(self, key, op):
+    # Drop a queued change the opposing change undoes, returns whether there was one
+    with self.lock:
+      if key in self.pending and self.pending[key][0] == op:
+        del self.pending[key]
+        return True
+      return False
+
+  def deadline(self):
+    # When the queued changes are due, None when nothing is queued
+    with self.lock:
+      if not self.pending:
+        return None
+      return min(at for op, at in self.pending.values()) + mutationWindowSeconds
+
+  def take(self):
+    with self.lock:
+      pending, self.pending = self.pending, {}
+    return pending
+
+class PiholeTarget:
+  # Connection and ownership state of one Pi-hole instance. A single
+  # configured Pi-hole is moduleTarget, several are listed in targets.
+  def __init__(self, name, api, token, statePath):
+    self.name = name
+    self.piholeAPI = api
+    self.token = token
+    self.statePath = statePath
+    self.sid = None
+    self.session = None
+    # Why the last Pi-hole call raised, None once a call got a response
+    self.apiError = None
+    # Seconds Pi-hole keeps an idle session, and when ours lapses, None until known
+    self.sessionValidity = None
+    self.sessionExpires = None
+    # Serialises logins when concurrent calls find the session expired
+    self.authLock = threading.Lock()
+    self.store = RecordStore()
+    # What the state file plus its journal hold on disk, None until known
+    self.persistedOwned = None
+    self.persistedLastSeen = {}
+    self.persistedLabeledAt = None
+    self.persistedGeneration = 0
+    self.journalEntries = 0
+    # Fingerprints and outcome of the last full reconcile, see reconcileIsFresh()
+    self.lastReconcile = None
+    # Pi-hole's records as of recordCacheAt, kept up to date by our own writes
+    self.recordCache = None
+    self.recordCacheAt = 0
+    # Labeled records Pi-hole has from elsewhere, left alone without ADOPT_UNMANAGED
+    self.unmanaged = set()
+    self.backoff = Backoff()
+    self.writeBucket = TokenBucket()
+    self.mutations = MutationQueue()
+    self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pihole-%s" %(name))
+    self.pending = None
+
+# The single configured Pi-hole
+moduleTarget = PiholeTarget("default", piholeAPI, token, statePath)
+currentTargetVar = contextvars.ContextVar("currentTarget", default=None)
+
+def currentTarget():
+  return currentTargetVar.get() or moduleTarget
+
+def runWithTarget(pihole, fn, *args, **kwargs):
+  reset = currentTargetVar.set(pihole)
+  try:
+    return fn(*args, **kwargs)
+  finally:
+    currentTargetVar.reset(reset)
+
+def buildTargets(apis, tokens, statePath):
+  # Several comma separated PIHOLE_API urls fan out to one target each, with
+  # either one shared token or one token per url and a state file per url.
+  apis = [api.strip() for api in apis.split(",") if api.strip()]
+  if len(apis) <= 1:
+    return []
+  tokenList = [tok.strip() for tok in tokens.split(",")]
+  if len(tokenList) != len(apis):
+    tokenList = [tokens] * len(apis)
+  targetList = []
+  for api, tok in zip(apis, tokenList):
+    name = endpointName(api)
+    targetList.append(PiholeTarget(name, api, tok, "%s.%s" %(statePath, name)))
+  return targetList
+
+targets = buildTargets(piholeAPI, token, statePath)
+
+def runForTargets(fn, *args, **kwargs):
+  # Run fn once per Pi-hole, concurrently when several are configured. A Pi-hole
+  # still busy with an earlier run is skipped and one that does not finish in
+  # TARGET_TIMEOUT_SECONDS is left running, so neither stalls the others.
+  if not targets:
+    return {moduleTarget.name: fn(*args, **kwargs)}
+  futures = {}
+  for pihole in targets:
+    if pihole.pending is not None and not pihole.pending.done():
+      logger.warning("Pi-hole %s is still busy, skipping it this round" %(pihole.name))
+      continue
+    pihole.pending = pihole.executor.submit(runWithTarget, pihole, fn, *args, **kwargs)
+    futures[pihole.name] = pihole.pending
+  wait(futures.values(), timeout=targetTimeoutSeconds)
+  results = {}
+  for name, future in futures.items():
+    if not future.done():
+      logger.warning("Pi-hole %s did not finish within %ss, continuing without it" %(name, targetTimeoutSeconds))
+      continue
+    try:
+      results[name] = future.result()
+    except Exception as ex:
+      logger.error("Pi-hole %s failed: %s" %(name, ex))
+  return results
 
 endpoints = {
     "createAuth": {
       "type": "post",
       "endpoint": "/auth",
-      "payloadExtractor": lambda payload: payload["session"]["sid"],
+      "payloadExtractor": lambda payload: payload["session"],
     },
     "getAuths": {
       "type": "get",
@@ -66,68 +761,224 @@ endpoints = {
       "type": "delete",
       "endpoint": "/config/dns/cnameRecords",
     },
+    "patchConfig": {
+      "type": "patch",
+      "endpoint": "/config",
+    },
+    "checkAuth": {
+      "type": "get",
+      "endpoint": "/auth",
+      "payloadExtractor": lambda payload: payload["session"],
+    },
 }
 
+hostnameLabel = re.compile(r"(?!-)[A-Za-z0-9_-]{1,63}(?<!-)")
+
+@functools.lru_cache(maxsize=65536)
+def validHostname(name):
+  # RFC 1123 labels (underscores allowed), at most 253 characters, and not all
+  # numeric at the end so short IPv4 forms such as "10.1" are not hostnames
+  labels = (name[:-1] if name.endswith(".") else name).split(".")
+  return len(name) <= 253 and all(hostnameLabel.fullmatch(label) for label in labels) and not labels[-1].isdigit()
+
+@functools.lru_cache(maxsize=65536)
+def recordKind(target):
+  # "A" or "AAAA" for an IP address, "CNAME" for a hostname, None when malformed.
+  # Memoized, so each target is classified once.
+  try:
+    return "A" if ipaddress.ip_address(target).version == 4 else "AAAA"
+  except ValueError:
+    return "CNAME" if validHostname(target) else None
+
+def isAddress(target):
+  # A and AAAA records both live in Pi-hole's hosts list
+  return recordKind(target) in ("A", "AAAA")
+
+def validRecord(entry):
+  # (domain, target) of a label entry, None when it is not a valid record
+  if not isinstance(entry, (list, tuple)) or len(entry) != 2 or not all(isinstance(item, str) for item in entry):
+    return None
+  domain, target = entry
+  if not validHostname(domain) or recordKind(target) is None:
+    return None
+  return (domain, target)
+
 def ipTest(ip):
-  is_ip = False
+  return isAddress(ip), ip
+
+def journalPath():
+  pihole = currentTarget()
+  return "%s.journal" %(pihole.statePath)
+
+def writeAtomic(path, data, mode=None):
+  # Write to a temp file and rename over the target, so a crash leaves either
+  # the old or the new state on disk and never a truncated file.
+  tmpPath = "%s.tmp" %(path)
+  fd = os.open(tmpPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666 if mode is None else mode)
+  if mode is not None:
+    os.fchmod(fd, mode)
+  with os.fdopen(fd, "w") as outfile:
+    outfile.write(data)
+    outfile.flush()
+    os.fsync(outfile.fileno())
+  os.replace(tmpPath, path)
   try:
-   socket.inet_aton(ip)
-   is_ip = True
-  except Exception as ex:
-    template = "An exception of type {0} occurred. Arguments:\n{1!r}"
-    message = template.format(type(ex).__name__, ex.args)
-    logger.debug(message)
+    dirFd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+      os.fsync(dirFd)
+    finally:
+      os.close(dirFd)
+  except OSError:
+    pass
+
+def applyJournalEntry(entry, pihole):
+  # Apply one journal entry to what is known to be on disk
+  op = entry[0]
+  if op == "labeled_at":
+    pihole.persistedLabeledAt = int(entry[1])
+    return
+  tup = (entry[1], entry[2])
+  if op == "own":
+    pihole.persistedOwned.add(tup)
+    if len(entry) > 3:
+      pihole.persistedLastSeen[tup] = int(entry[3])
+    else:
+      pihole.persistedLastSeen.pop(tup, None)
+  elif op == "seen":
+    pihole.persistedLastSeen[tup] = int(entry[3])
+  elif op == "labeled":
+    pihole.persistedLastSeen.pop(tup, None)
+  elif op == "drop":
+    pihole.persistedOwned.discard(tup)
+    pihole.persistedLastSeen.pop(tup, None)
 
-  return is_ip, ip
+def stateChanges(owned, lastSeen, labeledAt):
+  # Journal entries turning the persisted state into the current one, None when
+  # the persisted state is unknown. Only records that stopped being labeled can
+  # be reaped, so only they keep their own last_seen, which no longer moves. The
+  # labeled ones share labeled_at, written once it moved by the resolution.
+  pihole = currentTarget()
+  if pihole.persistedOwned is None:
+    return None
+  changes = []
+  if owned - set(lastSeen) and (pihole.persistedLabeledAt is None or labeledAt - pihole.persistedLabeledAt >= lastSeenResolution):
+    changes.append(["labeled_at", labeledAt])
+  for tup in sorted(owned - pihole.persistedOwned):
+    changes.append(["own", tup[0], tup[1], lastSeen[tup]] if tup in lastSeen else ["own", tup[0], tup[1]])
+  for tup in sorted(pihole.persistedOwned - owned):
+    changes.append(["drop", tup[0], tup[1]])
+  for tup in sorted(owned & pihole.persistedOwned):
+    seen = pihole.persistedLastSeen.get(tup)
+    if tup in lastSeen and seen != lastSeen[tup]:
+      changes.append(["seen", tup[0], tup[1], lastSeen[tup]])
+    elif tup not in lastSeen and seen is not None:
+      changes.append(["labeled", tup[0], tup[1]])
+  return changes
 
 def flushList():
-  # Persist state with ownership and last-seen timestamps
-  owned_list = list(globalList)
-  # Only persist last_seen for owned records to avoid bloat
-  last_seen_list = [[k[0], k[1], globalLastSeen.get(k, int(time.time()))] for k in owned_list]
+  # Persist state with ownership and last-seen timestamps, only when it changed
+  pihole = currentTarget()
+  now = int(time.time())
+  with stateLock:
+    owned = set(pihole.store.owned)
+    # Owned records scheduled for removal are the ones no longer labeled, the
+    # others were labeled as of now
+    lastSeen = {k: pihole.store.lastSeen(k, now) for k in owned & pihole.store.scheduled}
+  changes = stateChanges(owned, lastSeen, now)
+  if changes == []:
+    return False
+
+  if changes is not None and stateJournal and pihole.journalEntries + len(changes) <= stateCompactEntries:
+    lines = "".join("%s\n" %(json.dumps(change, separators=(",", ":"))) for change in changes)
+    if pihole.journalEntries == 0:
+      # A journal only applies on top of the snapshot generation it starts with
+      lines = "%s\n%s" %(json.dumps(["generation", pihole.persistedGeneration]), lines)
+    with open(journalPath(), "w" if pihole.journalEntries == 0 else "a") as outfile:
+      outfile.write(lines)
+      outfile.flush()
+      os.fsync(outfile.fileno())
+    for change in changes:
+      applyJournalEntry(change, pihole)
+    pihole.journalEntries += len(changes)
+    logger.debug("Appended %s state changes to journal" %(len(changes)))
+    return True
+
+  generation = pihole.persistedGeneration + 1
   jsonObject = json.dumps({
-    "owned": owned_list,
-    "last_seen": last_seen_list,
+    "owned": sorted(owned),
+    "last_seen": [[k[0], k[1], lastSeen[k]] for k in sorted(lastSeen)],
+    "labeled_at": now,
+    "generation": generation,
     "version": 2
-  }, indent=2)
-  with open(statePath, "w") as outfile:
-    outfile.write(jsonObject)
+  }, separators=(",", ":"))
+  writeAtomic(pihole.statePath, jsonObject)
+  if os.path.exists(journalPath()):
+    os.remove(journalPath())
+  pihole.persistedOwned = owned
+  pihole.persistedLastSeen = lastSeen
+  pihole.persistedLabeledAt = now
+  pihole.persistedGeneration = generation
+  pihole.journalEntries = 0
+  logger.debug("Wrote state snapshot with %s records" %(len(owned)))
+  return True
+
+def replayJournal(generation):
+  # Re-apply journal entries written after the snapshot, ignoring a torn last line
+  pihole = currentTarget()
+  path = journalPath()
+  if not os.path.exists(path):
+    return
+  with open(path, "r") as openfile:
+    lines = openfile.read().splitlines()
+  if not lines or json.loads(lines[0]) != ["generation", generation]:
+    logger.warning("Ignoring state journal of another snapshot generation")
+    return
+  replayed = 0
+  for line in lines[1:]:
+    try:
+      entry = json.loads(line)
+    except ValueError:
+      logger.warning("Ignoring torn state journal entry: %s" %(line))
+      break
+    applyJournalEntry(entry, pihole)
+    replayed += 1
+  pihole.journalEntries = replayed
+  logger.info("Replayed %s state journal entries" %(replayed))
 
 def readState():
-  fileExists = os.path.exists(statePath)
+  pihole = currentTarget()
+  fileExists = os.path.exists(pihole.statePath)
   if fileExists:
     logger.info("Loading existing state...")
     try:
-      with open(statePath, 'r') as openfile:
+      with open(pihole.statePath, 'r') as openfile:
         rawState = json.load(openfile)
         # Backward compatibility: legacy format was a list of pairs
         if isinstance(rawState, list):
           for obj in rawState:
             logger.info("From file (%s): %s" %(type(obj), obj))
-            tup = tuple(obj)
-            globalList.add(tup)
             # Initialize last seen to now for legacy state
-            globalLastSeen[tup] = int(time.time())
+            pihole.store.own(tuple(obj), int(time.time()))
         elif isinstance(rawState, dict):
           version = int(rawState.get("version", 1))
           if version == 2:
             owned = rawState.get("owned", [])
             last_seen = rawState.get("last_seen", [])
-            for obj in owned:
-              tup = tuple(obj)
-              globalList.add(tup)
-            for entry in last_seen:
-              if len(entry) >= 3:
-                tup = (entry[0], entry[1])
-                globalLastSeen[tup] = int(entry[2])
+            # Remember what is on disk so unchanged state is not rewritten
+            pihole.persistedOwned = set(tuple(obj) for obj in owned)
+            pihole.persistedLastSeen = dict(((entry[0], entry[1]), int(entry[2])) for entry in last_seen if len(entry) >= 3)
+            pihole.persistedLabeledAt = rawState.get("labeled_at")
+            pihole.persistedGeneration = int(rawState.get("generation", 0))
+            replayJournal(pihole.persistedGeneration)
+            # Records without a last_seen of their own were labeled as of labeled_at
+            for tup in pihole.persistedOwned:
+              pihole.store.own(tup, pihole.persistedLastSeen.get(tup, pihole.persistedLabeledAt))
           elif version == 1:
             # v1 dict (unexpected) or legacy: try to parse like legacy list
             owned = rawState.get("owned", [])
             if owned:
               for obj in owned:
-                tup = tuple(obj)
-                globalList.add(tup)
-                globalLastSeen[tup] = int(time.time())
+                pihole.store.own(tuple(obj), int(time.time()))
             else:
               logger.warning("v1 state without 'owned' key, starting fresh")
           else:
@@ -135,12 +986,10 @@ def readState():
             owned = rawState.get("owned", [])
             last_seen = rawState.get("last_seen", [])
             for obj in owned:
-              tup = tuple(obj)
-              globalList.add(tup)
+              pihole.store.own(tuple(obj))
             for entry in last_seen:
               if len(entry) >= 3:
-                tup = (entry[0], entry[1])
-                globalLastSeen[tup] = int(entry[2])
+                pihole.store.seen((entry[0], entry[1]), int(entry[2]))
         else:
           logger.warning("Unknown state format, starting fresh")
     except Exception as ex:
@@ -149,36 +998,88 @@ def readState():
     logger.info("Loading skipped, no db found.")
 
 def printState():
+  pihole = currentTarget()
   logger.debug("State")
   logger.debug("-----------")
-  for obj in globalList:
+  for obj in pihole.store:
     logger.debug(obj)
   logger.debug("-----------")
 
-sid = None
+def getSession():
+  # One pooled keep-alive session per Pi-hole for all its calls, so a reconcile pushing
+  # many records reuses connections instead of opening one per record.
+  pihole = currentTarget()
+  if pihole.session is None:
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    retry = Retry(
+      total=httpRetries,
+      backoff_factor=httpBackoffSeconds,
+      status_forcelist=(502, 503, 504),
+      # Only calls that can be repeated safely. A retried create or delete that
+      # Pi-hole already applied answers "Item already present" or not found.
+      allowed_methods=frozenset(["GET", "PATCH"]),
+      raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=httpPoolSize, pool_maxsize=httpPoolSize, max_retries=retry)
+    pihole.session = requests.Session()
+    pihole.session.mount("http://", adapter)
+    pihole.session.mount("https://", adapter)
+    pihole.session.headers.update({
+      "User-Agent": "docker-pihole-dns-shim",
+      "Connection": "keep-alive",
+    })
+  return pihole.session
 
-def apiCall(endpointKey, payload=None):
+class SessionRejected(Exception):
+  # Pi-hole answered 401/403 to a call made with our session
+  def __init__(self, response):
+    super().__init__(response)
+    self.response = response
+
+def apiRequest(endpointKey, payload=None):
+  pihole = currentTarget()
   endpointDict = endpoints[endpointKey]
   payloadExtractor = endpointDict.get("payloadExtractor", lambda x: x)
   http_method = endpointDict["type"]
-  endpoint = "%s%s" %(piholeAPI, endpointDict["endpoint"])
+  endpoint = "%s%s" %(pihole.piholeAPI, endpointDict["endpoint"])
   headers = {
-    "sid": sid,
-    "User-Agent": "docker-pihole-dns-shim",
+    "sid": pihole.sid,
   }
-  if http_method == "get":
-    response = requests.get(endpoint, params=payload, headers=headers)
-  elif http_method == "post":
-    response = requests.post(endpoint, json=payload, headers=headers)
-  elif http_method == "delete":
-    response = requests.delete("%s/%s" %(endpoint, payload), headers=headers)
-  elif http_method == "put":
-    response = requests.put("%s/%s" %(endpoint, payload), headers=headers)
+  http = getSession()
+  started = time.perf_counter()
+  try:
+    if http_method == "get":
+      response = http.get(endpoint, params=payload, headers=headers, timeout=httpTimeoutSeconds)
+    elif http_method == "post":
+      response = http.post(endpoint, json=payload, headers=headers, timeout=httpTimeoutSeconds)
+    elif http_method == "delete":
+      response = http.delete("%s/%s" %(endpoint, payload), headers=headers, timeout=httpTimeoutSeconds)
+    elif http_method == "put":
+      response = http.put("%s/%s" %(endpoint, payload), headers=headers, timeout=httpTimeoutSeconds)
+    elif http_method == "patch":
+      response = http.patch(endpoint, json=payload, headers=headers, timeout=httpTimeoutSeconds)
+  except Exception as ex:
+    metrics.inc("pihole_shim_api_responses_total", endpoint=endpointKey, code="error", target=pihole.name)
+    pihole.apiError = str(ex)
+    raise
+  finally:
+    metrics.observe("pihole_shim_api_request_duration_seconds", time.perf_counter() - started, endpoint=endpointKey, target=pihole.name)
+    beat()
+  pihole.apiError = None
+  metrics.inc("pihole_shim_api_responses_total", endpoint=endpointKey, code=str(response.status_code), target=pihole.name)
 
   logger.debug("Response code: %s" %(response.status_code))
 
   extractedResponse = None
 
+  if response.status_code in (401, 403) and endpointKey not in authEndpoints:
+    raise SessionRejected(response.json())
+  if pihole.sessionValidity is not None and endpointKey not in authEndpoints:
+    # Every authenticated call restarts Pi-hole's session validity window
+    pihole.sessionExpires = time.time() + pihole.sessionValidity
+
   if response.status_code == 200:
     success = True
     extractedResponse = payloadExtractor(response.json())
@@ -191,14 +1092,141 @@ def apiCall(endpointKey, payload=None):
 
   return(success, extractedResponse)
 
-def auth():
+authEndpoints = ("createAuth", "checkAuth")
+# Calls that make Pi-hole rewrite its config, paced by WRITE_RATE_PER_SECOND
+writeEndpoints = ("createDns", "deleteDns", "createCname", "deleteCname", "patchConfig")
+
+def apiCall(endpointKey, payload=None):
+  # Refresh a session about to lapse before using it, and log in again and retry
+  # once when Pi-hole rejects it anyway (e.g. after a Pi-hole restart).
+  pihole = currentTarget()
+  if endpointKey in authEndpoints:
+    return apiRequest(endpointKey, payload)
+  if endpointKey in writeEndpoints:
+    throttle()
+  if pihole.sessionExpires is not None and pihole.sessionExpires - time.time() < sessionRefreshSeconds:
+    refreshSession(pihole.sid)
+  sid = pihole.sid
+  try:
+    return apiRequest(endpointKey, payload)
+  except SessionRejected as rejected:
+    logger.warning("Pi-hole rejected the session on %s, logging in again" %(endpointKey))
+    if not reauthenticate(sid, "rejected"):
+      return(False, rejected.response)
+  try:
+    return apiRequest(endpointKey, payload)
+  except SessionRejected as rejected:
+    return(False, rejected.response)
+
+def throttle():
+  # Wait for the Pi-hole's write rate limit
+  pihole = currentTarget()
+  delay = pihole.writeBucket.reserve(time.monotonic())
+  if delay > 0:
+    metrics.inc("pihole_shim_writes_throttled_total", target=pihole.name)
+    metrics.inc("pihole_shim_write_throttle_seconds_total", delay, target=pihole.name)
+    logger.debug("Write rate limit reached, waiting %.2fs" %(delay))
+    time.sleep(delay)
+
+def reauthenticate(staleSid, reason):
+  # Log in unless another thread already replaced the stale session
+  pihole = currentTarget()
+  with pihole.authLock:
+    if pihole.sid != staleSid and pihole.sid is not None:
+      return True
+    return login(reason) is not None
+
+def refreshSession(staleSid):
+  # Touching the session restarts its validity window, log in when that fails
+  pihole = currentTarget()
+  with pihole.authLock:
+    if pihole.sid != staleSid:
+      return pihole.sid is not None
+    success, result = apiRequest("checkAuth")
+    if success and result.get("valid"):
+      pihole.sessionExpires = time.time() + result.get("validity", pihole.sessionValidity or 0)
+      return True
+    return login("expiring") is not None
+
+def sessionPath():
+  return "%s.session" %(currentTarget().statePath)
+
+def saveSession():
+  # Keep the session id next to the state, readable by us only
+  pihole = currentTarget()
+  if not sessionPersist:
+    return
+  try:
+    writeAtomic(sessionPath(), json.dumps({"api": pihole.piholeAPI, "sid": pihole.sid, "validity": pihole.sessionValidity}), mode=0o600)
+  except OSError as ex:
+    logger.warning("Failed to persist Pi-hole session: %s" %(ex))
+
+def restoreSession():
+  # Reuse the session of an earlier run if Pi-hole still accepts it, saving a
+  # login and the cleanup of the session it would leave behind
+  pihole = currentTarget()
+  if not sessionPersist or not os.path.exists(sessionPath()):
+    return False
+  try:
+    with open(sessionPath(), "r") as openfile:
+      saved = json.load(openfile)
+  except (OSError, ValueError) as ex:
+    logger.warning("Ignoring unreadable Pi-hole session file: %s" %(ex))
+    return False
+  if saved.get("api") != pihole.piholeAPI or not saved.get("sid"):
+    return False
+  pihole.sid = saved["sid"]
+  try:
+    success, result = apiRequest("checkAuth")
+  except Exception as ex:
+    logger.warning("Failed to validate persisted Pi-hole session: %s" %(ex))
+    success, result = False, None
+  if not success or not result.get("valid"):
+    logger.info("Persisted Pi-hole session is no longer valid")
+    pihole.sid = None
+    return False
+  pihole.sessionValidity = saved.get("validity") or result.get("validity")
+  pihole.sessionExpires = time.time() + result.get("validity", 0)
+  metrics.inc("pihole_shim_logins_total", reason="reused", target=pihole.name)
+  logger.info("Reusing persisted Pi-hole session")
+  return True
+
+def login(reason="startup"):
+  pihole = currentTarget()
   logger.debug("Authenticating with pihole API...")
-  success, response = apiCall("createAuth", payload={"password": token})
+  success, response = apiCall("createAuth", payload={"password": pihole.token})
   if not success:
     logger.error("Authentication failed: %s" %(response))
-    sys.exit(1)
+    return None
+  pihole.sid = response["sid"]
+  pihole.sessionValidity = response.get("validity")
+  pihole.sessionExpires = None if pihole.sessionValidity is None else time.time() + pihole.sessionValidity
+  metrics.inc("pihole_shim_logins_total", reason=reason, target=pihole.name)
+  saveSession()
   logger.debug("done")
-  return response
+  return pihole.sid
+
+def auth():
+  sid = login()
+  if sid is None:
+    sys.exit(1)
+  return sid
+
+def startSession():
+  # Reuse or log in, returns whether a new session was created and sessions of
+  # earlier runs may need cleaning up
+  pihole = currentTarget()
+  if restoreSession():
+    return False
+  # A single Pi-hole that rejects the token is fatal, one of several is retried
+  pihole.sid = auth() if pihole is moduleTarget else login()
+  return pihole.sid is not None
+
+def connect(cleanup=True):
+  # Reuse or log in and tidy up sessions of earlier runs, for Pi-holes of a fan-out
+  if startSession() and cleanup:
+    cleanSessions()
+  return currentTarget().sid is not None
 
 def cleanSessions():
   logger.debug("Removing old sessions...")
@@ -228,144 +1256,1212 @@ def listExisting():
   logger.debug("done")
   return({"dns": dns, "cname": cname})
 
+def fetchExisting(now):
+  # Pi-hole's records, served from the cache while it is younger than
+  # RECORD_CACHE_SECONDS. Our own writes keep the cache current, so only
+  # changes made outside the shim wait for the next refresh.
+  pihole = currentTarget()
+  if recordCacheSeconds <= 0:
+    return listExisting()
+  if pihole.recordCache is not None and now - pihole.recordCacheAt < recordCacheSeconds:
+    metrics.inc("pihole_shim_record_cache_lookups_total", result="hit", target=pihole.name)
+    logger.debug("Using Pi-hole records cached %ss ago" %(now - pihole.recordCacheAt))
+    return pihole.recordCache
+  metrics.inc("pihole_shim_record_cache_lookups_total", result="miss", target=pihole.name)
+  existingRecords = listExisting()
+  with stateLock:
+    pihole.recordCache = existingRecords
+    pihole.recordCacheAt = now
+  return existingRecords
+
+def updateRecordCache(obj, present):
+  # Mirror a write Pi-hole accepted in the cached records
+  pihole = currentTarget()
+  with stateLock:
+    if pihole.recordCache is None:
+      return
+    records = pihole.recordCache["dns" if isAddress(obj[1]) else "cname"]
+    if present:
+      records.add(obj)
+    else:
+      records.discard(obj)
+
+def invalidateRecordCache(reason):
+  pihole = currentTarget()
+  with stateLock:
+    if pihole.recordCache is not None:
+      logger.info("Dropping cached Pi-hole records: %s" %(reason))
+      pihole.recordCache = None
+
 def addObject(obj, existingRecords):
-  domain = False
+  # True once the shim owns the record, False when Pi-hole did not take it and
+  # None when Pi-hole already had it from elsewhere and it is left unmanaged
+  pihole = currentTarget()
   logger.info("Adding: " + str(obj))
-  domain = obj[0]
-  is_ip, target = ipTest(obj[1])
-  logger.debug("domain (%s): %s" %(type(domain), domain))
-  logger.debug("target (%s): %s" %(type(target), target))
-  logger.debug("is_ip: %s" %(str(is_ip)))
+  domain, target = obj
+  is_ip = isAddress(target)
+  logger.debug("%s record %s -> %s" %(recordKind(target), domain, target))
 
-  if is_ip:
-    if obj in existingRecords["dns"]:
-      success = True
-    else:
-      success, result = apiCall("createDns", payload="%s %s" %(target, domain))
+  called = False
+  if obj in existingRecords["dns" if is_ip else "cname"]:
+    success = True
   else:
-    if obj in existingRecords["cname"]:
-      success = True
-    else:
-      success, result = apiCall("createCname", payload="%s,%s" %(domain,target))
+    called = True
+    try:
+      if is_ip:
+        success, result = apiCall("createDns", payload="%s %s" %(target, domain))
+      else:
+        success, result = apiCall("createCname", payload="%s,%s" %(domain,target))
+    except Exception:
+      # Pi-hole may have applied the create before the answer was lost. Owning
+      # it keeps it from looking unmanaged next sync, which re-adds it if missing.
+      with stateLock:
+        pihole.store.own(obj, int(time.time()))
+      invalidateRecordCache("adding %s failed" %(str(obj)))
+      raise
+
+  if called and success:
+    updateRecordCache(obj, True)
+  elif called and ("error" in result and "message" in result["error"] and result["error"]["message"] == "Item already present"):
+    # Pi-hole has a record the cache did not know about
+    invalidateRecordCache("%s already present" %(str(obj)))
+  elif called:
+    invalidateRecordCache("adding %s failed" %(str(obj)))
 
   if success or ("error" in result and "message" in result["error"] and result["error"]["message"] == "Item already present"):
-    globalList.add(obj)
-    globalLastSeen[obj] = int(time.time())
+    if (not called or not success) and obj not in pihole.store:
+      # Pi-hole had it before the shim added it
+      if not adoptUnmanaged:
+        logger.warning("%s is already in Pi-hole but was not added by the shim, leaving it unmanaged" %(str(obj)))
+        with stateLock:
+          pihole.unmanaged.add(obj)
+        metrics.set("pihole_shim_unmanaged_records", len(pihole.unmanaged), target=pihole.name)
+        return None
+      metrics.inc("pihole_shim_records_adopted_total", target=pihole.name)
+      logger.info("Adopting %s, which was already in Pi-hole" %(str(obj)))
+    with stateLock:
+      pihole.store.own(obj, int(time.time()))
     logger.info("Added to global list after success: %s" %(str(obj)))
+    return True
   else:
     logger.error("Failed to add to list: %s" %(str(result)))
+    return False
 
 def removeObject(obj, existingRecords):
+  pihole = currentTarget()
   logger.info("Removing: " + str(obj))
-  domain = obj[0]
-  is_ip, target = ipTest(obj[1])
-  logger.debug("domain (%s): %s" %(type(domain), domain))
-  logger.debug("target (%s): %s" %(type(target), target))
-  logger.debug("is_ip: %s" %(str(is_ip)))
+  domain, target = obj
+  is_ip = isAddress(target)
+  logger.debug("%s record %s -> %s" %(recordKind(target), domain, target))
+  called = False
   if is_ip:
     if obj not in existingRecords["dns"]:
       success = True
     else:
+      called = True
       success, result = apiCall("deleteDns",payload="%s %s" %(target, domain))
   else:
     if obj not in existingRecords["cname"]:
       success = True
     else:
+      called = True
       success, result = apiCall("deleteCname",payload="%s,%s" %(domain, target))
 
+  if called and success:
+    updateRecordCache(obj, False)
+  elif called:
+    # e.g. a 404 for a record the cache still listed
+    invalidateRecordCache("removing %s failed" %(str(obj)))
+
   if success:
-    globalList.remove(obj)
+    with stateLock:
+      pihole.store.disown(obj)
     logger.info("Removed from global list after success: %s" %(str(obj)))
+    return True
   else:
     logger.error("Failed to remove from list: %s" %(str(result)))
+    return False
 
-def handleList(newGlobalList, existingRecords, *, allow_remove=True):
+def applyBatch(toAdd, toRemove, existingRecords):
+  # Replace the hosts/cnameRecords arrays in one PATCH /config, so Pi-hole
+  # rewrites its config and reloads once instead of once per record. Cached
+  # records may miss ones added in Pi-hole since, which the PATCH would
+  # delete, so the arrays are built from a fresh listing then.
+  if recordCacheSeconds > 0:
+    existingRecords = listExisting()
+  hosts = set(existingRecords["dns"])
+  cnames = set(existingRecords["cname"])
+  for obj in toAdd:
+    (hosts if isAddress(obj[1]) else cnames).add(obj)
+  for obj in toRemove:
+    hosts.discard(obj)
+    cnames.discard(obj)
+
+  dnsConfig = {}
+  if hosts != existingRecords["dns"]:
+    dnsConfig["hosts"] = sorted("%s %s" %(target, domain) for domain, target in hosts)
+  if cnames != existingRecords["cname"]:
+    dnsConfig["cnameRecords"] = sorted("%s,%s" %(domain, target) for domain, target in cnames)
+  if not dnsConfig:
+    return True
+
+  logger.debug("Patching config: %s" %(dnsConfig))
+  success, result = apiCall("patchConfig", payload={"config": {"dns": dnsConfig}})
+  if not success:
+    logger.warning("Batch update failed, falling back to per-record calls: %s" %(result))
+    invalidateRecordCache("batch update failed")
+  else:
+    pihole = currentTarget()
+    with stateLock:
+      if recordCacheSeconds > 0:
+        pihole.recordCache = {"dns": hosts, "cname": cnames}
+        pihole.recordCacheAt = int(time.time())
+  return success
+
+def applyAll(action, items, existingRecords):
+  # Apply action to every item with at most applyConcurrency calls in flight,
+  # results come back in sorted item order regardless of completion order.
+  ordered = sorted(items)
+  if applyConcurrency <= 1 or len(ordered) <= 1:
+    return [(item, action(item, existingRecords)) for item in ordered]
+  pihole = currentTarget()
+  with ThreadPoolExecutor(max_workers=min(applyConcurrency, len(ordered)), thread_name_prefix="apply") as executor:
+    results = list(executor.map(lambda item: runWithTarget(pihole, action, item, existingRecords), ordered))
+  return list(zip(ordered, results))
+
+def logResults(phase, results):
+  if not results:
+    return
+  failed = [item for item, ok in results if ok is False]
+  unmanaged = sum(1 for item, ok in results if ok is None)
+  logger.info("%s: %s applied, %s failed%s" %(phase, len(results) - len(failed) - unmanaged, len(failed), ", %s left unmanaged" %(unmanaged) if unmanaged else ""))
+  for item in failed:
+    logger.info("%s failed for %s" %(phase, str(item)))
+
+def limitReaps(due, now):
+  # Spread a mass reap (e.g. every container gone after a Docker daemon restart):
+  # REAP_BURST due records are removed now, the rest are put back on the reap
+  # heap in chunks of REAP_BURST at REAP_RATE_PER_SECOND. Call with stateLock held.
+  pihole = currentTarget()
+  if reapRatePerSecond <= 0 or len(due) <= reapBurst:
+    return due
+  ordered = sorted(due)
+  later = ordered[reapBurst:]
+  for index, key in enumerate(later):
+    pihole.store.schedule(key, now + (index // reapBurst + 1) * reapBurst / reapRatePerSecond)
+  metrics.inc("pihole_shim_reaps_rate_limited_total", len(later), target=pihole.name)
+  logger.warning("%s records due for removal, removing %s now and the rest at %s/s" %(len(ordered), reapBurst, reapRatePerSecond))
+  return set(ordered[:reapBurst])
+
+def planList(newGlobalList, existingRecords, *, allow_remove=True):
+  # Decide what a sync does: the records to add, remove (or only suppress with
+  # --no-remove) and re-sync, and the removals still deferred. Schedules reaps
+  # in the record store but makes no API calls and writes no state.
+  pihole = currentTarget()
+  store = pihole.store
   now = int(time.time())
-  toAdd = set([x for x in newGlobalList if x not in globalList])
-
-  # Candidates for removal are owned but not currently labeled
-  removalCandidates = set([x for x in globalList if x not in newGlobalList])
-  toRemove = set()
-  for candidate in removalCandidates:
-    last_seen = globalLastSeen.get(candidate)
-    if last_seen is None:
-      # If unknown, initialize now to avoid immediate removal
-      globalLastSeen[candidate] = now
-      last_seen = now
-    age = now - last_seen
-    if age >= reapSeconds:
-      toRemove.add(candidate)
-    else:
-      remaining = reapSeconds - age
-      logger.info("Deferring removal for %s, reaping in ~%ss" %(str(candidate), remaining))
+  with stateLock:
+    store.prune(newGlobalList)
+  toAdd = set(newGlobalList) - store.owned
+  # Records Pi-hole has that the shim did not add are only taken over with ADOPT_UNMANAGED
+  unmanaged = set() if adoptUnmanaged else {tup for tup in toAdd if tup in existingRecords["dns"] or tup in existingRecords["cname"]}
+  toAdd -= unmanaged
 
-  logger.debug("These are labels to add: %s" %(toAdd))
-  for add in toAdd:
-    addObject(add, existingRecords)
+  with stateLock:
+    # Owned records labeled again are no longer up for removal
+    for relabeled in store.scheduled & newGlobalList:
+      store.unschedule(relabeled)
+    # Owned records that stopped being labeled get a reap deadline, once
+    for candidate in sorted(store.owned - store.scheduled - newGlobalList):
+      last_seen = store.lastSeen(candidate)
+      if last_seen is None:
+        # If unknown, initialize now to avoid immediate removal
+        store.seen(candidate, now)
+        last_seen = now
+      if candidate in domainIndex.rejected:
+        # Still labeled, but it lost a conflict on its domain
+        store.schedule(candidate, now)
+        logger.info("Removing %s, another container's records won its domain" %(str(candidate)))
+        continue
+      deadline = last_seen + store.reapDelay(candidate)
+      store.schedule(candidate, deadline)
+      logger.info("Deferring removal for %s, reaping in ~%ss" %(str(candidate), max(0, deadline - now)))
+    toRemove = limitReaps(set(store.due(now)), now)
+    reapAt = store.nextDeadline()
+    deferred = store.scheduled - toRemove
+
+  toSync = store.owned.difference(existingRecords["dns"], existingRecords["cname"]) - toAdd - toRemove
 
+  logger.debug("These are labels to add: %s" %(toAdd))
   logger.debug("These are labels to remove (after reap window): %s" %(toRemove))
-  if not allow_remove:
-    if len(toRemove) > 0:
-      logger.debug("Suppressed removal (--no-remove): eligible=%s" %(sorted(list(toRemove))))
+  logger.debug("These are labels to sync: %s" %(toSync))
+  if not allow_remove and len(toRemove) > 0:
+    logger.debug("Suppressed removal (--no-remove): eligible=%s" %(sorted(list(toRemove))))
+  return {
+    "now": now,
+    "add": toAdd,
+    "remove": toRemove if allow_remove else set(),
+    "suppressed": set() if allow_remove else toRemove,
+    "sync": toSync,
+    "deferred": deferred,
+    "unmanaged": unmanaged,
+    "reapAt": reapAt,
+  }
+
+def describePlan(plan, existingRecords):
+  # JSON-ready plan with counts and the API calls applying it would take
+  pihole = currentTarget()
+  changes = plan["add"] or plan["remove"] or plan["sync"]
+  if batchApply:
+    writes = 1 if changes else 0
   else:
-    for remove in toRemove:
-      removeObject(remove, existingRecords)
-      # After removal, forget last seen as well
-      if remove in globalLastSeen:
-        del globalLastSeen[remove]
+    # addObject/removeObject skip records Pi-hole already has, or lacks
+    writes = (
+      sum(1 for obj in plan["add"] if obj not in existingRecords["dns"] and obj not in existingRecords["cname"])
+      + sum(1 for obj in plan["remove"] if obj in existingRecords["dns"] or obj in existingRecords["cname"])
+      + len(plan["sync"])
+    )
+  rows = lambda records: [list(record) for record in sorted(records)]
+  return {
+    "target": pihole.name,
+    "add": rows(plan["add"]),
+    "remove": rows(plan["remove"]),
+    "suppressed": rows(plan["suppressed"]),
+    "sync": rows(plan["sync"]),
+    "defer": [{"record": list(record), "reapAt": pihole.store.reapAt(record)} for record in sorted(plan["deferred"])],
+    "unmanaged": rows(plan["unmanaged"]),
+    "counts": dict(((key, len(plan[key])) for key in ("add", "remove", "suppressed", "sync", "deferred")), owned=len(pihole.store)),
+    # Every sync lists hosts and CNAME records, unless RECORD_CACHE_SECONDS serves them
+    "apiCalls": {"reads": 2, "writes": writes},
+  }
 
-  toSync = set([x for x in globalList if ((x not in existingRecords["dns"]) and (x not in existingRecords["cname"]))]) - toAdd - toRemove
-  logger.debug("These are labels to sync: %s" %(toSync))
-  for sync in toSync:
-    addObject(sync, existingRecords)
+def handleList(newGlobalList, existingRecords, *, allow_remove=True):
+  return applyPlan(planList(newGlobalList, existingRecords, allow_remove=allow_remove), existingRecords)
+
+def applyPlan(plan, existingRecords):
+  pihole = currentTarget()
+  store = pihole.store
+  now = plan["now"]
+  toAdd, applyRemove, toSync = plan["add"], plan["remove"], plan["sync"]
+
+  summary = {
+    "added": 0, "removed": 0, "synced": 0, "failed": 0,
+    "deferred": len(plan["deferred"]),
+    "reapAt": plan["reapAt"],
+  }
+  if batchApply and (toAdd or toSync or applyRemove) and applyBatch(toAdd | toSync, applyRemove, existingRecords):
+    with stateLock:
+      for add in toAdd | toSync:
+        store.own(add, now)
+      for remove in applyRemove:
+        store.disown(remove)
+    summary.update(added=len(toAdd), removed=len(applyRemove), synced=len(toSync))
+    logger.info("Batch applied: %s added, %s removed, %s synced" %(len(toAdd), len(applyRemove), len(toSync)))
+  else:
+    for phase, key, results in (
+      ("Add", "added", applyAll(addObject, toAdd, existingRecords)),
+      ("Remove", "removed", applyAll(removeObject, applyRemove, existingRecords)),
+      ("Sync", "synced", applyAll(addObject, toSync, existingRecords)),
+    ):
+      logResults(phase, results)
+      failed = sum(1 for item, ok in results if ok is False)
+      summary[key] = sum(1 for item, ok in results if ok is True)
+      summary["failed"] += failed
+    with stateLock:
+      for remove in applyRemove:
+        if remove in store:
+          # Removal failed, retry on the next cycle
+          store.schedule(remove, now)
+
+  newlyUnmanaged = plan["unmanaged"] - pihole.unmanaged
+  for tup in sorted(newlyUnmanaged):
+    logger.warning("%s is already in Pi-hole but was not added by the shim, leaving it unmanaged" %(str(tup)))
+  pihole.unmanaged = set(plan["unmanaged"])
+  metrics.set("pihole_shim_unmanaged_records", len(pihole.unmanaged), target=pihole.name)
 
   printState()
   flushList()
+  return summary
 
-def sync_once(*, allow_remove=True):
-  logger.info("Running sync")
+class LabelParse:
+  # Records and options read from the labels of one container. Shared between
+  # containers with the same labels, so never modified once parsed.
+  __slots__ = ("records", "priority", "reapSeconds", "errors")
+
+  def __init__(self):
+    self.records = frozenset()
+    self.priority = 0
+    self.reapSeconds = None
+    self.errors = []
+
+# <prefix>.record.<n>.domain / .target pairs and Traefik router rules
+recordLabel = re.compile(r"%s\.record\.([^.]+)\.(domain|target)$" %(re.escape(labelPrefix)))
+traefikRule = re.compile(r"traefik\.http\.routers\.[^.]+\.rule$")
+hostMatcher = re.compile(r"(?<![A-Za-z])Host\(([^)]*)\)")
+quotedHost = re.compile(r"[`\"']([^`\"']+)[`\"']")
+
+def labelRelevant(key):
+  return key == labelKey or key.startswith(labelPrefix + ".") or ("traefik" in labelSources and traefikRule.match(key) is not None)
+
+def labelFilters():
+  # The daemon filters containers on the JSON label key, the other sources
+  # can be on any container
+  return {"label": labelKey} if labelSources == {"json"} else {}
+
+def relevantLabels(labels):
+  return tuple(sorted((key, value) for key, value in (labels or {}).items() if labelRelevant(key)))
+
+@functools.lru_cache(maxsize=4096)
+def parseLabelItems(items):
+  # Parse the relevant labels of a container, cached by their contents. A
+  # malformed label or record is reported in errors and contributes nothing,
+  # the rest of the labels still count.
+  parsed = LabelParse()
+  labels = dict(items)
+  entries = []
+  if "json" in labelSources and labels.get(labelKey):
+    try:
+      value = json.loads(labels[labelKey])
+      if not isinstance(value, list):
+        raise ValueError("expected a list of [domain, target] pairs")
+      entries.extend((labelKey, entry) for entry in value)
+    except ValueError as ex:
+      parsed.errors.append("%s: %s" %(labelKey, ex))
+  if "records" in labelSources:
+    numbered = {}
+    for key, value in items:
+      match = recordLabel.match(key)
+      if match:
+        numbered.setdefault(match.group(1), {})[match.group(2)] = value
+    for n, fields in sorted(numbered.items()):
+      entries.append(("%s.record.%s" %(labelPrefix, n), [fields.get("domain"), fields.get("target")]))
+  if "traefik" in labelSources:
+    target = labels.get("%s.target" %(labelPrefix)) or traefikTarget
+    for key, value in items:
+      if not traefikRule.match(key):
+        continue
+      hosts = [host for args in hostMatcher.findall(value) for host in quotedHost.findall(args)]
+      if hosts and not target:
+        parsed.errors.append("%s: no %s.target label or TRAEFIK_TARGET for %s" %(key, labelPrefix, ", ".join(hosts)))
+        continue
+      entries.extend((key, [host, target]) for host in hosts)
+  records = set()
+  for source, entry in entries:
+    record = validRecord(entry)
+    if record is None:
+      parsed.errors.append("%s: malformed record %s" %(source, entry))
+      continue
+    records.add(record)
+  parsed.records = frozenset(records)
+  for option, attribute in (("priority", "priority"), ("reap-seconds", "reapSeconds")):
+    key = "%s.%s" %(labelPrefix, option)
+    if key in labels:
+      try:
+        setattr(parsed, attribute, int(labels[key]))
+      except ValueError:
+        parsed.errors.append("%s: not a number: %s" %(key, labels[key]))
+  return parsed
+
+def parseLabels(labels):
+  return parseLabelItems(relevantLabels(labels))
+
+def parseRecords(labels):
+  parsed = parseLabels(labels)
+  for error in parsed.errors:
+    logger.warning("Ignoring malformed label %s" %(error))
+  return set(parsed.records)
+
+def reconcileIsFresh(fingerprint, now):
+  # True when neither the labels nor the owned records changed since the last
+  # clean reconcile, no reap is due and the Pi-hole view is not too old.
+  pihole = currentTarget()
+  if maxStaleSeconds <= 0 or pihole.lastReconcile is None:
+    return False
+  if pihole.lastReconcile["fingerprint"] != fingerprint or not pihole.lastReconcile["clean"]:
+    return False
+  if now - pihole.lastReconcile["at"] >= maxStaleSeconds:
+    return False
+  reapAt = pihole.lastReconcile["reapAt"]
+  return reapAt is None or now < reapAt
+
+def recordsFingerprint(newGlobalList):
+  pihole = currentTarget()
+  return (hash(frozenset(newGlobalList)), hash(frozenset(pihole.store.owned)))
+
+def cachedLabels(cache, containerId, labels, created=0):
+  # Parse a container's labels once and reuse them for as long as they are
+  # unchanged. Malformed labels are reported once per change, against the
+  # container carrying them. Entries also keep when the container was created.
+  items = relevantLabels(labels)
+  labelHash = hash(items)
+  cached = cache.get(containerId)
+  if cached is not None and cached[0] == labelHash:
+    return cached[1]
+  if cached is not None:
+    created = cached[2]
+  parsed = parseLabelItems(items)
+  if parsed.errors:
+    metrics.inc("pihole_shim_label_errors_total", len(parsed.errors))
+    for error in parsed.errors:
+      logger.warning("Container %s: ignoring malformed label %s" %(containerId[:12], error))
+  cache[containerId] = (labelHash, parsed, created)
+  return parsed
+
+def collectOptions(caches):
+  # (priority, reapSeconds) of every labeled record, taken from the container
+  # with the highest priority when several label it
+  options = {}
+  for cache in caches:
+    for labelHash, parsed, created in cache.values():
+      for record in parsed.records:
+        if record not in options or parsed.priority > options[record][0]:
+          options[record] = (parsed.priority, parsed.reapSeconds)
+  return options
+
+def containerRanks(cache, prefix=""):
+  # (priority, created) of the cached containers, keyed like containerRecords
+  return dict(("%s%s" %(prefix, containerId), (parsed.priority, created)) for containerId, (labelHash, parsed, created) in cache.items())
+
+def listLabeled(dockerClient, cache):
+  # Records of running containers carrying the label, filtered by the Docker
+  # daemon and read from the container list endpoint, so no container is
+  # inspected. Cache entries of containers that went away are dropped.
+  containers = {}
+  seen = {}
+  for summary in dockerClient.api.containers(filters=labelFilters()):
+    containerId = summary["Id"]
+    records = cachedLabels(cache, containerId, summary.get("Labels"), summary.get("Created", 0)).records
+    seen[containerId] = cache[containerId]
+    if records:
+      containers[containerId] = records
+  cache.clear()
+  cache.update(seen)
+  return containers
+
+def scanContainers():
+  # Labeled records of all running containers, also rebuilding containerRecords
   logger.debug("Listing containers...")
-  containers = client.containers.list()
+  containers = listLabeled(defaultClient(), labelCache)
   newGlobalList = set()
+  containerRecords.clear()
+  containerRecords.update(containers)
+  for records in containers.values():
+    newGlobalList.update(records)
+  labelOptions.clear()
+  labelOptions.update(collectOptions([labelCache]))
+  domainIndex.sync(containerRecords, containerRanks(labelCache))
+  return newGlobalList
+
+def dockerClient(url):
+  # docker is imported on first use, importing the shim does not pay for it
+  import docker
+  return docker.DockerClient(base_url=url, timeout=dockerTimeoutSeconds)
+
+def defaultClient():
+  global client
+  if client is None:
+    client = dockerClient(dockerUrl)
+  return client
+
+def scanSource(source):
+  if source.client is None:
+    source.client = dockerClient(source.url)
+  return listLabeled(source.client, source.labelCache)
+
+def scanSources():
+  # Scan all Docker sources concurrently and merge their records. A source that
+  # cannot be scanned contributes the records of its last successful scan, so
+  # they are held rather than reaped. Returns the records and whether every
+  # source has been scanned at least once.
+  with ThreadPoolExecutor(max_workers=len(dockerSources), thread_name_prefix="docker") as executor:
+    futures = [(source, executor.submit(scanSource, source)) for source in dockerSources]
+  complete = True
+  newGlobalList = set()
+  containerRecords.clear()
+  recordSources.clear()
+  for source, future in futures:
+    try:
+      source.containers = future.result()
+    except Exception as ex:
+      # Reconnect on the next scan
+      source.client = None
+      if source.containers is None:
+        complete = False
+        logger.warning("Docker host %s unreachable and never scanned, holding all removals: %s" %(source.name, ex))
+      else:
+        logger.warning("Docker host %s unreachable, holding its %s containers' records: %s" %(source.name, len(source.containers), ex))
+    for containerId, records in (source.containers or {}).items():
+      containerRecords["%s/%s" %(source.name, containerId)] = records
+      newGlobalList.update(records)
+      for tup in records:
+        recordSources.setdefault(tup, set()).add(source.name)
+  logger.debug("Record sources: %s" %(recordSources))
+  labelOptions.clear()
+  labelOptions.update(collectOptions([source.labelCache for source in dockerSources]))
+  ranks = {}
+  for source in dockerSources:
+    ranks.update(containerRanks(source.labelCache, "%s/" %(source.name)))
+  domainIndex.sync(containerRecords, ranks)
+  return newGlobalList, complete
+
+def reconcile(newGlobalList, now, *, allow_remove=True):
+  pihole = currentTarget()
+  if targets and pihole.sid is None and not connect():
+    raise RuntimeError("not authenticated")
+  newGlobalList = domainIndex.publish(newGlobalList, pihole.store.owned)
+  for tup in newGlobalList:
+    # Track last seen for currently labeled items
+    pihole.store.seen(tup, now, labelOptions.get(tup))
+
+  if not isLeader():
+    # Keep cached Pi-hole records warm for a takeover, but leave writing to the
+    # leader. Without RECORD_CACHE_SECONDS there is nothing to keep.
+    with stateLock:
+      pihole.store.prune(newGlobalList)
+    if recordCacheSeconds > 0:
+      fetchExisting(now)
+    logger.debug("Standing by, %s holds the leader lease" %(lease.holderOf()))
+    return {"added": 0, "removed": 0, "synced": 0, "failed": 0, "deferred": 0, "reapAt": None, "skipped": True}
+
+  # The full sync plans from the owned records, write the changes events queued first
+  flushMutations(now, force=True)
+  if reconcileIsFresh(recordsFingerprint(newGlobalList), now):
+    logger.info("Labels and owned records unchanged, skipping reconcile")
+    return {"added": 0, "removed": 0, "synced": 0, "failed": 0, "deferred": 0, "reapAt": pihole.lastReconcile["reapAt"], "skipped": True}
+
+  with metrics.time("pihole_shim_phase_duration_seconds", phase="list_existing", target=pihole.name):
+    existingRecords = fetchExisting(now)
+  existingFingerprint = hash((frozenset(existingRecords["dns"]), frozenset(existingRecords["cname"])))
+  if pihole.lastReconcile is not None and pihole.lastReconcile["existing"] not in (None, existingFingerprint):
+    logger.info("Pi-hole records changed outside the shim since the last reconcile")
+  with metrics.time("pihole_shim_phase_duration_seconds", phase="handle_list", target=pihole.name):
+    summary = handleList(newGlobalList, existingRecords, allow_remove=allow_remove)
+  recordMetrics(summary)
+  wrote = summary["added"] + summary["removed"] + summary["synced"] + summary["failed"] > 0
+  pihole.lastReconcile = {
+    "fingerprint": recordsFingerprint(newGlobalList),
+    # Our own writes change Pi-hole, only a quiet cycle tells us what it should look like
+    "existing": None if wrote else existingFingerprint,
+    "at": now,
+    "clean": summary["failed"] == 0,
+    "reapAt": summary["reapAt"],
+  }
+  return summary
+
+def recordMetrics(summary):
+  pihole = currentTarget()
+  for key, name in (
+    ("added", "pihole_shim_records_added_total"),
+    ("removed", "pihole_shim_records_removed_total"),
+    ("synced", "pihole_shim_records_synced_total"),
+    ("failed", "pihole_shim_record_failures_total"),
+    ("deferred", "pihole_shim_deferred_reaps_total"),
+  ):
+    metrics.inc(name, summary[key], target=pihole.name)
+  metrics.set("pihole_shim_owned_records", len(pihole.store), target=pihole.name)
+  if summary["failed"] == 0:
+    metrics.set("pihole_shim_last_success_timestamp_seconds", time.time(), target=pihole.name)
+
+def mergeSummaries(summaries):
+  merged = {"added": 0, "removed": 0, "synced": 0, "failed": 0, "deferred": 0, "reapAt": None}
+  for summary in summaries:
+    for key in ("added", "removed", "synced", "failed", "deferred"):
+      merged[key] += summary[key]
+    if summary["reapAt"] is not None:
+      merged["reapAt"] = summary["reapAt"] if merged["reapAt"] is None else min(merged["reapAt"], summary["reapAt"])
+  if summaries and all(summary.get("skipped") for summary in summaries):
+    merged["skipped"] = True
+  return merged
+
+def reconcileTarget(newGlobalList, now, *, allow_remove=True):
+  # reconcile() unless this Pi-hole is backing off after failed syncs. A sync
+  # fails when it raises or when every call it made failed.
+  pihole = currentTarget()
+  if now < pihole.backoff.until:
+    logger.info("Pi-hole %s is backing off after %s failed syncs, retrying in %ss" %(pihole.name, pihole.backoff.failures, int(pihole.backoff.until - now)))
+    return {"added": 0, "removed": 0, "synced": 0, "failed": 0, "deferred": 0, "reapAt": None, "skipped": True}
+  try:
+    summary = reconcile(newGlobalList, now, allow_remove=allow_remove)
+  except Exception:
+    logger.warning("Pi-hole %s: backing off for %.1fs" %(pihole.name, pihole.backoff.failed(now)))
+    raise
+  if summary.get("failed", 0) > 0 and sum(summary.get(key, 0) for key in ("added", "removed", "synced")) == 0:
+    logger.warning("Pi-hole %s: backing off for %.1fs" %(pihole.name, pihole.backoff.failed(now)))
+  else:
+    pihole.backoff.succeeded()
+  return summary
+
+def scanLabels(allow_remove):
+  # Labeled records of all Docker sources, and whether removals are safe
+  global startupLabels
+  if startupLabels is not None:
+    # Listed while starting up
+    (newGlobalList, allow_remove), startupLabels = startupLabels, None
+    return newGlobalList, allow_remove
+  with metrics.time("pihole_shim_phase_duration_seconds", phase="list_containers"):
+    if dockerSources:
+      newGlobalList, complete = scanSources()
+      if not complete and allow_remove:
+        logger.warning("Not removing any records until every Docker host has been scanned")
+        allow_remove = False
+    else:
+      newGlobalList = scanContainers()
+  beat()
+  return newGlobalList, allow_remove
+
+def sync_once(*, allow_remove=True):
+  with metrics.time("pihole_shim_sync_duration_seconds"):
+    logger.info("Running sync")
+    newGlobalList, allow_remove = scanLabels(allow_remove)
+    takeOver()
+    now = int(time.time())
+    try:
+      if not targets:
+        return reconcileTarget(newGlobalList, now, allow_remove=allow_remove)
+      results = runForTargets(reconcileTarget, newGlobalList, now, allow_remove=allow_remove)
+      return mergeSummaries(list(results.values()))
+    finally:
+      cleanupAfterSync()
+
+def cleanupAfterSync():
+  # Remove the sessions of earlier runs in the background once the first sync
+  # is done, so they do not delay it
+  global cleanupPending, cleanupThread
+  piholes, cleanupPending = cleanupPending, []
+  if not piholes:
+    return
+  def cleanAll():
+    for pihole in piholes:
+      try:
+        runWithTarget(pihole, cleanSessions)
+      except Exception as ex:
+        logger.warning("Failed to clean up sessions of %s: %s" %(pihole.name, ex))
+  cleanupThread = threading.Thread(target=cleanAll, name="session-cleanup", daemon=True)
+  cleanupThread.start()
+
+def planTarget(newGlobalList, now, *, allow_remove=True):
+  pihole = currentTarget()
+  if pihole.sid is None:
+    raise RuntimeError("not authenticated")
+  newGlobalList = domainIndex.publish(newGlobalList, pihole.store.owned)
+  for tup in newGlobalList:
+    pihole.store.seen(tup, now, labelOptions.get(tup))
   existingRecords = listExisting()
-  for container in containers:
-    customRecordsLabel = container.labels.get("pihole.custom-record")
-    if customRecordsLabel:
-      customRecords = json.loads(customRecordsLabel)
-      for cr in customRecords:
-        tup = tuple(cr)
-        newGlobalList.add(tup)
-        # Track last seen for currently labeled items
-        globalLastSeen[tup] = int(time.time())
-
-  handleList(newGlobalList, existingRecords, allow_remove=allow_remove)
+  return describePlan(planList(newGlobalList, existingRecords, allow_remove=allow_remove), existingRecords)
+
+def plan_once(*, allow_remove=True):
+  # What sync_once() would do right now, for every Pi-hole, without writing to
+  # Pi-hole or the state file
+  newGlobalList, allow_remove = scanLabels(allow_remove)
+  now = int(time.time())
+  plans = list(runForTargets(planTarget, newGlobalList, now, allow_remove=allow_remove).values())
+  totals = {"counts": {}, "apiCalls": {}}
+  for plan in plans:
+    for section in totals:
+      for key, value in plan[section].items():
+        totals[section][key] = totals[section].get(key, 0) + value
+  return dict(totals, labeled=len(newGlobalList), targets=plans)
+
+def applyStarted(records, now):
+  # Add the records of a started container, returns the reap deadline of
+  # owned records its records displaced (or None)
+  pihole = currentTarget()
+  records = domainIndex.publish(records, pihole.store.owned)
+  for tup in records:
+    pihole.store.seen(tup, now, labelOptions.get(tup))
+  for tup in records & pihole.store.scheduled:
+    # Labeled again before its reap fired
+    pihole.store.unschedule(tup)
+    if pihole.mutations.cancel(tup, "remove"):
+      metrics.inc("pihole_shim_mutations_coalesced_total", target=pihole.name)
+    logger.info("%s labeled again, cancelled its removal" %(str(tup)))
+  toAdd = records - pihole.store.owned
+  logger.debug("These are labels to add from event: %s" %(toAdd))
+  for add in toAdd:
+    pihole.mutations.push("add", add, now)
+  queuedAt = flushMutations(now)
+  # Owned records of the same domains that now lose a conflict to these
+  with stateLock:
+    displaced = {tup for domain in {tup[0] for tup in records} for tup in pihole.store.byDomain(domain)} & (domainIndex.rejected - domainIndex.held)
+    for tup in displaced:
+      pihole.store.schedule(tup, now)
+      logger.info("Removing %s, another container's records won its domain" %(str(tup)))
+  if displaced:
+    return now
+  return queuedAt
+
+def applyStopped(containerId, records, now):
+  pihole = currentTarget()
+  for tup in records - pihole.store.owned:
+    if pihole.mutations.cancel(tup, "add"):
+      # Stopped before its add was written
+      metrics.inc("pihole_shim_mutations_coalesced_total", target=pihole.name)
+      logger.info("Container %s stopped, dropped the queued add of %s" %(containerId, str(tup)))
+  orphaned = records & pihole.store.owned
+  deadlines = [deadline for deadline in (flushMutations(now),) if deadline is not None]
+  for tup in orphaned:
+    # The label was seen until now, so the reap window starts from here
+    pihole.store.seen(tup, now)
+    delay = pihole.store.reapDelay(tup)
+    pihole.store.schedule(tup, now + delay)
+    deadlines.append(now + delay)
+    logger.info("Container %s stopped, reaping %s in ~%ss" %(containerId, str(tup), delay))
+  if orphaned:
+    flushList()
+  # Earliest reap or queued change deadline, None when nothing is pending
+  return min(deadlines) if deadlines else None
+
+def reapDue(now, *, allow_remove=True):
+  # Remove the owned records whose reap deadline passed, without a full sync.
+  # Only used with WATCH_EVENTS, where a record labeled again is unscheduled by
+  # its start event. Returns the next reap deadline.
+  pihole = currentTarget()
+  store = pihole.store
+  if not isLeader():
+    # Reaps are the leader's, a takeover starts with a full sync that schedules them again
+    return None
+  with stateLock:
+    due = limitReaps(set(store.due(now)), now)
+  if due and not allow_remove:
+    logger.debug("Suppressed removal (--no-remove): eligible=%s" %(sorted(due)))
+  elif due:
+    for item in due:
+      pihole.mutations.push("remove", item, now)
+  queuedAt = flushMutations(now)
+  with stateLock:
+    deadlines = [deadline for deadline in (store.nextDeadline(), queuedAt) if deadline is not None]
+  return min(deadlines) if deadlines else None
+
+def flushMutations(now, force=False):
+  # Write the queued record changes once the oldest is MUTATION_WINDOW_SECONDS
+  # old, or right away when forced. With BATCH_APPLY they go out in one PATCH.
+  # Returns when the changes still queued are due, None when none are.
+  pihole = currentTarget()
+  store = pihole.store
+  deadline = pihole.mutations.deadline()
+  if deadline is None or (now < deadline and not force):
+    metrics.set("pihole_shim_mutation_queue_depth", len(pihole.mutations), target=pihole.name)
+    return deadline
+  pending = pihole.mutations.take()
+  metrics.set("pihole_shim_mutation_queue_depth", len(pihole.mutations), target=pihole.name)
+  toAdd = {key for key, (op, at) in pending.items() if op == "add"}
+  toRemove = set(pending) - toAdd
+  batch = batchApply and len(pending) > 1
+  if batch or toRemove:
+    existing = fetchExisting(int(now))
+  else:
+    # Without cached Pi-hole records they are unknown, "already present" is handled as success
+    existing = pihole.recordCache or {"dns": set(), "cname": set()}
+  # Records Pi-hole already has go through addObject, which decides on adopting them
+  present = {key for key in toAdd if key in existing["dns"] or key in existing["cname"]}
+  if batch and applyBatch(toAdd - present, toRemove, existing):
+    with stateLock:
+      for add in toAdd - present:
+        store.own(add, int(now))
+      for remove in toRemove:
+        store.disown(remove)
+    added = [(key, True) for key in sorted(toAdd - present)] + applyAll(addObject, present, existing)
+    removed = [(key, True) for key in sorted(toRemove)]
+  else:
+    added = applyAll(addObject, toAdd, existing)
+    removed = applyAll(removeObject, toRemove, existing)
+  logResults("Reap", removed)
+  written = time.time()
+  for (op, results) in (("add", added), ("remove", removed)):
+    failed = sum(1 for item, ok in results if ok is False)
+    metrics.inc("pihole_shim_records_added_total" if op == "add" else "pihole_shim_records_removed_total", sum(1 for item, ok in results if ok is True), target=pihole.name)
+    metrics.inc("pihole_shim_record_failures_total", failed, target=pihole.name)
+    for item, ok in results:
+      metrics.observe("pihole_shim_mutation_latency_seconds", max(0, written - pending[item][1]), op=op, target=pihole.name)
+  metrics.set("pihole_shim_owned_records", len(store), target=pihole.name)
+  with stateLock:
+    for item, ok in removed:
+      if ok is False and item in store:
+        # Retry with the next full sync
+        store.schedule(item, now + reconcileSeconds)
+  flushList()
+  return pihole.mutations.deadline()
+
+def reapOnce(*, allow_remove=True):
+  # Run due reaps on every Pi-hole, returns the earliest next reap deadline
+  now = time.time()
+  deadlines = [deadline for deadline in runForTargets(reapDue, now, allow_remove=allow_remove).values() if deadline is not None]
+  return min(deadlines) if deadlines else None
+
+def handleEvent(event):
+  # Apply a single container event incrementally, returns the epoch at which
+  # orphaned records become reapable (or None when nothing is pending).
+  action = event.get("Action") or event.get("status")
+  actor = event.get("Actor") or {}
+  containerId = actor.get("ID") or event.get("id")
+  attributes = actor.get("Attributes") or {}
+  now = int(time.time())
+  sourceName = event.get("source")
+  source = next((source for source in dockerSources if source.name == sourceName), None)
+  key = "%s/%s" %(sourceName, containerId) if source else containerId
+  logger.debug("Docker event %s for container %s" %(action, key))
+
+  if action in ("start", "update"):
+    cache = source.labelCache if source else labelCache
+    parsed = cachedLabels(cache, containerId, attributes, event.get("time", now))
+    records = parsed.records
+    domainIndex.update(key, records, (parsed.priority, cache[containerId][2]))
+    for record in records:
+      if record not in labelOptions or parsed.priority > labelOptions[record][0]:
+        labelOptions[record] = (parsed.priority, parsed.reapSeconds)
+    containerRecords[key] = records
+    if source and source.containers is not None:
+      source.containers[containerId] = records
+    if not isLeader():
+      return None
+    deadlines = [deadline for deadline in runForTargets(applyStarted, records, now).values() if deadline is not None]
+    return min(deadlines) if deadlines else None
+
+  if action == "die":
+    records = containerRecords.pop(key, None)
+    if source and source.containers is not None:
+      source.containers.pop(containerId, None)
+    if records is None:
+      records = parseRecords(attributes)
+    changed = domainIndex.update(key, frozenset())
+    if not isLeader():
+      return None
+    # Records of other containers that no longer lose a conflict to this one
+    promoted = frozenset(tup for domain in changed for labeled in domainIndex.labels.get(domain, {}).values() for tup in labeled)
+    if promoted:
+      runForTargets(applyStarted, promoted, now)
+    stillLabeled = set().union(*containerRecords.values())
+    results = runForTargets(applyStopped, containerId, records - stillLabeled, now)
+    deadlines = [deadline for deadline in results.values() if deadline is not None]
+    if deadlines:
+      return min(deadlines)
+  return None
+
+def streamEvents(eventQueue, source=None):
+  filters = dict(labelFilters(), type="container", event=list(eventActions))
+  while True:
+    try:
+      if source is None:
+        events = defaultClient().events(decode=True, filters=filters)
+      else:
+        if source.client is None:
+          source.client = dockerClient(source.url)
+        events = source.client.events(decode=True, filters=filters)
+      for event in events:
+        eventQueue.put(event if source is None else dict(event, source=source.name))
+      logger.warning("Docker event stream ended")
+    except Exception as ex:
+      logger.error("Docker event stream failed: %s" %(ex))
+    # Anything may have happened while disconnected, ask for a full reconcile
+    eventQueue.put(None)
+    time.sleep(intervalSeconds)
+
+class Lease:
+  # Leader lease shared by the shim replicas syncing the same Pi-holes. Only
+  # the holder writes, the others stand by until it is not renewed for
+  # LEADER_LEASE_SECONDS. The lease record lives in memory here, which is
+  # enough for tests and to share between Lease objects of one process.
+  def __init__(self, holder, seconds, shared=None):
+    self.holder = holder
+    self.seconds = seconds
+    self.shared = {} if shared is None else shared
+    self.expires = 0
+    # None until the first renewal, then whether this replica led after the last one
+    self.leader = None
+    self.takenFrom = None
+    self.takenOver = False
+
+  @contextmanager
+  def locked(self):
+    yield
+
+  def read(self):
+    return dict(self.shared) or None
+
+  def write(self, record):
+    self.shared.clear()
+    self.shared.update(record)
+
+  def held(self, now):
+    return now < self.expires
+
+  def holderOf(self):
+    current = self.read()
+    return current["holder"] if current else None
+
+  def renew(self, now):
+    # Take or extend the lease, returns whether this replica holds it
+    with self.locked():
+      current = self.read()
+      if current and current["holder"] != self.holder and current["expires"] > now:
+        self.expires = 0
+        return False
+      self.write({"holder": self.holder, "expires": now + self.seconds, "renewed": now})
+    self.takenFrom = current if current and current["holder"] != self.holder else None
+    self.expires = now + self.seconds
+    return True
+
+class FileLease(Lease):
+  # Lease record in a JSON file on storage shared by the replicas. Renewals
+  # are serialised by an flock on <path>.lock and written atomically.
+  def __init__(self, path, holder, seconds):
+    super().__init__(holder, seconds)
+    self.path = path
+
+  @contextmanager
+  def locked(self):
+    with open("%s.lock" %(self.path), "a") as lockFile:
+      fcntl.flock(lockFile, fcntl.LOCK_EX)
+      try:
+        yield
+      finally:
+        fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+  def read(self):
+    try:
+      with open(self.path, "r") as openfile:
+        return json.load(openfile)
+    except FileNotFoundError:
+      return None
+
+  def write(self, record):
+    writeAtomic(self.path, json.dumps(record))
+
+lease = FileLease(leaseFile, leaderId, leaseSeconds) if leaseFile else None
+
+def isLeader():
+  return lease is None or lease.held(time.time())
+
+def renewLease(now):
+  # Renew or take the leader lease, logging and measuring changes of leadership.
+  # Returns whether this replica now leads.
+  started = time.perf_counter()
+  try:
+    leader = lease.renew(now)
+    metrics.inc("pihole_shim_lease_renewals_total", result="leader" if leader else "standby")
+  except Exception as ex:
+    # Keep leading until the lease we hold runs out
+    logger.warning("Could not renew the leader lease: %s" %(ex))
+    metrics.inc("pihole_shim_lease_renewals_total", result="error")
+    leader = lease.held(now)
+  metrics.observe("pihole_shim_lease_renew_duration_seconds", time.perf_counter() - started)
+  if leader and not lease.leader:
+    if lease.takenFrom is not None:
+      failover = now - lease.takenFrom["renewed"]
+      metrics.observe("pihole_shim_failover_seconds", failover)
+      logger.warning("Took over as leader from %s, %.1fs after its last renewal" %(lease.takenFrom["holder"], failover))
+    else:
+      logger.info("Leading as %s" %(lease.holder))
+    # A replica that stood by reloads the state the previous leader persisted
+    lease.takenOver = lease.leader is False
+  elif not leader and lease.leader is not False:
+    logger.info("Standing by, %s holds the leader lease" %(lease.holderOf()))
+  lease.leader = leader
+  metrics.set("pihole_shim_leader", int(leader))
+  return leader
+
+def leaseLoop(onTakeover):
+  # Renew the lease every LEADER_RENEW_SECONDS, calling onTakeover() when this
+  # replica becomes leader so it syncs right away
+  while True:
+    time.sleep(leaseRenewSeconds)
+    wasLeader = lease.leader
+    if renewLease(time.time()) and not wasLeader:
+      onTakeover()
+
+def reloadState():
+  # Replace the in-memory state with the one the previous leader persisted
+  pihole = currentTarget()
+  with stateLock:
+    pihole.store = RecordStore()
+    pihole.persistedOwned = None
+    pihole.persistedLastSeen = {}
+    pihole.persistedLabeledAt = None
+    pihole.persistedGeneration = 0
+    pihole.journalEntries = 0
+    pihole.lastReconcile = None
+    readState()
+
+def takeOver():
+  if lease is None or not lease.takenOver:
+    return
+  lease.takenOver = False
+  runForTargets(reloadState)
+
+class Scheduler:
+  # Delay before the next polling sync. It grows by INTERVAL_GROWTH after each
+  # sync that changed nothing, up to MAX_INTERVAL_SECONDS, and snaps back to
+  # MIN_INTERVAL_SECONDS on any change. Failing syncs back off instead, and
+  # the loop does not wake before a due reap or while every Pi-hole backs off.
+  def __init__(self):
+    self.interval = self.minimum()
+    self.backoff = Backoff()
+
+  def minimum(self):
+    return minIntervalSeconds or intervalSeconds
+
+  def maximum(self):
+    return max(maxIntervalSeconds, self.minimum())
+
+  def nextDelay(self, summary, now):
+    if summary is None:
+      return self.backoff.failed(now)
+    self.backoff.succeeded()
+    changed = sum(summary.get(key, 0) for key in ("added", "removed", "synced", "failed")) > 0
+    self.interval = self.minimum() if changed else min(self.maximum(), self.interval * intervalGrowth)
+    delay = max(self.interval, min(pihole.backoff.until for pihole in targets or [moduleTarget]) - now)
+    if summary.get("reapAt") is not None:
+      delay = min(delay, max(0, summary["reapAt"] - now))
+    return delay
+
+def pollLoop(*, allow_remove=True):
+  scheduler = Scheduler()
+  wake = threading.Event()
+  if lease is not None:
+    threading.Thread(target=leaseLoop, args=(wake.set,), name="leader-lease", daemon=True).start()
+  while True:
+    try:
+      summary = sync_once(allow_remove=allow_remove)
+    except Exception as ex:
+      logger.error("Sync failed: %s" %(ex))
+      summary = None
+    delay = scheduler.nextDelay(summary, time.time())
+    logger.info("Sleeping for %.1fs" %(delay))
+    beat(delay)
+    wake.wait(delay)
+    wake.clear()
+
+def runEventLoop(*, allow_remove=True):
+  eventQueue = queue.Queue()
+  for source in dockerSources or [None]:
+    name = "docker-events" if source is None else "docker-events-%s" %(source.name)
+    threading.Thread(target=streamEvents, args=(eventQueue, source), name=name, daemon=True).start()
+  if lease is not None:
+    # A takeover asks for a full reconcile like a reconnected event stream
+    threading.Thread(target=leaseLoop, args=(lambda: eventQueue.put(None),), name="leader-lease", daemon=True).start()
+  nextReconcile = 0
+  nextReap = None
+  while True:
+    now = time.time()
+    if now >= nextReconcile:
+      try:
+        nextReap = sync_once(allow_remove=allow_remove)["reapAt"]
+      except Exception as ex:
+        logger.error("Sync failed: %s" %(ex))
+      nextReconcile = time.time() + reconcileSeconds
+      logger.info("Waiting for docker events, full reconcile in %ss" %(reconcileSeconds))
+      continue
+    if nextReap is not None and now >= nextReap:
+      try:
+        nextReap = reapOnce(allow_remove=allow_remove)
+      except Exception as ex:
+        logger.error("Reap failed: %s" %(ex))
+        nextReap = None
+      continue
+    timeout = min(nextReconcile, nextReap or nextReconcile) - now
+    beat(timeout)
+    try:
+      event = eventQueue.get(timeout=timeout)
+    except queue.Empty:
+      continue
+    if event is None:
+      nextReconcile = 0
+      continue
+    try:
+      reapAt = handleEvent(event)
+    except Exception as ex:
+      logger.error("Failed to apply docker event: %s" %(ex))
+      continue
+    if reapAt is not None:
+      nextReap = reapAt if nextReap is None else min(nextReap, reapAt)
+
+# Labeled records listed by startup(), used by the first sync
+startupLabels = None
+# Pi-holes that got a new session at startup and their session cleanup thread
+cleanupPending = []
+cleanupThread = None
+
+def startup(allow_remove, cleanup):
+  # Load the state, connect to every Pi-hole and list the labeled containers
+  # concurrently, logging how long each took. Returns whether any Pi-hole is
+  # connected.
+  global startupLabels
+  timings = {}
+  def timed(name, fn, *args, **kwargs):
+    started = time.perf_counter()
+    try:
+      return fn(*args, **kwargs)
+    finally:
+      timings[name] = time.perf_counter() - started
+
+  started = time.perf_counter()
+  piholes = targets or [moduleTarget]
+  with ThreadPoolExecutor(max_workers=2 * len(piholes) + 1, thread_name_prefix="startup") as executor:
+    labels = executor.submit(timed, "containers", scanLabels, allow_remove)
+    sessions = []
+    for pihole in piholes:
+      suffix = "" if pihole is moduleTarget else " %s" %(pihole.name)
+      executor.submit(runWithTarget, pihole, timed, "state" + suffix, readState)
+      sessions.append((pihole, executor.submit(runWithTarget, pihole, timed, "session" + suffix, startSession)))
+  try:
+    startupLabels = labels.result()
+  except Exception as ex:
+    # The first sync lists them again
+    logger.warning("Could not list containers at startup: %s" %(ex))
+  for pihole, future in sessions:
+    try:
+      fresh = future.result()
+    except Exception as ex:
+      logger.error("Could not connect to Pi-hole %s: %s" %(pihole.name, ex))
+      continue
+    if fresh and cleanup:
+      cleanupPending.append(pihole)
+  logger.info("Started in %.2fs (%s)" %(time.perf_counter() - started, ", ".join("%s %.2fs" %(name, timings[name]) for name in sorted(timings))))
+  return any(pihole.sid is not None for pihole in piholes)
 
 def main(argv=None):
   parser = argparse.ArgumentParser(description="Synchronise Docker label records into Pi-hole DNS records.")
   parser.add_argument("--run-once", action="store_true", help="Run a single sync iteration and exit.")
   parser.add_argument("--no-remove", action="store_true", help="Do not delete records (suppresses removals even when eligible).")
+  parser.add_argument("--plan", action="store_true", help="Print what a sync would change as JSON and exit, without writing anything.")
   args = parser.parse_args(argv)
 
   if token == "":
     logger.warning("pihole token is blank, Set a token environment variable PIHOLE_TOKEN")
     return 1
 
-  readState()
-
-  global sid
-  sid = auth()
-  cleanSessions()
+  # Replicas would delete each other's sessions
+  cleanup = not args.plan and lease is None
 
+  if targets:
+    logger.info("Syncing to %s Pi-holes: %s" %(len(targets), ", ".join(pihole.name for pihole in targets)))
   allow_remove = not args.no_remove
+  if not startup(allow_remove, cleanup):
+    logger.error("Could not authenticate with any Pi-hole")
+    return 1
+
+  if lease is not None and not args.plan:
+    renewLease(time.time())
+
+  if args.plan:
+    print(json.dumps(plan_once(allow_remove=allow_remove), indent=2))
+    return 0
 
   if args.run_once:
     sync_once(allow_remove=allow_remove)
+    if cleanupThread is not None:
+      cleanupThread.join()
     return 0
 
-  while True:
-    sync_once(allow_remove=allow_remove)
-    logger.info("Sleeping for %s" %(intervalSeconds))
-    time.sleep(intervalSeconds)
+  if metricsPort > 0:
+    startMetricsServer(metricsPort)
+
+  if watchEvents:
+    runEventLoop(allow_remove=allow_remove)
+    return 0
+
+  pollLoop(allow_remove=allow_remove)
+  return 0
 
 if __name__ == "__main__":
   sys.exit(main())
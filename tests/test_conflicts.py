@@ -0,0 +1,142 @@
+import sys, types, importlib, logging
+
+
+def import_shim_with_docker_stub():
+	sys.modules.pop('shim', None)
+	docker_stub = types.SimpleNamespace(DockerClient=lambda base_url, **kwargs: object())
+	sys.modules['docker'] = docker_stub
+	return importlib.import_module('shim')
+
+
+first = ("app.lan", "10.0.0.1")
+second = ("app.lan", "10.0.0.2")
+other = ("other.lan", "10.0.0.3")
+
+
+def test_priority_then_age_picks_the_records_of_a_conflicting_domain(caplog):
+	shim = import_shim_with_docker_stub()
+	caplog.set_level(logging.INFO)
+	index = shim.DomainIndex()
+	containers = {"c1": frozenset({first, other}), "c2": frozenset({second})}
+
+	assert index.sync(containers, {"c1": (0, 100), "c2": (0, 200)}) == {"app.lan", "other.lan"}
+	assert index.conflicts == {"app.lan": (("c1", "c2"), "c1")}
+	assert index.rejected == {second}
+	assert "Containers label app.lan with conflicting targets (c1: 10.0.0.1; c2: 10.0.0.2), keeping those of c1" in caplog.text
+
+	# Nothing changed, nothing is resolved again
+	assert index.sync(containers, {"c1": (0, 100), "c2": (0, 200)}) == set()
+
+	# A higher priority wins over age, only its domains are resolved again
+	assert index.sync(containers, {"c1": (0, 100), "c2": (5, 200)}) == {"app.lan"}
+	assert index.rejected == {first}
+	assert index.publish({first, second, other}, set()) == {second, other}
+	assert shim.metrics.values[("pihole_shim_domain_conflicts_total", (("policy", "priority"),))] == 2
+
+	assert index.update("c2", frozenset()) == {"app.lan"}
+	assert index.conflicts == {}
+	assert index.rejected == set()
+	assert "Conflict on app.lan resolved" in caplog.text
+
+
+def test_oldest_and_refuse_policies():
+	shim = import_shim_with_docker_stub()
+	containers = {"c1": frozenset({first}), "c2": frozenset({second})}
+	ranks = {"c1": (0, 200), "c2": (9, 100)}
+
+	shim.conflictPolicy = "oldest"
+	index = shim.DomainIndex()
+	index.sync(containers, ranks)
+	assert index.conflicts["app.lan"][1] == "c2"
+
+	shim.conflictPolicy = "refuse"
+	index = shim.DomainIndex()
+	index.sync(containers, ranks)
+	assert index.conflicts["app.lan"] == (("c1", "c2"), None)
+	# Neither is added, an owned one is kept
+	assert index.publish({first, second}, set()) == set()
+	assert index.publish({first, second}, {first}) == {first}
+
+
+def test_plan_replaces_a_displaced_record_and_leaves_unmanaged_ones_alone(monkeypatch):
+	shim = import_shim_with_docker_stub()
+	shim.moduleTarget.store = shim.RecordStore()
+	shim.reapSeconds = 600
+	monkeypatch.setattr(shim.time, 'time', lambda: 1000)
+	shim.moduleTarget.store.own(first, 990)
+	shim.domainIndex.sync({"c1": frozenset({first}), "c2": frozenset({second})}, {"c1": (0, 100), "c2": (5, 200)})
+	manual = ("manual.lan", "10.0.0.9")
+	existing = {"dns": {first, manual}, "cname": set()}
+
+	labeled = shim.domainIndex.publish({first, second, manual}, shim.moduleTarget.store.owned)
+	plan = shim.planList(labeled, existing)
+	assert plan["add"] == {second}
+	# The loser goes right away instead of after REAP_SECONDS
+	assert plan["remove"] == {first}
+	assert plan["unmanaged"] == {manual}
+
+	shim.adoptUnmanaged = True
+	plan = shim.planList(labeled, existing)
+	assert plan["add"] == {second, manual}
+
+
+def test_addObject_only_adopts_unmanaged_records_when_allowed(monkeypatch):
+	shim = import_shim_with_docker_stub()
+	shim.moduleTarget.store = shim.RecordStore()
+	monkeypatch.setattr(shim, 'apiCall', lambda endpoint_key, payload=None: (False, {"error": {"message": "Item already present"}}))
+	existing = {"dns": {other}, "cname": set()}
+
+	# Left unmanaged, which is neither an add nor a failure
+	assert shim.addObject(other, existing) is None
+	assert shim.addObject(first, existing) is None
+	assert shim.moduleTarget.store.owned == set()
+	assert shim.moduleTarget.unmanaged == {first, other}
+
+	shim.adoptUnmanaged = True
+	assert shim.addObject(other, existing) is True
+	assert shim.addObject(first, existing) is True
+	assert shim.moduleTarget.store.owned == {first, other}
+	assert shim.metrics.values[("pihole_shim_records_adopted_total", (("target", "default"),))] == 2
+
+
+def test_a_create_whose_answer_is_lost_is_owned(monkeypatch):
+	shim = import_shim_with_docker_stub()
+	shim.moduleTarget.store = shim.RecordStore()
+	monkeypatch.setattr(shim, 'apiCall', lambda endpoint_key, payload=None: (_ for _ in ()).throw(TimeoutError("read timed out")))
+
+	try:
+		shim.addObject(first, {"dns": set(), "cname": set()})
+		assert False, "the error is raised"
+	except TimeoutError:
+		pass
+	# Pi-hole may have applied it, the next sync finds it or re-adds it
+	assert shim.moduleTarget.store.owned == {first}
+	existing = {"dns": {first}, "cname": set()}
+	assert shim.planList({first}, existing)["unmanaged"] == set()
+
+
+def test_creates_and_deletes_are_not_retried():
+	shim = import_shim_with_docker_stub()
+	adapter = shim.getSession().get_adapter("http://pi.hole/api")
+	assert adapter.max_retries.allowed_methods == frozenset(["GET", "PATCH"])
+
+
+def test_a_and_aaaa_records_of_different_containers_do_not_conflict():
+	shim = import_shim_with_docker_stub()
+	v4, v6, v6b = ("app.lan", "10.0.0.1"), ("app.lan", "fd00::1"), ("app.lan", "fd00::2")
+	alias = ("app.lan", "web.lan")
+	index = shim.DomainIndex()
+
+	index.sync({"c1": frozenset({v4}), "c2": frozenset({v6})}, {"c1": (0, 100), "c2": (0, 200)})
+	assert index.conflicts == {}
+	assert index.publish({v4, v6}, set()) == {v4, v6}
+
+	# Two AAAA targets still conflict, the older container keeps its own
+	index.update("c3", frozenset({v6b}), (0, 300))
+	assert index.conflicts == {"app.lan": (("c1", "c2", "c3"), "c1")}
+	assert index.rejected == {v6b}
+
+	# A CNAME excludes addresses, the winner decides which the domain gets
+	index.update("c3", frozenset({alias}), (9, 300))
+	assert index.rejected == {v4, v6}
+	assert index.publish({v4, v6, alias}, set()) == {alias}
@@ -0,0 +1,60 @@
+import sys, types, importlib
+
+
+def import_shim_with_docker_stub():
+	sys.modules.pop('shim', None)
+	docker_stub = types.SimpleNamespace(DockerClient=lambda base_url, **kwargs: object())
+	sys.modules['docker'] = docker_stub
+	return importlib.import_module('shim')
+
+
+def make_event(action, container_id, label=None):
+	attributes = {"name": container_id}
+	if label is not None:
+		attributes["pihole.custom-record"] = label
+	return {"Type": "container", "Action": action, "Actor": {"ID": container_id, "Attributes": attributes}}
+
+
+def test_handleEvent_start_adds_only_new_records(monkeypatch):
+	shim = import_shim_with_docker_stub()
+	shim.moduleTarget.store = shim.RecordStore()
+	shim.moduleTarget.store.own(("known.lan", "10.0.0.1"))
+	shim.containerRecords.clear()
+	monkeypatch.setattr(shim.time, 'time', lambda: 5000)
+
+	added = []
+	flushed = []
+	monkeypatch.setattr(shim, 'addObject', lambda obj, existing: added.append(obj))
+	monkeypatch.setattr(shim, 'flushList', lambda: flushed.append(True))
+
+	label = '[["known.lan", "10.0.0.1"], ["new.lan", "10.0.0.2"]]'
+	reapAt = shim.handleEvent(make_event("start", "c1", label))
+
+	assert reapAt is None
+	assert added == [("new.lan", "10.0.0.2")]
+	assert flushed == [True]
+	assert shim.containerRecords["c1"] == {("known.lan", "10.0.0.1"), ("new.lan", "10.0.0.2")}
+	assert shim.moduleTarget.store.lastSeen(("known.lan", "10.0.0.1")) == 5000
+
+
+def test_handleEvent_die_starts_reap_clock_for_orphaned_records_only(monkeypatch):
+	shim = import_shim_with_docker_stub()
+	shared = ("shared.lan", "10.0.0.3")
+	solo = ("solo.lan", "10.0.0.4")
+	shim.moduleTarget.store = shim.RecordStore()
+	shim.moduleTarget.store.own(shared, 100)
+	shim.moduleTarget.store.own(solo, 100)
+	shim.containerRecords.clear()
+	shim.containerRecords.update({"c1": {shared, solo}, "c2": {shared}})
+	shim.reapSeconds = 60
+	monkeypatch.setattr(shim.time, 'time', lambda: 7000)
+	monkeypatch.setattr(shim, 'flushList', lambda: None)
+	monkeypatch.setattr(shim, 'removeObject', lambda obj, existing: (_ for _ in ()).throw(AssertionError("events never remove directly")))
+
+	reapAt = shim.handleEvent(make_event("die", "c1"))
+
+	assert reapAt == 7060
+	assert "c1" not in shim.containerRecords
+	assert shim.moduleTarget.store.lastSeen(solo) == 7000
+	assert shim.moduleTarget.store.lastSeen(shared) == 100
+	assert shim.moduleTarget.store.owned == {shared, solo}
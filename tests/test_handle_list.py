@@ -3,7 +3,7 @@ import sys, types, importlib, logging
 
 def import_shim_with_docker_stub():
 	sys.modules.pop('shim', None)
-	docker_stub = types.SimpleNamespace(DockerClient=lambda base_url: object())
+	docker_stub = types.SimpleNamespace(DockerClient=lambda base_url, **kwargs: object())
 	sys.modules['docker'] = docker_stub
 	return importlib.import_module('shim')
 
@@ -11,8 +11,7 @@ def import_shim_with_docker_stub():
 def test_handleList_adds_new_records_and_flushes(monkeypatch):
 	shim = import_shim_with_docker_stub()
 	# Isolate globals
-	shim.globalList = set()
-	shim.globalLastSeen = {}
+	shim.moduleTarget.store = shim.RecordStore()
 
 	# Freeze time for determinism
 	monkeypatch.setattr(shim.time, 'time', lambda: 2000000000)
@@ -22,8 +21,7 @@ def test_handleList_adds_new_records_and_flushes(monkeypatch):
 
 	def fake_addObject(obj, existingRecords):
 		created.append(obj)
-		shim.globalList.add(obj)
-		shim.globalLastSeen[obj] = 2000000000
+		shim.moduleTarget.store.own(obj, 2000000000)
 
 	calls = {"flushed": False}
 
@@ -39,14 +37,13 @@ def test_handleList_adds_new_records_and_flushes(monkeypatch):
 	shim.handleList(newGlobalList, existing)
 
 	assert created == [("new.example", "10.0.0.10")]
-	assert ("new.example", "10.0.0.10") in shim.globalList
+	assert ("new.example", "10.0.0.10") in shim.moduleTarget.store
 	assert calls["flushed"] is True
 
 
 def test_handleList_reaps_old_records_and_defers_recent(monkeypatch):
 	shim = import_shim_with_docker_stub()
-	shim.globalList = set()
-	shim.globalLastSeen = {}
+	shim.moduleTarget.store = shim.RecordStore()
 
 	# Set reap window to 100 seconds
 	shim.reapSeconds = 100
@@ -54,10 +51,11 @@ def test_handleList_reaps_old_records_and_defers_recent(monkeypatch):
 	# Two records: one old, one recent
 	old_rec = ("old.example", "10.0.0.20")
 	recent_rec = ("recent.example", "10.0.0.21")
-	shim.globalList.update({old_rec, recent_rec})
-	shim.globalLastSeen[old_rec] = 1000  # very old
+	shim.moduleTarget.store.own(old_rec)
+	shim.moduleTarget.store.own(recent_rec)
+	shim.moduleTarget.store.seen(old_rec, 1000)  # very old
 	# recent record seen 50s ago, which is < reapSeconds, so it should be deferred
-	shim.globalLastSeen[recent_rec] = 2050
+	shim.moduleTarget.store.seen(recent_rec, 2050)
 
 	# Now is 2100: old should be reaped (age 110), recent deferred (age 50)
 	monkeypatch.setattr(shim.time, 'time', lambda: 2100)
@@ -66,7 +64,7 @@ def test_handleList_reaps_old_records_and_defers_recent(monkeypatch):
 
 	def fake_removeObject(obj, existing):
 		removed.append(obj)
-		shim.globalList.remove(obj)
+		shim.moduleTarget.store.disown(obj)
 
 	# Prevent addObject from calling out to API during sync phase
 	monkeypatch.setattr(shim, 'addObject', lambda obj, existing: None)
@@ -81,13 +79,15 @@ def test_handleList_reaps_old_records_and_defers_recent(monkeypatch):
 
 	assert old_rec in removed
 	assert recent_rec not in removed
-	assert old_rec not in shim.globalList
-	assert recent_rec in shim.globalList
+	assert old_rec not in shim.moduleTarget.store
+	assert recent_rec in shim.moduleTarget.store
 
 
 def test_handleList_syncs_missing_records(monkeypatch):
 	shim = import_shim_with_docker_stub()
-	shim.globalList = {("synced.example", "10.0.0.30"), ("alias.example", "host.example")}
+	shim.moduleTarget.store = shim.RecordStore()
+	shim.moduleTarget.store.own(("synced.example", "10.0.0.30"))
+	shim.moduleTarget.store.own(("alias.example", "host.example"))
 
 	added = []
 
@@ -98,7 +98,7 @@ def test_handleList_syncs_missing_records(monkeypatch):
 	monkeypatch.setattr(shim, 'flushList', lambda: None)
 
 	# existing records are missing both entries → should be re-added via addObject
-	newGlobalList = shim.globalList.copy()
+	newGlobalList = set(shim.moduleTarget.store.owned)
 	existing = {"dns": set(), "cname": set()}
 
 	shim.handleList(newGlobalList, existing)
@@ -108,13 +108,11 @@ def test_handleList_syncs_missing_records(monkeypatch):
 
 def test_handleList_no_remove_suppresses_eligible_removals_and_logs_debug(monkeypatch, caplog):
 	shim = import_shim_with_docker_stub()
-	shim.globalList = set()
-	shim.globalLastSeen = {}
+	shim.moduleTarget.store = shim.RecordStore()
 
 	shim.reapSeconds = 100
 	old_rec = ("old.example", "10.0.0.20")
-	shim.globalList.add(old_rec)
-	shim.globalLastSeen[old_rec] = 1000
+	shim.moduleTarget.store.own(old_rec, 1000)
 
 	# Now is 1200: old is eligible for reap (age 200 >= 100)
 	monkeypatch.setattr(shim.time, 'time', lambda: 1200)
@@ -136,3 +134,83 @@ def test_handleList_no_remove_suppresses_eligible_removals_and_logs_debug(monkey
 	assert "Suppressed removal (--no-remove)" in caplog.text
 	assert "old.example" in caplog.text
 
+
+
+def test_handleList_applies_with_bounded_concurrency_and_ordered_results(monkeypatch, caplog):
+	shim = import_shim_with_docker_stub()
+	shim.moduleTarget.store = shim.RecordStore()
+	shim.applyConcurrency = 4
+	monkeypatch.setattr(shim, 'flushList', lambda: None)
+
+	import threading, time as real_time
+	lock = threading.Lock()
+	state = {"inFlight": 0, "peak": 0}
+
+	def slow_addObject(obj, existing):
+		with lock:
+			state["inFlight"] += 1
+			state["peak"] = max(state["peak"], state["inFlight"])
+		real_time.sleep(0.02)
+		with lock:
+			state["inFlight"] -= 1
+		shim.moduleTarget.store.own(obj)
+		return obj[0] != "host3.lan"
+
+	monkeypatch.setattr(shim, 'addObject', slow_addObject)
+
+	newGlobalList = {("host%s.lan" % i, "10.0.0.%s" % i) for i in range(12)}
+	existing = {"dns": set(), "cname": set()}
+
+	with caplog.at_level(logging.INFO):
+		shim.handleList(newGlobalList, existing)
+
+	assert state["peak"] == 4
+	assert shim.moduleTarget.store.owned == newGlobalList
+	assert "Add: 11 applied, 1 failed" in caplog.text
+	assert "Add failed for ('host3.lan', '10.0.0.3')" in caplog.text
+
+
+def test_handleList_batch_apply_patches_full_arrays_once(monkeypatch):
+	shim = import_shim_with_docker_stub()
+	shim.batchApply = True
+	shim.reapSeconds = 0
+	monkeypatch.setattr(shim.time, 'time', lambda: 3000)
+	monkeypatch.setattr(shim, 'flushList', lambda: None)
+	monkeypatch.setattr(shim, 'addObject', lambda obj, existing: (_ for _ in ()).throw(AssertionError("no per-record calls")))
+
+	stale = ("stale.lan", "10.0.0.9")
+	shim.moduleTarget.store = shim.RecordStore()
+	shim.moduleTarget.store.own(stale, 1000)
+
+	calls = []
+	monkeypatch.setattr(shim, 'apiCall', lambda key, payload=None: (calls.append((key, payload)), (True, None))[1])
+
+	existing = {
+		"dns": {("manual.lan", "10.0.0.1"), stale},
+		"cname": {("manual-alias.lan", "manual.lan")},
+	}
+	newGlobalList = {("app.lan", "10.0.0.2"), ("alias.lan", "app.lan")}
+
+	shim.handleList(newGlobalList, existing)
+
+	assert calls == [("patchConfig", {"config": {"dns": {
+		"hosts": ["10.0.0.1 manual.lan", "10.0.0.2 app.lan"],
+		"cnameRecords": ["alias.lan,app.lan", "manual-alias.lan,manual.lan"],
+	}}})]
+	assert shim.moduleTarget.store.owned == newGlobalList
+	assert shim.moduleTarget.store.lastSeen(stale) is None
+
+
+def test_handleList_batch_apply_falls_back_to_per_record_calls(monkeypatch):
+	shim = import_shim_with_docker_stub()
+	shim.batchApply = True
+	shim.moduleTarget.store = shim.RecordStore()
+	monkeypatch.setattr(shim, 'flushList', lambda: None)
+	monkeypatch.setattr(shim, 'apiCall', lambda key, payload=None: (False, {"error": {"message": "Invalid"}}))
+
+	added = []
+	monkeypatch.setattr(shim, 'addObject', lambda obj, existing: added.append(obj))
+
+	shim.handleList({("app.lan", "10.0.0.2")}, {"dns": set(), "cname": set()})
+
+	assert added == [("app.lan", "10.0.0.2")]
@@ -0,0 +1,100 @@
+import sys, types, importlib, json
+
+
+def import_shim_with_docker_stub():
+	sys.modules.pop('shim', None)
+	docker_stub = types.SimpleNamespace(DockerClient=lambda base_url, **kwargs: object())
+	sys.modules['docker'] = docker_stub
+	return importlib.import_module('shim')
+
+
+def get(shim, path):
+	code, contentType, body = shim.httpRoute(path)
+	assert contentType == "application/json"
+	return code, json.loads(body)
+
+
+def test_healthz_fails_once_the_loop_stops_making_progress(monkeypatch):
+	shim = import_shim_with_docker_stub()
+	shim.intervalSeconds = 10
+	shim.healthIntervals = 3
+	now = [1000.0]
+	monkeypatch.setattr(shim.time, "time", lambda: now[0])
+
+	assert get(shim, "/healthz") == (200, {"status": "starting"})
+
+	# Sleeping for the next poll is not a stall
+	shim.beat(60)
+	now[0] += 80
+	assert get(shim, "/healthz")[0] == 200
+
+	now[0] += 20
+	code, body = get(shim, "/healthz")
+	assert code == 503
+	assert body["status"] == "stalled"
+	assert body["secondsSinceProgress"] == 100
+
+
+def test_an_api_call_during_a_long_wait_does_not_shorten_it(monkeypatch):
+	shim = import_shim_with_docker_stub()
+	shim.intervalSeconds = 10
+	shim.healthIntervals = 3
+	now = [1000.0]
+	monkeypatch.setattr(shim.time, "time", lambda: now[0])
+
+	shim.beat(300)
+	now[0] += 10
+	# e.g. the session cleanup thread or a Docker event calling Pi-hole
+	shim.beat()
+	now[0] += 90
+	code, body = get(shim, "/healthz")
+	assert code == 200
+	assert body["secondsSinceProgress"] == 90
+
+	now[0] = 1000.0 + 300 + 31
+	assert get(shim, "/healthz")[0] == 503
+
+
+def test_readyz_reports_why_a_pihole_is_not_ready():
+	shim = import_shim_with_docker_stub()
+
+	code, body = get(shim, "/readyz")
+	assert code == 503
+	assert body["targets"]["default"] == ["not authenticated", "no reconcile yet"]
+
+	shim.moduleTarget.sid = "sid"
+	shim.moduleTarget.apiError = "Connection refused"
+	shim.moduleTarget.backoff.failures = 2
+	shim.moduleTarget.lastReconcile = {"clean": False}
+	code, body = get(shim, "/readyz")
+	assert code == 503
+	assert body["targets"]["default"] == [
+		"unreachable: Connection refused",
+		"2 failed syncs",
+		"last reconcile had failures",
+	]
+
+	shim.moduleTarget.apiError = None
+	shim.moduleTarget.backoff.failures = 0
+	shim.moduleTarget.lastReconcile = {"clean": True}
+	assert get(shim, "/readyz") == (200, {"status": "ready", "role": "leader", "targets": {"default": "ok"}})
+
+
+def test_api_errors_mark_the_pihole_unreachable_until_it_answers(monkeypatch):
+	shim = import_shim_with_docker_stub()
+	shim.moduleTarget.sid = "sid"
+
+	def refuse(*args, **kwargs):
+		raise ConnectionError("refused")
+
+	http = shim.getSession()
+	monkeypatch.setattr(http, "get", refuse)
+	try:
+		shim.apiRequest("dns")
+	except ConnectionError:
+		pass
+	assert shim.moduleTarget.apiError == "refused"
+
+	monkeypatch.setattr(http, "get", lambda *args, **kwargs: types.SimpleNamespace(status_code=200, json=lambda: {"config": {"dns": {"hosts": []}}}))
+	shim.apiRequest("dns")
+	assert shim.moduleTarget.apiError is None
@@ -0,0 +1,94 @@
+import sys, types, importlib
+
+
+def import_shim_with_docker_stub():
+	sys.modules.pop('shim', None)
+	docker_stub = types.SimpleNamespace(DockerClient=lambda base_url, **kwargs: object())
+	sys.modules['docker'] = docker_stub
+	return importlib.import_module('shim')
+
+
+def fake_client(containers, expected_filters):
+	def list_containers(filters=None):
+		assert filters == expected_filters
+		return list(containers)
+	return types.SimpleNamespace(api=types.SimpleNamespace(containers=list_containers))
+
+
+def test_records_are_read_from_numbered_keys_and_traefik_rules():
+	shim = import_shim_with_docker_stub()
+	shim.labelSources = frozenset({"json", "records", "traefik"})
+	labels = {
+		"pihole.custom-record": '[["json.lan", "10.0.0.1"]]',
+		"pihole.record.1.domain": "one.lan",
+		"pihole.record.1.target": "10.0.0.2",
+		"pihole.record.web.domain": "web.lan",
+		"pihole.record.web.target": "one.lan",
+		"traefik.http.routers.app.rule": "Host(`app.example`) || (Host(`api.example`) && PathPrefix(`/v1`))",
+		"traefik.http.routers.app.entrypoints": "web",
+		"pihole.target": "10.0.0.5",
+		"com.example.unrelated": "x",
+	}
+
+	assert shim.parseRecords(labels) == {
+		("json.lan", "10.0.0.1"),
+		("one.lan", "10.0.0.2"),
+		("web.lan", "one.lan"),
+		("app.example", "10.0.0.5"),
+		("api.example", "10.0.0.5"),
+	}
+	assert shim.labelFilters() == {}
+
+
+def test_traefik_hosts_without_a_target_are_reported():
+	shim = import_shim_with_docker_stub()
+	shim.labelSources = frozenset({"traefik"})
+
+	parsed = shim.parseLabels({"traefik.http.routers.app.rule": "Host(`app.example`)"})
+	assert parsed.records == frozenset()
+	assert parsed.errors == ["traefik.http.routers.app.rule: no pihole.target label or TRAEFIK_TARGET for app.example"]
+
+	shim.traefikTarget = "proxy.lan"
+	assert shim.parseRecords({"traefik.http.routers.other.rule": "Host(`app.example`)"}) == {("app.example", "proxy.lan")}
+
+
+def test_malformed_label_only_drops_its_own_container(caplog):
+	shim = import_shim_with_docker_stub()
+	containers = [
+		{"Id": "broken000000", "Labels": {"pihole.custom-record": '[["a.lan", "10.0.0.1"]'}},
+		{"Id": "good00000000", "Labels": {"pihole.custom-record": '[["b.lan", "10.0.0.2"]]', "pihole.priority": "high"}},
+	]
+	cache = {}
+
+	client = fake_client(containers, {"label": "pihole.custom-record"})
+	assert shim.listLabeled(client, cache) == {"good00000000": {("b.lan", "10.0.0.2")}}
+	assert shim.listLabeled(client, cache) == {"good00000000": {("b.lan", "10.0.0.2")}}
+
+	warnings = [record.getMessage() for record in caplog.records if "malformed label" in record.getMessage()]
+	# Reported once per label change, against the offending container
+	assert len(warnings) == 2
+	assert warnings[0].startswith("Container broken000000: ignoring malformed label pihole.custom-record:")
+	assert warnings[1] == "Container good00000000: ignoring malformed label pihole.priority: not a number: high"
+	assert shim.metrics.values[("pihole_shim_label_errors_total", ())] == 2
+
+
+def test_reap_override_of_the_highest_priority_container_applies(monkeypatch):
+	shim = import_shim_with_docker_stub()
+	shim.reapSeconds = 600
+	shim.moduleTarget.store = shim.RecordStore()
+	monkeypatch.setattr(shim, 'flushList', lambda: None)
+	shared = ("shared.lan", "10.0.0.1")
+	cache = {}
+	shim.cachedLabels(cache, "low", {"pihole.custom-record": '[["shared.lan", "10.0.0.1"]]', "pihole.reap-seconds": "3600"})
+	shim.cachedLabels(cache, "high", {"pihole.custom-record": '[["shared.lan", "10.0.0.1"]]', "pihole.reap-seconds": "30", "pihole.priority": "10"})
+	shim.labelOptions = shim.collectOptions([cache])
+	assert shim.labelOptions == {shared: (10, 30)}
+
+	shim.moduleTarget.store.own(shared)
+	shim.applyStarted({shared}, 1000)
+	assert shim.applyStopped("high", {shared}, 1100) == 1130
+	assert shim.moduleTarget.store.reapAt(shared) == 1130
+	# Without an override the global grace period applies
+	other = ("other.lan", "10.0.0.2")
+	shim.moduleTarget.store.own(other)
+	assert shim.applyStopped("plain", {other}, 1100) == 1700
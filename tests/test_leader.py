@@ -0,0 +1,89 @@
+import sys, types, importlib, json
+
+
+def import_shim_with_docker_stub():
+	sys.modules.pop('shim', None)
+	docker_stub = types.SimpleNamespace(DockerClient=lambda base_url, **kwargs: object())
+	sys.modules['docker'] = docker_stub
+	return importlib.import_module('shim')
+
+
+def test_lease_is_held_by_one_replica_until_it_expires():
+	shim = import_shim_with_docker_stub()
+	shared = {}
+	first = shim.Lease("first", 15, shared)
+	second = shim.Lease("second", 15, shared)
+
+	assert first.renew(1000) is True
+	assert second.renew(1005) is False
+	assert first.renew(1010) is True
+	assert second.renew(1020) is False
+	# first stopped renewing at 1010
+	assert second.renew(1026) is True
+	assert second.takenFrom["holder"] == "first"
+	assert first.held(1026) is False
+	assert first.renew(1027) is False
+
+
+def test_file_lease_is_shared_through_the_lease_file(tmp_path):
+	shim = import_shim_with_docker_stub()
+	path = str(tmp_path / "leader.lease")
+	first = shim.FileLease(path, "first", 15)
+	second = shim.FileLease(path, "second", 15)
+
+	assert first.renew(1000) is True
+	assert json.load(open(path)) == {"holder": "first", "expires": 1015, "renewed": 1000}
+	assert second.renew(1010) is False
+	assert second.renew(1016) is True
+	assert second.holderOf() == "second"
+
+
+def test_standby_does_not_write_and_reloads_state_on_takeover(monkeypatch):
+	shim = import_shim_with_docker_stub()
+	shim.moduleTarget.store = shim.RecordStore()
+	shared = {}
+	shim.Lease("first", 15, shared).renew(1000)
+	shim.lease = shim.Lease("second", 15, shared)
+	fetches = []
+	writes = []
+	reloads = []
+	monkeypatch.setattr(shim, 'listExisting', lambda: fetches.append(True) or {"dns": set(), "cname": set()})
+	monkeypatch.setattr(shim, 'apiCall', lambda endpoint_key, payload=None: writes.append(endpoint_key) or (True, None))
+	monkeypatch.setattr(shim, 'readState', lambda: reloads.append(True))
+	monkeypatch.setattr(shim, 'flushList', lambda: True)
+	now = [1005]
+	monkeypatch.setattr(shim.time, "time", lambda: now[0])
+
+	assert shim.renewLease(now[0]) is False
+	summary = shim.reconcile({("app.lan", "10.0.0.1")}, now[0])
+	assert summary["skipped"] is True
+	# Nothing to keep warm without a record cache
+	assert not fetches and not writes
+	shim.recordCacheSeconds = 300
+	shim.reconcile({("app.lan", "10.0.0.1")}, now[0])
+	assert fetches == [True] and not writes
+	assert shim.moduleTarget.recordCache == {"dns": set(), "cname": set()}
+	shim.recordCacheSeconds = 0
+	assert shim.readyStatus()[1]["role"] == "standby"
+
+	now[0] = 1030
+	assert shim.renewLease(now[0]) is True
+	assert shim.metrics.histograms[("pihole_shim_failover_seconds", ())][1] == 30
+	shim.takeOver()
+	assert reloads == [True]
+	shim.reconcile({("app.lan", "10.0.0.1")}, now[0])
+	assert writes == ["createDns"]
+
+
+def test_standby_does_not_keep_returning_past_reap_deadlines():
+	shim = import_shim_with_docker_stub()
+	shim.moduleTarget.store = shim.RecordStore()
+	shim.moduleTarget.store.own(("app.lan", "10.0.0.1"), 100)
+	shim.moduleTarget.store.schedule(("app.lan", "10.0.0.1"), 200)
+	shared = {}
+	shim.Lease("first", 15, shared).renew(1000)
+	shim.lease = shim.Lease("second", 15, shared)
+	assert shim.renewLease(1005) is False
+
+	assert shim.reapOnce() is None
+	assert shim.moduleTarget.store.owned == {("app.lan", "10.0.0.1")}
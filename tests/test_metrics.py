@@ -0,0 +1,65 @@
+import sys, types, importlib, urllib.request
+
+
+def import_shim_with_docker_stub():
+	sys.modules.pop('shim', None)
+	docker_stub = types.SimpleNamespace(DockerClient=lambda base_url, **kwargs: object())
+	sys.modules['docker'] = docker_stub
+	return importlib.import_module('shim')
+
+
+def test_metrics_render_counters_gauges_and_histograms():
+	shim = import_shim_with_docker_stub()
+	registry = shim.Metrics()
+	registry.buckets = (0.1, 1)
+	registry.describe("demo_total", "counter", "Demo counter.")
+	registry.describe("demo_seconds", "histogram", "Demo histogram.")
+	registry.inc("demo_total", 2, endpoint="dns")
+	registry.inc("demo_total", endpoint="dns")
+	registry.observe("demo_seconds", 0.05, phase="a")
+	registry.observe("demo_seconds", 0.5, phase="a")
+
+	text = registry.render()
+	assert 'demo_total{endpoint="dns"} 3' in text
+	assert 'demo_seconds_bucket{phase="a",le="0.1"} 1' in text
+	assert 'demo_seconds_bucket{phase="a",le="1"} 2' in text
+	assert 'demo_seconds_bucket{phase="a",le="+Inf"} 2' in text
+	assert 'demo_seconds_count{phase="a"} 2' in text
+	assert "# TYPE demo_seconds histogram" in text
+
+
+def test_apiCall_records_latency_and_status_by_endpoint_and_is_served(monkeypatch):
+	shim = import_shim_with_docker_stub()
+	shim.metrics = shim.Metrics()
+	shim.metrics.describe("pihole_shim_api_responses_total", "counter", "Responses.")
+	shim.metrics.describe("pihole_shim_api_request_duration_seconds", "histogram", "Latency.")
+
+	class FakeResponse:
+		status_code = 201
+
+	monkeypatch.setattr(shim, 'getSession', lambda: types.SimpleNamespace(put=lambda *a, **k: FakeResponse()))
+	shim.apiCall("createDns", payload="10.0.0.1 a.lan")
+
+	server = shim.startMetricsServer(0)
+	try:
+		url = "http://127.0.0.1:%s/metrics" % server.server_address[1]
+		text = urllib.request.urlopen(url, timeout=5).read().decode()
+	finally:
+		server.shutdown()
+		server.server_close()
+
+	assert 'pihole_shim_api_responses_total{code="201",endpoint="createDns",target="default"} 1' in text
+	assert 'pihole_shim_api_request_duration_seconds_count{endpoint="createDns",target="default"} 1' in text
+
+
+def test_metrics_render_with_numeric_and_text_values_of_one_label():
+	shim = import_shim_with_docker_stub()
+	shim.metrics = shim.Metrics()
+	shim.metrics.describe("pihole_shim_api_responses_total", "counter", "Responses.")
+	shim.metrics.inc("pihole_shim_api_responses_total", endpoint="dns", code=200, target="default")
+	shim.metrics.inc("pihole_shim_api_responses_total", endpoint="dns", code="error", target="default")
+
+	status, contentType, body = shim.httpRoute("/metrics")
+	assert status == 200
+	assert b'pihole_shim_api_responses_total{code="200",endpoint="dns",target="default"} 1' in body
+	assert b'pihole_shim_api_responses_total{code="error",endpoint="dns",target="default"} 1' in body
@@ -0,0 +1,136 @@
+import sys, types, importlib
+
+
+def import_shim_with_docker_stub():
+	sys.modules.pop('shim', None)
+	docker_stub = types.SimpleNamespace(DockerClient=lambda base_url, **kwargs: object())
+	sys.modules['docker'] = docker_stub
+	return importlib.import_module('shim')
+
+
+def make_event(action, container_id, label=None):
+	attributes = {"name": container_id}
+	if label is not None:
+		attributes["pihole.custom-record"] = label
+	return {"Type": "container", "Action": action, "Actor": {"ID": container_id, "Attributes": attributes}}
+
+
+app = ("app.lan", "10.0.0.1")
+label = '[["app.lan", "10.0.0.1"]]'
+
+
+def test_token_bucket_allows_a_burst_then_paces_writes():
+	shim = import_shim_with_docker_stub()
+	shim.writeRatePerSecond = 2
+	shim.writeBurst = 2
+	bucket = shim.TokenBucket()
+
+	assert [bucket.reserve(0) for _ in range(4)] == [0, 0, 0.5, 1.0]
+	# Refilled, but never beyond the burst
+	assert bucket.reserve(100) == 0
+	assert bucket.tokens == 1
+
+	shim.writeRatePerSecond = 0
+	assert bucket.reserve(100) == 0
+
+
+def test_only_writes_wait_for_the_rate_limit(monkeypatch):
+	shim = import_shim_with_docker_stub()
+	shim.writeRatePerSecond = 1
+	shim.writeBurst = 1
+	shim.moduleTarget.writeBucket = shim.TokenBucket()
+	calls = []
+	slept = []
+	monkeypatch.setattr(shim, 'apiRequest', lambda endpointKey, payload=None: calls.append(endpointKey) or (True, {}))
+	monkeypatch.setattr(shim.time, 'monotonic', lambda: 50)
+	monkeypatch.setattr(shim.time, 'sleep', slept.append)
+
+	shim.apiCall("createDns", "10.0.0.1 app.lan")
+	shim.apiCall("dns")
+	shim.apiCall("deleteDns", "10.0.0.1 app.lan")
+
+	assert calls == ["createDns", "dns", "deleteDns"]
+	assert slept == [1.0]
+	assert shim.metrics.values[("pihole_shim_writes_throttled_total", (("target", "default"),))] == 1
+	assert shim.metrics.values[("pihole_shim_write_throttle_seconds_total", (("target", "default"),))] == 1.0
+
+
+def test_a_flapping_container_is_coalesced_within_the_window(monkeypatch):
+	shim = import_shim_with_docker_stub()
+	shim.moduleTarget.store = shim.RecordStore()
+	shim.moduleTarget.mutations = shim.MutationQueue()
+	shim.containerRecords.clear()
+	shim.mutationWindowSeconds = 5
+	clock = [5000]
+	monkeypatch.setattr(shim.time, 'time', lambda: clock[0])
+	monkeypatch.setattr(shim, 'flushList', lambda: None)
+	added = []
+	monkeypatch.setattr(shim, 'addObject', lambda obj, existing: added.append(obj) or shim.moduleTarget.store.own(obj, clock[0]) or True)
+
+	# The add waits for the window
+	assert shim.handleEvent(make_event("start", "c1", label)) == 5005
+	assert added == []
+	assert shim.metrics.values[("pihole_shim_mutation_queue_depth", (("target", "default"),))] == 1
+
+	# Stopped before it was written, nothing is left to do
+	assert shim.handleEvent(make_event("die", "c1", label)) is None
+	assert len(shim.moduleTarget.mutations) == 0
+	assert shim.metrics.values[("pihole_shim_mutations_coalesced_total", (("target", "default"),))] == 1
+
+	shim.handleEvent(make_event("start", "c1", label))
+	clock[0] = 5002
+	shim.handleEvent(make_event("start", "c2", '[["other.lan", "10.0.0.2"]]'))
+	clock[0] = 5005
+	# Both adds are written together when the oldest is due
+	assert shim.reapDue(5005) is None
+	assert added == [app, ("other.lan", "10.0.0.2")]
+	counts, total = shim.metrics.histograms[("pihole_shim_mutation_latency_seconds", (("op", "add"), ("target", "default")))]
+	assert total == 8
+
+
+def test_a_record_labeled_again_cancels_its_queued_removal(monkeypatch):
+	shim = import_shim_with_docker_stub()
+	shim.moduleTarget.store = shim.RecordStore()
+	shim.moduleTarget.mutations = shim.MutationQueue()
+	shim.containerRecords.clear()
+	shim.mutationWindowSeconds = 5
+	shim.moduleTarget.store.own(app, 100)
+	shim.moduleTarget.store.schedule(app, 200)
+	monkeypatch.setattr(shim.time, 'time', lambda: 201)
+	monkeypatch.setattr(shim, 'flushList', lambda: None)
+	monkeypatch.setattr(shim, 'removeObject', lambda obj, existing: (_ for _ in ()).throw(AssertionError("removal should be cancelled")))
+	monkeypatch.setattr(shim, 'addObject', lambda obj, existing: (_ for _ in ()).throw(AssertionError("record is still owned")))
+
+	assert shim.reapDue(201) == 206
+	assert shim.handleEvent(make_event("start", "c1", label)) is None
+	assert shim.reapDue(206) is None
+	assert shim.moduleTarget.store.owned == {app}
+	assert app not in shim.moduleTarget.store.scheduled
+	assert shim.metrics.values[("pihole_shim_mutations_coalesced_total", (("target", "default"),))] == 1
+
+
+def test_queued_changes_are_batched_into_one_patch(monkeypatch):
+	shim = import_shim_with_docker_stub()
+	shim.moduleTarget.store = shim.RecordStore()
+	shim.moduleTarget.mutations = shim.MutationQueue()
+	shim.batchApply = True
+	shim.mutationWindowSeconds = 5
+	gone = ("gone.lan", "10.0.0.9")
+	web = ("web.lan", "app.lan")
+	shim.moduleTarget.store.own(gone, 100)
+	existing = {"dns": {gone}, "cname": set()}
+	calls = []
+	monkeypatch.setattr(shim.time, 'time', lambda: 300)
+	monkeypatch.setattr(shim, 'flushList', lambda: None)
+	monkeypatch.setattr(shim, 'fetchExisting', lambda now: existing)
+	monkeypatch.setattr(shim, 'apiCall', lambda endpointKey, payload=None: calls.append((endpointKey, payload)) or (True, {}))
+
+	shim.moduleTarget.mutations.push("add", app, 300)
+	shim.moduleTarget.mutations.push("add", web, 300)
+	shim.moduleTarget.mutations.push("remove", gone, 300)
+	assert shim.flushMutations(300) == 305
+	assert calls == []
+
+	assert shim.flushMutations(300, force=True) is None
+	assert calls == [("patchConfig", {"config": {"dns": {"hosts": ["10.0.0.1 app.lan"], "cnameRecords": ["web.lan,app.lan"]}}})]
+	assert shim.moduleTarget.store.owned == {app, web}
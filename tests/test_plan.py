@@ -0,0 +1,63 @@
+import sys, types, importlib, json
+
+
+def import_shim_with_docker_stub():
+	sys.modules.pop('shim', None)
+	docker_stub = types.SimpleNamespace(DockerClient=lambda base_url, **kwargs: object())
+	sys.modules['docker'] = docker_stub
+	return importlib.import_module('shim')
+
+
+def setup(shim, monkeypatch):
+	shim.moduleTarget.store = shim.RecordStore()
+	shim.reapSeconds = 100
+	shim.moduleTarget.sid = "sid"
+	kept = ("kept.lan", "10.0.0.1")
+	drifted = ("drifted.lan", "10.0.0.2")
+	stale = ("stale.lan", "10.0.0.3")
+	leaving = ("leaving.lan", "10.0.0.4")
+	shim.moduleTarget.store.own(kept, 1000)
+	shim.moduleTarget.store.own(drifted, 1000)
+	shim.moduleTarget.store.own(stale, 1000)
+	shim.moduleTarget.store.own(leaving, 1950)
+	labeled = {kept, drifted, ("new.lan", "host.lan")}
+	monkeypatch.setattr(shim, 'scanContainers', lambda: set(labeled))
+	monkeypatch.setattr(shim, 'listExisting', lambda: {"dns": {kept, stale, leaving}, "cname": set()})
+	monkeypatch.setattr(shim, 'apiCall', lambda endpoint_key, payload=None: (_ for _ in ()).throw(AssertionError("no API calls when planning")))
+	monkeypatch.setattr(shim, 'flushList', lambda: (_ for _ in ()).throw(AssertionError("no state writes when planning")))
+	monkeypatch.setattr(shim.time, 'time', lambda: 2000)
+
+
+def test_plan_once_reports_changes_counts_and_api_calls_without_writing(monkeypatch):
+	shim = import_shim_with_docker_stub()
+	setup(shim, monkeypatch)
+
+	plan = shim.plan_once()
+
+	target = plan["targets"][0]
+	assert target["add"] == [["new.lan", "host.lan"]]
+	assert target["remove"] == [["stale.lan", "10.0.0.3"]]
+	assert target["sync"] == [["drifted.lan", "10.0.0.2"]]
+	assert target["defer"] == [{"record": ["leaving.lan", "10.0.0.4"], "reapAt": 2050}]
+	assert plan["counts"] == {"add": 1, "remove": 1, "suppressed": 0, "sync": 1, "deferred": 1, "owned": 4}
+	assert plan["apiCalls"] == {"reads": 2, "writes": 3}
+	assert plan["labeled"] == 3
+	json.dumps(plan)
+
+
+def test_main_plan_prints_json_and_skips_session_cleanup(monkeypatch, capsys):
+	shim = import_shim_with_docker_stub()
+	setup(shim, monkeypatch)
+	shim.token = "token"
+	shim.batchApply = True
+	monkeypatch.setattr(shim, 'readState', lambda: None)
+	monkeypatch.setattr(shim, 'restoreSession', lambda: False)
+	monkeypatch.setattr(shim, 'auth', lambda: "sid")
+	monkeypatch.setattr(shim, 'cleanSessions', lambda: (_ for _ in ()).throw(AssertionError("cleanSessions deletes sessions")))
+
+	assert shim.main(["--plan", "--no-remove"]) == 0
+
+	plan = json.loads(capsys.readouterr().out)
+	assert plan["targets"][0]["suppressed"] == [["stale.lan", "10.0.0.3"]]
+	assert plan["targets"][0]["remove"] == []
+	assert plan["apiCalls"] == {"reads": 2, "writes": 1}
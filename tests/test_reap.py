@@ -0,0 +1,49 @@
+import sys, types, importlib
+
+
+def import_shim_with_docker_stub():
+	sys.modules.pop('shim', None)
+	docker_stub = types.SimpleNamespace(DockerClient=lambda base_url, **kwargs: object())
+	sys.modules['docker'] = docker_stub
+	return importlib.import_module('shim')
+
+
+def test_limitReaps_spreads_a_mass_reap_over_the_heap():
+	shim = import_shim_with_docker_stub()
+	shim.moduleTarget.store = shim.RecordStore()
+	shim.reapBurst = 100
+	shim.reapRatePerSecond = 10
+	due = set(("host%03d.lan" % i, "10.0.0.1") for i in range(250))
+	for key in due:
+		shim.moduleTarget.store.own(key)
+
+	now = shim.limitReaps(due, 1000)
+
+	assert len(now) == 100
+	assert shim.moduleTarget.store.nextDeadline() == 1010
+	assert len(shim.moduleTarget.store.due(1010)) == 100
+	assert len(shim.moduleTarget.store.due(1020)) == 50
+
+
+def test_reapDue_removes_at_the_deadline_unless_labeled_again(monkeypatch):
+	shim = import_shim_with_docker_stub()
+	shim.moduleTarget.store = shim.RecordStore()
+	shim.reapSeconds = 60
+	gone = ("gone.lan", "10.0.0.1")
+	back = ("back.lan", "10.0.0.2")
+	shim.moduleTarget.store.own(gone, 100)
+	shim.moduleTarget.store.own(back, 100)
+	removed = []
+	monkeypatch.setattr(shim, 'flushList', lambda: None)
+	monkeypatch.setattr(shim, 'fetchExisting', lambda now: {"dns": {gone, back}, "cname": set()})
+	monkeypatch.setattr(shim, 'addObject', lambda obj, existing: True)
+	monkeypatch.setattr(shim, 'removeObject', lambda obj, existing: removed.append(obj) or shim.moduleTarget.store.disown(obj) or True)
+
+	shim.applyStopped("c1", {gone, back}, 1000)
+	shim.applyStarted({back}, 1030)
+
+	assert shim.reapDue(1059) == 1060
+	assert removed == []
+	assert shim.reapDue(1060) is None
+	assert removed == [gone]
+	assert back in shim.moduleTarget.store
@@ -0,0 +1,75 @@
+import sys, types, importlib
+
+
+def import_shim_with_docker_stub():
+	sys.modules.pop('shim', None)
+	docker_stub = types.SimpleNamespace(DockerClient=lambda base_url, **kwargs: object())
+	sys.modules['docker'] = docker_stub
+	return importlib.import_module('shim')
+
+
+def test_fetchExisting_serves_cache_updated_by_own_writes_until_it_expires(monkeypatch):
+	shim = import_shim_with_docker_stub()
+	shim.recordCacheSeconds = 300
+	shim.moduleTarget.store = shim.RecordStore()
+	fetches = []
+
+	def fake_listExisting():
+		fetches.append(True)
+		return {"dns": {("old.lan", "10.0.0.1")}, "cname": set()}
+
+	monkeypatch.setattr(shim, 'listExisting', fake_listExisting)
+	monkeypatch.setattr(shim, 'apiCall', lambda endpoint_key, payload=None: (True, None))
+
+	existing = shim.fetchExisting(1000)
+	shim.addObject(("new.lan", "host.lan"), existing)
+	shim.removeObject(("old.lan", "10.0.0.1"), existing)
+
+	assert shim.fetchExisting(1200) == {"dns": set(), "cname": {("new.lan", "host.lan")}}
+	assert len(fetches) == 1
+	shim.fetchExisting(1300)
+	assert len(fetches) == 2
+
+
+def test_unexpected_write_results_drop_the_cache(monkeypatch):
+	shim = import_shim_with_docker_stub()
+	shim.recordCacheSeconds = 300
+	shim.moduleTarget.store = shim.RecordStore()
+	monkeypatch.setattr(shim, 'listExisting', lambda: {"dns": {("gone.lan", "10.0.0.2")}, "cname": set()})
+
+	monkeypatch.setattr(shim, 'apiCall', lambda endpoint_key, payload=None: (False, {"error": {"message": "Item already present"}}))
+	assert shim.addObject(("dup.lan", "10.0.0.1"), shim.fetchExisting(1000)) is None
+	assert shim.moduleTarget.recordCache is None
+
+	monkeypatch.setattr(shim, 'apiCall', lambda endpoint_key, payload=None: (False, {"error": {"key": "not_found"}}))
+	assert shim.removeObject(("gone.lan", "10.0.0.2"), shim.fetchExisting(1000)) is False
+	assert shim.moduleTarget.recordCache is None
+
+
+def test_batched_apply_keeps_records_added_outside_the_shim_since_the_cache_refresh(monkeypatch):
+	shim = import_shim_with_docker_stub()
+	shim.recordCacheSeconds = 300
+	shim.batchApply = True
+	shim.moduleTarget.store = shim.RecordStore()
+	shim.moduleTarget.mutations = shim.MutationQueue()
+	pihole = {"dns": {("old.lan", "10.0.0.1")}, "cname": set()}
+	patches = []
+	monkeypatch.setattr(shim, 'listExisting', lambda: {"dns": set(pihole["dns"]), "cname": set(pihole["cname"])})
+	monkeypatch.setattr(shim, 'apiCall', lambda endpoint_key, payload=None: patches.append(payload) or (True, None))
+	monkeypatch.setattr(shim, 'flushList', lambda: None)
+	monkeypatch.setattr(shim.time, 'time', lambda: 1000)
+
+	cached = shim.fetchExisting(1000)
+	# An admin adds a record after the cache was filled
+	pihole["dns"].add(("manual.lan", "10.9.9.9"))
+
+	assert shim.applyBatch({("new.lan", "10.0.0.2")}, set(), cached)
+	assert patches[-1]["config"]["dns"]["hosts"] == ["10.0.0.1 old.lan", "10.0.0.2 new.lan", "10.9.9.9 manual.lan"]
+	assert ("manual.lan", "10.9.9.9") in shim.fetchExisting(1000)["dns"]
+
+	# Queued event changes go through the same batch
+	shim.moduleTarget.mutations.push("add", ("web.lan", "10.0.0.3"), 1000)
+	shim.moduleTarget.mutations.push("add", ("api.lan", "10.0.0.4"), 1000)
+	pihole["dns"] = {("old.lan", "10.0.0.1"), ("new.lan", "10.0.0.2"), ("manual.lan", "10.9.9.9"), ("other.lan", "10.9.9.8")}
+	shim.flushMutations(1000, force=True)
+	assert "10.9.9.8 other.lan" in patches[-1]["config"]["dns"]["hosts"]
@@ -0,0 +1,93 @@
+import sys, types, importlib
+
+
+def import_shim_with_docker_stub():
+	sys.modules.pop('shim', None)
+	docker_stub = types.SimpleNamespace(DockerClient=lambda base_url, **kwargs: object())
+	sys.modules['docker'] = docker_stub
+	return importlib.import_module('shim')
+
+
+def test_store_indexes_owned_records_by_domain_target_and_kind():
+	shim = import_shim_with_docker_stub()
+	store = shim.RecordStore()
+	store.own(("a.lan", "10.0.0.1"), 100)
+	store.own(("b.lan", "10.0.0.1"))
+	store.own(("a.lan", "proxy.lan"))
+	store.seen(("c.lan", "10.0.0.9"), 100)
+
+	assert len(store) == 3
+	assert ("c.lan", "10.0.0.9") not in store
+	assert store.byDomain("a.lan") == {("a.lan", "10.0.0.1"), ("a.lan", "proxy.lan")}
+	assert store.byTarget("10.0.0.1") == {("a.lan", "10.0.0.1"), ("b.lan", "10.0.0.1")}
+	assert store.byKind("CNAME") == {("a.lan", "proxy.lan")}
+
+	store.disown(("a.lan", "proxy.lan"))
+	assert store.byKind("CNAME") == set()
+	assert store.byDomain("a.lan") == {("a.lan", "10.0.0.1")}
+	assert store.lastSeen(("a.lan", "proxy.lan")) is None
+	assert store.lastSeen(("a.lan", "10.0.0.1")) == 100
+
+
+def test_store_reap_heap_pops_only_current_deadlines():
+	shim = import_shim_with_docker_stub()
+	store = shim.RecordStore()
+	early, late, back = ("early.lan", "10.0.0.1"), ("late.lan", "10.0.0.2"), ("back.lan", "10.0.0.3")
+	for key in (early, late, back):
+		store.own(key)
+	store.schedule(early, 100)
+	store.schedule(late, 300)
+	store.schedule(back, 50)
+	store.unschedule(back)
+	# Rescheduling leaves a stale heap entry behind
+	store.schedule(late, 200)
+
+	assert store.nextDeadline() == 100
+	assert store.due(99) == []
+	assert store.due(250) == [early, late]
+	assert store.nextDeadline() is None
+
+
+def test_handleList_cancels_reap_of_relabeled_record(monkeypatch):
+	shim = import_shim_with_docker_stub()
+	shim.moduleTarget.store = shim.RecordStore()
+	shim.reapSeconds = 100
+	rec = ("flappy.lan", "10.0.0.5")
+	shim.moduleTarget.store.own(rec, 1000)
+	existing = {"dns": {rec}, "cname": set()}
+	removed = []
+	monkeypatch.setattr(shim, 'removeObject', lambda obj, existing: removed.append(obj))
+	monkeypatch.setattr(shim, 'flushList', lambda: None)
+
+	monkeypatch.setattr(shim.time, 'time', lambda: 1050)
+	summary = shim.handleList(set(), existing)
+	assert summary["deferred"] == 1
+	assert summary["reapAt"] == 1100
+
+	monkeypatch.setattr(shim.time, 'time', lambda: 1080)
+	summary = shim.handleList({rec}, existing)
+	assert summary["reapAt"] is None
+
+	monkeypatch.setattr(shim.time, 'time', lambda: 1200)
+	shim.handleList({rec}, existing)
+	assert removed == []
+	assert rec in shim.moduleTarget.store
+
+
+def test_plan_forgets_records_that_are_neither_owned_nor_labeled(monkeypatch):
+	shim = import_shim_with_docker_stub()
+	shim.moduleTarget.store = shim.RecordStore()
+	monkeypatch.setattr(shim.time, 'time', lambda: 1000)
+	owned, manual, gone = ("owned.lan", "10.0.0.1"), ("manual.lan", "10.0.0.2"), ("gone.lan", "10.0.0.3")
+	shim.moduleTarget.store.own(owned, 900)
+	for key in (manual, gone):
+		shim.moduleTarget.store.seen(key, 900)
+	existing = {"dns": {owned, manual}, "cname": set()}
+
+	# manual is labeled but Pi-hole already has it, gone lost its label
+	shim.planList({owned, manual}, existing)
+	assert set(shim.moduleTarget.store.records) == {owned, manual}
+
+	shim.planList(set(), existing)
+	assert set(shim.moduleTarget.store.records) == {owned}
+	assert shim.moduleTarget.store.lastSeen(owned) == 900
@@ -0,0 +1,71 @@
+import sys, types, importlib
+
+
+def import_shim_with_docker_stub():
+	sys.modules.pop('shim', None)
+	docker_stub = types.SimpleNamespace(DockerClient=lambda base_url, **kwargs: object())
+	sys.modules['docker'] = docker_stub
+	return importlib.import_module('shim')
+
+
+def quiet(**changes):
+	summary = {"added": 0, "removed": 0, "synced": 0, "failed": 0, "deferred": 0, "reapAt": None}
+	summary.update(changes)
+	return summary
+
+
+def test_scheduler_lengthens_quiet_intervals_and_snaps_back_on_change():
+	shim = import_shim_with_docker_stub()
+	shim.minIntervalSeconds = 10
+	shim.maxIntervalSeconds = 60
+	shim.intervalGrowth = 2
+	scheduler = shim.Scheduler()
+
+	delays = [scheduler.nextDelay(quiet(), 1000) for _ in range(4)]
+	assert delays == [20, 40, 60, 60]
+	assert scheduler.nextDelay(quiet(added=1), 1000) == 10
+	# A due reap is not slept through
+	assert scheduler.nextDelay(quiet(reapAt=1005), 1000) == 5
+
+
+def test_scheduler_defaults_to_fixed_interval():
+	shim = import_shim_with_docker_stub()
+	shim.intervalSeconds = 10
+	scheduler = shim.Scheduler()
+
+	assert [scheduler.nextDelay(quiet(), 1000) for _ in range(3)] == [10, 10, 10]
+
+
+def test_backoff_grows_exponentially_with_jitter_up_to_the_cap(monkeypatch):
+	shim = import_shim_with_docker_stub()
+	shim.backoffBaseSeconds = 10
+	shim.backoffMaxSeconds = 60
+	monkeypatch.setattr(shim.random, 'uniform', lambda low, high: high)
+	backoff = shim.Backoff()
+
+	assert [backoff.failed(0) for _ in range(5)] == [10, 20, 40, 60, 60]
+	assert backoff.until == 60
+	backoff.succeeded()
+	assert backoff.failed(0) == 10
+
+
+def test_failing_pihole_is_skipped_until_its_backoff_ends(monkeypatch):
+	shim = import_shim_with_docker_stub()
+	shim.moduleTarget.backoff = shim.Backoff()
+	shim.backoffBaseSeconds = 30
+	monkeypatch.setattr(shim.random, 'uniform', lambda low, high: high)
+	calls = []
+
+	def fake_reconcile(records, now, allow_remove=True):
+		calls.append(now)
+		raise ConnectionError("pi-hole down")
+
+	monkeypatch.setattr(shim, 'reconcile', fake_reconcile)
+
+	try:
+		shim.reconcileTarget(set(), 1000)
+	except ConnectionError:
+		pass
+	assert shim.reconcileTarget(set(), 1010)["skipped"] is True
+	assert calls == [1000]
+	assert shim.Scheduler().nextDelay(quiet(), 1010) == 20
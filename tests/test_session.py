@@ -0,0 +1,116 @@
+import sys, types, importlib, os, stat, json
+
+
+def import_shim_with_docker_stub():
+	sys.modules.pop('shim', None)
+	docker_stub = types.SimpleNamespace(DockerClient=lambda base_url, **kwargs: object())
+	sys.modules['docker'] = docker_stub
+	return importlib.import_module('shim')
+
+
+class FakeResponse:
+	def __init__(self, status_code, body=None):
+		self.status_code = status_code
+		self.body = body
+
+	def json(self):
+		return self.body
+
+
+class FakePiholeSession:
+	# Accepts only the sids in valid, hands out sid-1, sid-2, ... on login
+	def __init__(self, valid=()):
+		self.valid = set(valid)
+		self.calls = []
+
+	def request(self, method, url, headers):
+		route = url.split("/api", 1)[1]
+		self.calls.append((method, route, headers.get("sid")))
+		if method == "post" and route == "/auth":
+			sid = "sid-%s" % (len([c for c in self.calls if c[:2] == ("post", "/auth")]))
+			self.valid.add(sid)
+			return FakeResponse(200, {"session": {"valid": True, "sid": sid, "validity": 300}})
+		if headers.get("sid") not in self.valid:
+			return FakeResponse(401, {"error": {"key": "unauthorized"}})
+		if route == "/auth":
+			return FakeResponse(200, {"session": {"valid": True, "validity": 300}})
+		return FakeResponse(201)
+
+	def get(self, url, params=None, headers=None, timeout=None):
+		return self.request("get", url, headers)
+
+	def post(self, url, json=None, headers=None, timeout=None):
+		return self.request("post", url, headers)
+
+	def put(self, url, headers=None, timeout=None):
+		return self.request("put", url, headers)
+
+
+def setup(shim, monkeypatch, tmp_path, valid=()):
+	fake = FakePiholeSession(valid)
+	monkeypatch.setattr(shim, 'getSession', lambda: fake)
+	shim.moduleTarget.piholeAPI = "http://pi.hole/api"
+	shim.moduleTarget.statePath = str(tmp_path / "pihole.state")
+	shim.moduleTarget.token = "secret"
+	shim.moduleTarget.sid = None
+	shim.moduleTarget.sessionValidity = None
+	shim.moduleTarget.sessionExpires = None
+	return fake
+
+
+def test_login_persists_session_privately_and_restart_reuses_it(monkeypatch, tmp_path):
+	shim = import_shim_with_docker_stub()
+	fake = setup(shim, monkeypatch, tmp_path)
+
+	assert shim.login() == "sid-1"
+	path = tmp_path / "pihole.state.session"
+	assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+	assert json.loads(path.read_text())["sid"] == "sid-1"
+
+	shim.moduleTarget.sid = None
+	assert shim.restoreSession() is True
+	assert shim.moduleTarget.sid == "sid-1"
+	assert fake.calls[-1] == ("get", "/auth", "sid-1")
+
+
+def test_restoreSession_rejects_expired_or_foreign_sessions(monkeypatch, tmp_path):
+	shim = import_shim_with_docker_stub()
+	fake = setup(shim, monkeypatch, tmp_path)
+	path = tmp_path / "pihole.state.session"
+
+	path.write_text(json.dumps({"api": "http://other/api", "sid": "sid-x"}))
+	assert shim.restoreSession() is False
+	assert fake.calls == []
+
+	path.write_text(json.dumps({"api": "http://pi.hole/api", "sid": "gone"}))
+	assert shim.restoreSession() is False
+	assert shim.moduleTarget.sid is None
+
+
+def test_apiCall_logs_in_again_and_retries_once_on_401(monkeypatch, tmp_path):
+	shim = import_shim_with_docker_stub()
+	fake = setup(shim, monkeypatch, tmp_path)
+	shim.moduleTarget.sid = "expired"
+
+	success, _ = shim.apiCall("createDns", payload="10.0.0.1 a.lan")
+
+	assert success is True
+	assert shim.moduleTarget.sid == "sid-1"
+	assert [call[:2] for call in fake.calls] == [("put", "/config/dns/hosts/10.0.0.1 a.lan"), ("post", "/auth"), ("put", "/config/dns/hosts/10.0.0.1 a.lan")]
+
+
+def test_apiCall_refreshes_session_before_it_lapses(monkeypatch, tmp_path):
+	shim = import_shim_with_docker_stub()
+	fake = setup(shim, monkeypatch, tmp_path, valid={"live"})
+	shim.moduleTarget.sid = "live"
+	shim.moduleTarget.sessionValidity = 300
+	shim.sessionRefreshSeconds = 60
+	monkeypatch.setattr(shim.time, 'time', lambda: 1000)
+	shim.moduleTarget.sessionExpires = 1030
+
+	success, _ = shim.apiCall("createDns", payload="10.0.0.1 a.lan")
+
+	assert success is True
+	assert [call[:2] for call in fake.calls] == [("get", "/auth"), ("put", "/config/dns/hosts/10.0.0.1 a.lan")]
+	assert shim.moduleTarget.sid == "live"
+	assert shim.moduleTarget.sessionExpires == 1300
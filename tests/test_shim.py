@@ -6,7 +6,7 @@ def import_shim_with_docker_stub():
 	# Ensure fresh import each time for isolated globals
 	sys.modules.pop('shim', None)
 	# Provide a minimal docker stub so importing shim doesn't require docker SDK
-	docker_stub = types.SimpleNamespace(DockerClient=lambda base_url: object())
+	docker_stub = types.SimpleNamespace(DockerClient=lambda base_url, **kwargs: object())
 	sys.modules['docker'] = docker_stub
 	return importlib.import_module('shim')
 
@@ -23,8 +23,7 @@ def test_ipTest_ipv4_true_and_invalid_false():
 
 def test_addObject_uses_createDns_for_ip_and_formats_payload(monkeypatch):
 	shim = import_shim_with_docker_stub()
-	shim.globalList = set()
-	shim.globalLastSeen = {}
+	shim.moduleTarget.store = shim.RecordStore()
 
 	captured = {}
 
@@ -42,15 +41,14 @@ def test_addObject_uses_createDns_for_ip_and_formats_payload(monkeypatch):
 
 	assert captured['endpoint_key'] == 'createDns'
 	assert captured['payload'] == '10.0.0.11 speedtest.example.com'
-	assert obj in shim.globalList
-	assert obj in shim.globalLastSeen
-	assert isinstance(shim.globalLastSeen[obj], int)
+	assert obj in shim.moduleTarget.store
+	assert shim.moduleTarget.store.lastSeen(obj) is not None
+	assert isinstance(shim.moduleTarget.store.lastSeen(obj), int)
 
 
 def test_addObject_uses_createCname_for_hostname_and_formats_payload(monkeypatch):
 	shim = import_shim_with_docker_stub()
-	shim.globalList = set()
-	shim.globalLastSeen = {}
+	shim.moduleTarget.store = shim.RecordStore()
 
 	captured = {}
 
@@ -68,9 +66,9 @@ def test_addObject_uses_createCname_for_hostname_and_formats_payload(monkeypatch
 
 	assert captured['endpoint_key'] == 'createCname'
 	assert captured['payload'] == 'alias.lan,app.lan'
-	assert obj in shim.globalList
-	assert obj in shim.globalLastSeen
-	assert isinstance(shim.globalLastSeen[obj], int)
+	assert obj in shim.moduleTarget.store
+	assert shim.moduleTarget.store.lastSeen(obj) is not None
+	assert isinstance(shim.moduleTarget.store.lastSeen(obj), int)
 
 
 def test_listExisting_parses_dns_and_cname_sets(monkeypatch):
@@ -101,7 +99,7 @@ def test_listExisting_parses_dns_and_cname_sets(monkeypatch):
 
 def test_removeObject_calls_delete_for_ip_and_cname(monkeypatch):
 	shim = import_shim_with_docker_stub()
-	shim.globalList = set()
+	shim.moduleTarget.store = shim.RecordStore()
 
 	calls = []
 
@@ -113,20 +111,20 @@ def test_removeObject_calls_delete_for_ip_and_cname(monkeypatch):
 
 	# IP/A record deletion
 	ip_obj = ("host.lan", "10.0.0.9")
-	shim.globalList.add(ip_obj)
+	shim.moduleTarget.store.own(ip_obj)
 	existing = {"dns": {ip_obj}, "cname": set()}
 	shim.removeObject(ip_obj, existing)
 	assert ("deleteDns", "10.0.0.9 host.lan") in calls
-	assert ip_obj not in shim.globalList
+	assert ip_obj not in shim.moduleTarget.store
 
 	# CNAME deletion
 	calls.clear()
 	cname_obj = ("alias.lan", "app.lan")
-	shim.globalList.add(cname_obj)
+	shim.moduleTarget.store.own(cname_obj)
 	existing2 = {"dns": set(), "cname": {cname_obj}}
 	shim.removeObject(cname_obj, existing2)
 	assert ("deleteCname", "alias.lan,app.lan") in calls
-	assert cname_obj not in shim.globalList
+	assert cname_obj not in shim.moduleTarget.store
 
 
 def test_main_run_once_calls_sync_once_and_exits(monkeypatch):
@@ -164,3 +162,69 @@ def test_main_run_once_no_remove_sets_allow_remove_false(monkeypatch):
 	assert rc == 0
 	assert called == [False]
 
+
+
+def test_getSession_is_pooled_and_reused():
+	shim = import_shim_with_docker_stub()
+	shim.httpPoolSize = 4
+
+	first = shim.getSession()
+	assert shim.getSession() is first
+	adapter = first.get_adapter("http://pi.hole/api")
+	assert adapter._pool_maxsize == 4
+	assert first.headers["User-Agent"] == "docker-pihole-dns-shim"
+
+
+def test_apiCall_uses_session_with_timeout(monkeypatch):
+	shim = import_shim_with_docker_stub()
+	shim.moduleTarget.piholeAPI = "http://pi.hole/api"
+	shim.moduleTarget.sid = "abc"
+	shim.httpTimeoutSeconds = 3
+
+	captured = {}
+
+	class FakeResponse:
+		status_code = 201
+
+	class FakeSession:
+		def put(self, url, headers=None, timeout=None):
+			captured.update(url=url, headers=headers, timeout=timeout)
+			return FakeResponse()
+
+	monkeypatch.setattr(shim, 'getSession', lambda: FakeSession())
+
+	success, result = shim.apiCall("createDns", payload="10.0.0.1 a.lan")
+
+	assert success is True
+	assert captured == {"url": "http://pi.hole/api/config/dns/hosts/10.0.0.1 a.lan", "headers": {"sid": "abc"}, "timeout": 3}
+
+
+def test_recordKind_classifies_ipv4_ipv6_and_hostnames():
+	shim = import_shim_with_docker_stub()
+
+	assert shim.recordKind('10.0.0.11') == "A"
+	assert shim.recordKind('2001:db8::1') == "AAAA"
+	assert shim.recordKind('host.lan') == "CNAME"
+	# Legacy short IPv4 forms are neither addresses nor hostnames
+	assert shim.recordKind('10.1') is None
+	assert shim.recordKind('-bad-.lan') is None
+	assert shim.ipTest('2001:db8::1') == (True, '2001:db8::1')
+
+
+def test_parseRecords_drops_malformed_entries_only():
+	shim = import_shim_with_docker_stub()
+	label = '[["v6.lan", "fd00::5"], ["ok.lan", "target.lan"], ["short.lan", "10.1"], ["bad domain", "10.0.0.1"], ["too", "many", "items"]]'
+
+	assert shim.parseRecords({shim.labelKey: label}) == {("v6.lan", "fd00::5"), ("ok.lan", "target.lan")}
+
+
+def test_addObject_routes_aaaa_records_to_hosts(monkeypatch):
+	shim = import_shim_with_docker_stub()
+	shim.moduleTarget.store = shim.RecordStore()
+	calls = []
+	monkeypatch.setattr(shim, 'apiCall', lambda endpoint_key, payload=None: calls.append((endpoint_key, payload)) or (True, None))
+
+	assert shim.addObject(("v6.lan", "fd00::5"), {"dns": set(), "cname": set()}) is True
+
+	assert calls == [("createDns", "fd00::5 v6.lan")]
+	assert shim.moduleTarget.store.byKind("AAAA") == {("v6.lan", "fd00::5")}
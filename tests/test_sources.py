@@ -0,0 +1,66 @@
+import sys, types, importlib
+
+
+def import_shim_with_docker_stub():
+	sys.modules.pop('shim', None)
+	docker_stub = types.SimpleNamespace(DockerClient=lambda base_url, **kwargs: object())
+	sys.modules['docker'] = docker_stub
+	return importlib.import_module('shim')
+
+
+class FakeDocker:
+	def __init__(self, containers):
+		self.api = types.SimpleNamespace(containers=self.list)
+		self.items = containers
+		self.down = False
+
+	def list(self, filters=None):
+		if self.down:
+			raise ConnectionError("host down")
+		return [{"Id": cid, "Labels": {"pihole.custom-record": label}} for cid, label in self.items]
+
+
+def test_buildSources_names_tcp_and_unix_endpoints():
+	shim = import_shim_with_docker_stub()
+	assert shim.buildSources("unix://var/run/docker.sock") == []
+	sources = shim.buildSources("unix://var/run/docker.sock,tcp://10.0.0.5:2375")
+	assert [(s.name, s.url) for s in sources] == [
+		("var_run_docker.sock", "unix://var/run/docker.sock"),
+		("10.0.0.5_2375", "tcp://10.0.0.5:2375"),
+	]
+
+
+def test_scanSources_merges_with_provenance_and_holds_unreachable_hosts():
+	shim = import_shim_with_docker_stub()
+	shim.dockerSources = shim.buildSources("tcp://a:2375,tcp://b:2375")
+	a, b = shim.dockerSources
+	a.client = FakeDocker([("c1", '[["shared.lan", "10.0.0.1"], ["a.lan", "10.0.0.2"]]')])
+	b.client = FakeDocker([("c1", '[["shared.lan", "10.0.0.1"]]'), ("c2", '[["b.lan", "10.0.0.3"]]')])
+
+	records, complete = shim.scanSources()
+	assert complete is True
+	assert records == {("shared.lan", "10.0.0.1"), ("a.lan", "10.0.0.2"), ("b.lan", "10.0.0.3")}
+	assert shim.recordSources[("shared.lan", "10.0.0.1")] == {"a_2375", "b_2375"}
+	assert set(shim.containerRecords) == {"a_2375/c1", "b_2375/c1", "b_2375/c2"}
+
+	# b goes away: its records from the last scan are held
+	b.client.down = True
+	held, complete = shim.scanSources()
+	assert complete is True
+	assert held == records
+	assert b.client is None
+
+
+def test_sync_once_holds_removals_while_a_host_was_never_scanned(monkeypatch):
+	shim = import_shim_with_docker_stub()
+	shim.dockerSources = shim.buildSources("tcp://a:2375,tcp://b:2375")
+	a, b = shim.dockerSources
+	a.client = FakeDocker([("c1", '[["a.lan", "10.0.0.2"]]')])
+	b.client = FakeDocker([])
+	b.client.down = True
+
+	seen = {}
+	monkeypatch.setattr(shim, 'reconcile', lambda records, now, allow_remove=True: seen.update(records=records, allow_remove=allow_remove) or {})
+
+	shim.sync_once()
+	assert seen == {"records": {("a.lan", "10.0.0.2")}, "allow_remove": False}
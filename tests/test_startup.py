@@ -0,0 +1,55 @@
+import sys, types, importlib, os, subprocess, time
+
+
+def import_shim_with_docker_stub():
+	sys.modules.pop('shim', None)
+	docker_stub = types.SimpleNamespace(DockerClient=lambda base_url, **kwargs: object())
+	sys.modules['docker'] = docker_stub
+	return importlib.import_module('shim')
+
+
+def test_importing_the_shim_needs_neither_docker_nor_requests():
+	code = "import sys; sys.modules['docker'] = None; import shim; assert shim.client is None; assert 'requests' not in sys.modules"
+	root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+	subprocess.run([sys.executable, "-c", code], cwd=root, check=True)
+
+
+def test_startup_loads_state_connects_and_lists_containers_concurrently(monkeypatch):
+	shim = import_shim_with_docker_stub()
+
+	def slow(result):
+		def fn(*args):
+			time.sleep(0.2)
+			return result
+		return fn
+
+	def fake_startSession():
+		time.sleep(0.2)
+		shim.moduleTarget.sid = "sid"
+		return True
+
+	monkeypatch.setattr(shim, 'readState', slow(None))
+	monkeypatch.setattr(shim, 'startSession', fake_startSession)
+	monkeypatch.setattr(shim, 'scanLabels', slow(({("app.lan", "10.0.0.1")}, True)))
+
+	started = time.perf_counter()
+	assert shim.startup(True, True) is True
+	assert time.perf_counter() - started < 0.5
+	assert shim.startupLabels == ({("app.lan", "10.0.0.1")}, True)
+	assert shim.cleanupPending == [shim.moduleTarget]
+
+
+def test_first_sync_uses_startup_listing_and_cleans_sessions_after_it(monkeypatch):
+	shim = import_shim_with_docker_stub()
+	shim.startupLabels = ({("app.lan", "10.0.0.1")}, False)
+	shim.cleanupPending = [shim.moduleTarget]
+	order = []
+	monkeypatch.setattr(shim, 'scanContainers', lambda: order.append("scan") or set())
+	monkeypatch.setattr(shim, 'reconcileTarget', lambda records, now, allow_remove=True: order.append(("sync", len(records), allow_remove)) or {})
+	monkeypatch.setattr(shim, 'cleanSessions', lambda: order.append("cleanup"))
+
+	shim.sync_once()
+	shim.cleanupThread.join()
+	shim.sync_once()
+
+	assert order == [("sync", 1, False), "cleanup", "scan", ("sync", 0, True)]
@@ -5,7 +5,7 @@ def import_shim_with_docker_stub():
 	# Fresh import for clean globals
 	sys.modules.pop('shim', None)
 	# Minimal docker stub to satisfy import
-	docker_stub = types.SimpleNamespace(DockerClient=lambda base_url: object())
+	docker_stub = types.SimpleNamespace(DockerClient=lambda base_url, **kwargs: object())
 	sys.modules['docker'] = docker_stub
 	return importlib.import_module('shim')
 
@@ -14,8 +14,7 @@ def test_readState_parses_legacy_list_format(tmp_path, monkeypatch):
 	shim = import_shim_with_docker_stub()
 	# Freeze time so last_seen is deterministic
 	monkeypatch.setattr(shim.time, 'time', lambda: 1700000000)
-	shim.globalList = set()
-	shim.globalLastSeen = {}
+	shim.moduleTarget.store = shim.RecordStore()
 
 	state_file = tmp_path / 'pihole.state'
 	legacy = [
@@ -23,21 +22,20 @@ def test_readState_parses_legacy_list_format(tmp_path, monkeypatch):
 		["alias.lan", "app.lan"],
 	]
 	state_file.write_text(json.dumps(legacy))
-	shim.statePath = str(state_file)
+	shim.moduleTarget.statePath = str(state_file)
 
 	shim.readState()
 
 	expected = {("example.lan", "10.0.0.1"), ("alias.lan", "app.lan")}
-	assert shim.globalList == expected
+	assert shim.moduleTarget.store.owned == expected
 	for tup in expected:
-		assert shim.globalLastSeen.get(tup) == 1700000000
+		assert shim.moduleTarget.store.lastSeen(tup) == 1700000000
 
 
 def test_readState_parses_v1_owned_sets_last_seen_now(tmp_path, monkeypatch):
 	shim = import_shim_with_docker_stub()
 	monkeypatch.setattr(shim.time, 'time', lambda: 1800000000)
-	shim.globalList = set()
-	shim.globalLastSeen = {}
+	shim.moduleTarget.store = shim.RecordStore()
 
 	state_file = tmp_path / 'pihole.state'
 	v1 = {
@@ -45,20 +43,19 @@ def test_readState_parses_v1_owned_sets_last_seen_now(tmp_path, monkeypatch):
 		"owned": [["v1.lan", "10.0.0.2"], ["v1alias.lan", "v1target.lan"]],
 	}
 	state_file.write_text(json.dumps(v1))
-	shim.statePath = str(state_file)
+	shim.moduleTarget.statePath = str(state_file)
 
 	shim.readState()
 
 	expected = {("v1.lan", "10.0.0.2"), ("v1alias.lan", "v1target.lan")}
-	assert shim.globalList == expected
+	assert shim.moduleTarget.store.owned == expected
 	for tup in expected:
-		assert shim.globalLastSeen.get(tup) == 1800000000
+		assert shim.moduleTarget.store.lastSeen(tup) == 1800000000
 
 
 def test_readState_parses_v2_owned_and_last_seen(tmp_path):
 	shim = import_shim_with_docker_stub()
-	shim.globalList = set()
-	shim.globalLastSeen = {}
+	shim.moduleTarget.store = shim.RecordStore()
 
 	state_file = tmp_path / 'pihole.state'
 	v2 = {
@@ -67,13 +64,13 @@ def test_readState_parses_v2_owned_and_last_seen(tmp_path):
 		"last_seen": [["v2.lan", "10.0.0.3", 1900000000]],
 	}
 	state_file.write_text(json.dumps(v2))
-	shim.statePath = str(state_file)
+	shim.moduleTarget.statePath = str(state_file)
 
 	shim.readState()
 
-	assert shim.globalList == {("v2.lan", "10.0.0.3"), ("v2alias.lan", "v2target.lan")}
-	assert shim.globalLastSeen.get(("v2.lan", "10.0.0.3")) == 1900000000
+	assert shim.moduleTarget.store.owned == {("v2.lan", "10.0.0.3"), ("v2alias.lan", "v2target.lan")}
+	assert shim.moduleTarget.store.lastSeen(("v2.lan", "10.0.0.3")) == 1900000000
 	# Entry without last_seen provided should be absent from map
-	assert ("v2alias.lan", "v2target.lan") not in shim.globalLastSeen
+	assert shim.moduleTarget.store.lastSeen(("v2alias.lan", "v2target.lan")) is None
 
 
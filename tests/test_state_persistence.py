@@ -0,0 +1,121 @@
+import sys, types, importlib, json, os
+
+
+def import_shim_with_docker_stub():
+	sys.modules.pop('shim', None)
+	docker_stub = types.SimpleNamespace(DockerClient=lambda base_url, **kwargs: object())
+	sys.modules['docker'] = docker_stub
+	return importlib.import_module('shim')
+
+
+def fresh_shim(tmp_path, monkeypatch, now):
+	shim = import_shim_with_docker_stub()
+	shim.moduleTarget.store = shim.RecordStore()
+	shim.moduleTarget.statePath = str(tmp_path / 'pihole.state')
+	monkeypatch.setattr(shim.time, 'time', lambda: now[0])
+	return shim
+
+
+def test_flushList_writes_atomically_and_only_when_changed(tmp_path, monkeypatch):
+	now = [1000]
+	shim = fresh_shim(tmp_path, monkeypatch, now)
+	shim.lastSeenResolution = 60
+	rec = ("app.lan", "10.0.0.1")
+	shim.moduleTarget.store.own(rec, 1000)
+
+	assert shim.flushList() is True
+	assert os.listdir(tmp_path) == ['pihole.state']
+	state = json.loads((tmp_path / 'pihole.state').read_text())
+	assert state["owned"] == [["app.lan", "10.0.0.1"]]
+	# A labeled record follows the shared labeled_at
+	assert state["last_seen"] == []
+	assert state["labeled_at"] == 1000
+
+	# labeled_at moves within the resolution are not written
+	now[0] = 1030
+	shim.moduleTarget.store.seen(rec, 1030)
+	assert shim.flushList() is False
+
+	now[0] = 1060
+	shim.moduleTarget.store.seen(rec, 1060)
+	assert shim.flushList() is True
+	assert json.loads((tmp_path / 'pihole.state').read_text())["labeled_at"] == 1060
+
+	# A record that stopped being labeled keeps its exact last_seen, which no longer moves
+	shim.moduleTarget.store.seen(rec, 1070)
+	shim.moduleTarget.store.schedule(rec, 1370)
+	now[0] = 1080
+	assert shim.flushList() is True
+	state = json.loads((tmp_path / 'pihole.state').read_text())
+	assert state["last_seen"] == [["app.lan", "10.0.0.1", 1070]]
+	now[0] = 1200
+	assert shim.flushList() is False
+
+
+def test_labeled_records_do_not_rewrite_the_state_as_time_passes(tmp_path, monkeypatch):
+	now = [1000]
+	shim = fresh_shim(tmp_path, monkeypatch, now)
+	shim.stateJournal = True
+	shim.stateCompactEntries = 100
+	shim.lastSeenResolution = 60
+	records = [("app%d.lan" % i, "10.0.0.%d" % i) for i in range(50)]
+	for rec in records:
+		shim.moduleTarget.store.own(rec, 1000)
+	shim.flushList()
+
+	# Ten minutes of sync cycles every ten seconds
+	for now[0] in range(1010, 1610, 10):
+		for rec in records:
+			shim.moduleTarget.store.seen(rec, now[0])
+		shim.flushList()
+
+	# One small entry per resolution, not one per record
+	journal = [json.loads(line) for line in (tmp_path / 'pihole.state.journal').read_text().splitlines()]
+	assert journal[1:] == [["labeled_at", ts] for ts in range(1060, 1610, 60)]
+
+	restarted = fresh_shim(tmp_path, monkeypatch, now)
+	restarted.readState()
+	assert restarted.moduleTarget.store.owned == set(records)
+	assert restarted.moduleTarget.store.lastSeen(records[0]) == 1600
+
+
+def test_journal_appends_changes_and_replays_on_startup(tmp_path, monkeypatch):
+	now = [1000]
+	shim = fresh_shim(tmp_path, monkeypatch, now)
+	shim.stateJournal = True
+	shim.stateCompactEntries = 3
+	first = ("first.lan", "10.0.0.1")
+	second = ("second.lan", "10.0.0.2")
+	third = ("third.lan", "10.0.0.3")
+	shim.moduleTarget.store.own(first, 1000)
+	shim.flushList()
+
+	now[0] = 1010
+	shim.moduleTarget.store.own(second, 1010)
+	shim.moduleTarget.store.disown(first)
+	shim.flushList()
+
+	journal = (tmp_path / 'pihole.state.journal').read_text().splitlines()
+	assert [json.loads(line)[0] for line in journal] == ["generation", "own", "drop"]
+	assert json.loads((tmp_path / 'pihole.state').read_text())["owned"] == [["first.lan", "10.0.0.1"]]
+
+	# Simulate a torn write of the last entry after a crash
+	with open(tmp_path / 'pihole.state.journal', 'a') as journal_file:
+		journal_file.write('["own","torn.lan"')
+
+	restarted = fresh_shim(tmp_path, monkeypatch, now)
+	restarted.stateJournal = True
+	restarted.stateCompactEntries = 3
+	restarted.readState()
+	assert restarted.moduleTarget.store.owned == {second}
+	# Labeled records were last written as labeled as of 1000
+	assert restarted.moduleTarget.store.lastSeen(second) == 1000
+
+	# Exceeding the compaction threshold rewrites the snapshot and drops the journal
+	restarted.moduleTarget.store.own(first, 1020)
+	restarted.moduleTarget.store.own(third, 1020)
+	restarted.flushList()
+	assert not os.path.exists(tmp_path / 'pihole.state.journal')
+	assert json.loads((tmp_path / 'pihole.state').read_text())["owned"] == [
+		["first.lan", "10.0.0.1"], ["second.lan", "10.0.0.2"], ["third.lan", "10.0.0.3"],
+	]
@@ -0,0 +1,112 @@
+import sys, types, importlib
+
+
+def import_shim_with_docker_stub():
+	sys.modules.pop('shim', None)
+	docker_stub = types.SimpleNamespace(DockerClient=lambda base_url, **kwargs: object())
+	sys.modules['docker'] = docker_stub
+	return importlib.import_module('shim')
+
+
+def fake_client(containers):
+	def list_containers(filters=None):
+		assert filters == {"label": "pihole.custom-record"}
+		return list(containers)
+	return types.SimpleNamespace(api=types.SimpleNamespace(containers=list_containers))
+
+
+def fake_container(container_id, label):
+	return {"Id": container_id, "Labels": {"pihole.custom-record": label}}
+
+
+def setup_shim(monkeypatch, containers, now):
+	shim = import_shim_with_docker_stub()
+	shim.moduleTarget.store = shim.RecordStore()
+	shim.client = fake_client(containers)
+	monkeypatch.setattr(shim.time, 'time', lambda: now[0])
+
+	fetches = []
+
+	def fake_listExisting():
+		fetches.append(now[0])
+		return {"dns": set(shim.moduleTarget.store.owned), "cname": set()}
+
+	def fake_addObject(obj, existing):
+		shim.moduleTarget.store.own(obj)
+		return True
+
+	monkeypatch.setattr(shim, 'listExisting', fake_listExisting)
+	monkeypatch.setattr(shim, 'addObject', fake_addObject)
+	monkeypatch.setattr(shim, 'flushList', lambda: None)
+	return shim, fetches
+
+
+def test_sync_once_skips_unchanged_reconcile_until_stale(monkeypatch):
+	now = [1000]
+	containers = [fake_container("c1", '[["app.lan", "10.0.0.1"]]')]
+	shim, fetches = setup_shim(monkeypatch, containers, now)
+	shim.maxStaleSeconds = 60
+
+	first = shim.sync_once()
+	assert first["added"] == 1
+	assert fetches == [1000]
+
+	now[0] = 1010
+	second = shim.sync_once()
+	assert second.get("skipped") is True
+	assert fetches == [1000]
+
+	# Max staleness forces a full reconcile
+	now[0] = 1070
+	third = shim.sync_once()
+	assert "skipped" not in third
+	assert fetches == [1000, 1070]
+
+
+def test_sync_once_reconciles_when_labels_change(monkeypatch):
+	now = [1000]
+	containers = [fake_container("c1", '[["app.lan", "10.0.0.1"]]')]
+	shim, fetches = setup_shim(monkeypatch, containers, now)
+	shim.maxStaleSeconds = 600
+
+	shim.sync_once()
+	containers.append(fake_container("c2", '[["other.lan", "10.0.0.2"]]'))
+	now[0] = 1010
+	summary = shim.sync_once()
+
+	assert summary["added"] == 1
+	assert fetches == [1000, 1010]
+	assert ("other.lan", "10.0.0.2") in shim.moduleTarget.store
+
+
+def test_sync_once_without_max_stale_always_reconciles(monkeypatch):
+	now = [1000]
+	shim, fetches = setup_shim(monkeypatch, [fake_container("c1", '[["app.lan", "10.0.0.1"]]')], now)
+	shim.maxStaleSeconds = 0
+
+	shim.sync_once()
+	shim.sync_once()
+
+	assert fetches == [1000, 1000]
+
+
+def test_listLabeled_reuses_parsed_labels_and_drops_gone_containers(monkeypatch):
+	shim = import_shim_with_docker_stub()
+	containers = [fake_container("c1", '[["app.lan", "10.0.0.1"]]'), fake_container("c2", '[["b.lan", "10.0.0.2"]]')]
+	cache = {}
+
+	parsed = []
+	real_parse = shim.parseLabelItems
+	monkeypatch.setattr(shim, 'parseLabelItems', lambda items: parsed.append(items) or real_parse(items))
+
+	first = shim.listLabeled(fake_client(containers), cache)
+	assert first == {"c1": {("app.lan", "10.0.0.1")}, "c2": {("b.lan", "10.0.0.2")}}
+	assert len(parsed) == 2
+
+	containers[1] = fake_container("c2", '[["b.lan", "10.0.0.20"]]')
+	del containers[0]
+	second = shim.listLabeled(fake_client(containers), cache)
+	assert second == {"c2": {("b.lan", "10.0.0.20")}}
+	# Only the changed label was parsed again, the gone container left the cache
+	assert len(parsed) == 3
+	assert set(cache) == {"c2"}
@@ -0,0 +1,63 @@
+import sys, types, importlib, threading
+
+
+def import_shim_with_docker_stub():
+	sys.modules.pop('shim', None)
+	docker_stub = types.SimpleNamespace(DockerClient=lambda base_url, **kwargs: object())
+	sys.modules['docker'] = docker_stub
+	return importlib.import_module('shim')
+
+
+def test_buildTargets_single_api_keeps_module_globals():
+	shim = import_shim_with_docker_stub()
+	assert shim.buildTargets("http://pi.hole:8080/api", "token", "/state/pihole.state") == []
+
+
+def test_buildTargets_splits_apis_tokens_and_state_files():
+	shim = import_shim_with_docker_stub()
+	targets = shim.buildTargets("http://pi1.lan:8080/api, https://pi2.lan/api", "one,two", "/state/pihole.state")
+	assert [(t.name, t.piholeAPI, t.token, t.statePath) for t in targets] == [
+		("pi1.lan_8080", "http://pi1.lan:8080/api", "one", "/state/pihole.state.pi1.lan_8080"),
+		("pi2.lan", "https://pi2.lan/api", "two", "/state/pihole.state.pi2.lan"),
+	]
+
+	shared = shim.buildTargets("http://pi1.lan/api,http://pi2.lan/api", "a,b,c", "/state/s")
+	assert [t.token for t in shared] == ["a,b,c", "a,b,c"]
+
+
+def test_sync_once_fans_out_and_a_slow_pihole_does_not_stall_the_others(tmp_path, monkeypatch):
+	shim = import_shim_with_docker_stub()
+	shim.targets = shim.buildTargets("http://fast.lan/api,http://slow.lan/api", "token", str(tmp_path / "pihole.state"))
+	for pihole in shim.targets:
+		pihole.sid = "sid-%s" % pihole.name
+	shim.targetTimeoutSeconds = 0.2
+	label = '[["app.lan", "10.0.0.1"]]'
+	shim.client = types.SimpleNamespace(api=types.SimpleNamespace(
+		containers=lambda filters=None: [{"Id": "c1", "Labels": {"pihole.custom-record": label}}]))
+
+	release = threading.Event()
+	calls = []
+
+	def fake_api_call(endpoint_key, payload=None):
+		pihole = shim.currentTarget()
+		if pihole.name == "slow.lan":
+			release.wait(5)
+		calls.append((pihole.name, endpoint_key, payload))
+		if endpoint_key in ("dns", "cname"):
+			return True, []
+		return True, None
+
+	monkeypatch.setattr(shim, 'apiCall', fake_api_call)
+
+	try:
+		summary = shim.sync_once()
+		assert summary["added"] == 1
+		fast, slow = shim.targets
+		assert fast.store.owned == {("app.lan", "10.0.0.1")}
+		assert ("fast.lan", "createDns", "10.0.0.1 app.lan") in calls
+		assert slow.store.owned == set()
+		assert (tmp_path / "pihole.state.fast.lan").exists()
+	finally:
+		release.set()
+	slow.pending.result(timeout=5)
+	assert slow.store.owned == {("app.lan", "10.0.0.1")}